@@ -0,0 +1,344 @@
+#### OFFLINE BENCHMARKS FOR THE PIPELINE IN SI507F17_finalproject.py ####
+#### Replays the cached Twitter responses in data_cache.json through every stage and times each one ####
+#### Usage: python SI507F17_benchmarks.py [--tweets 100000] [--output bench_results.json] [--compare old.json] ####
+#### The postgres DB stages only run when --db-name is given, because they drop and recreate the tables ####
+#### (--db-backend sqlite runs them against a throwaway sqlite file instead) ####
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+
+import psycopg2
+
+import SI507F17_finalproject as fp
+import SI507F17_fake_twitter as fake_twitter
+
+
+#--------------------------------------------------
+# Input data
+#--------------------------------------------------
+def load_cached_statuses(cache_fname):
+    """Every status in a legacy json data cache, search results and timelines alike"""
+    with open(cache_fname, 'r') as cache_file:
+        cache_diction = json.loads(cache_file.read())
+    statuses = []
+    for entry in cache_diction.values():
+        statuses.extend(fp.page_statuses(entry['values']))
+    return statuses
+
+def replicate_statuses(statuses, n, unique_text=True):
+    """Cycle through statuses until there are n of them, giving every copy a new id.
+    With unique_text each copy's text gets a suffix, so sentiment caching and
+    de-duplication can't skip the work a real corpus would need"""
+    if n is None or n <= len(statuses):
+        return statuses[:n] if n else list(statuses)
+    base_id = max(int(status['id_str']) for status in statuses) + 1
+    replicated = []
+    for i in range(n):
+        status = dict(statuses[i % len(statuses)])
+        status['id_str'] = str(base_id + i)
+        status['id'] = base_id + i
+        if unique_text and i >= len(statuses):
+            status['text'] = "{} ({})".format(status['text'], i)
+        replicated.append(status)
+    return replicated
+
+#--------------------------------------------------
+# Timing
+#--------------------------------------------------
+def time_stage(results, name, func, items, repeat=1, setup=None):
+    """Run func repeat times (after setup, which isn't timed) and record the timings"""
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    result = {
+        'stage': name,
+        'items': items,
+        'repeat': repeat,
+        'best_secs': best,
+        'median_secs': statistics.median(timings),
+        'items_per_sec': items / best if best > 0 else None
+    }
+    results.append(result)
+    print("{:<40} {:>10} items {:>10.4f}s {:>14}/s".format(name, items, best,
+        "{:.0f}".format(result['items_per_sec']) if result['items_per_sec'] else "-"))
+    return result
+
+#--------------------------------------------------
+# Stages
+#--------------------------------------------------
+def bench_cache(results, cache_fname, work_dir, repeat):
+    log_fname = os.path.join(work_dir, 'bench_cache.log')
+
+    def remove_log():
+        for fname in (log_fname, log_fname + '.idx'):
+            if os.path.exists(fname):
+                os.remove(fname)
+
+    def migrate_and_read():
+        store = fp.LogCacheStore(log_fname, legacy_fname=cache_fname, legacy_deadline=fp.cache_deadline)
+        for identifier in store:
+            store[identifier]
+        store.flush_index()
+
+    time_stage(results, 'cache: migrate json + read all', migrate_and_read, 1, repeat, setup=remove_log)
+
+    def warm_open_and_read_one():
+        store = fp.LogCacheStore(log_fname)
+        store[next(iter(store))]
+
+    time_stage(results, 'cache: open via sidecar + read one', warm_open_and_read_one, 1, repeat)
+
+    def legacy_json_load():
+        with open(cache_fname, 'r') as cache_file:
+            json.loads(cache_file.read())
+
+    time_stage(results, 'cache: legacy full json.loads', legacy_json_load, 1, repeat)
+
+def bench_cache_formats(results, cache_fname, work_dir, repeat):
+    """Write and re-read the cached responses in each on-disk format, recording the log size"""
+    with open(cache_fname, 'r') as cache_file:
+        responses = [entry['values'] for entry in json.loads(cache_file.read()).values()]
+    for label, codec, project in (('raw', None, False), ('raw+zlib', 'zlib', False), ('projected+zlib', 'zlib', True), ('projected+lzma', 'lzma', True)):
+        log_fname = os.path.join(work_dir, 'bench_format.log')
+
+        def remove_log():
+            for fname in (log_fname, log_fname + '.idx'):
+                if os.path.exists(fname):
+                    os.remove(fname)
+
+        def write():
+            store = fp.LogCacheStore(log_fname, codec=codec)
+            store.set_many((str(i), fp.project_twitter_data(response) if project else response) for i, response in enumerate(responses))
+
+        def read():
+            store = fp.LogCacheStore(log_fname)
+            for identifier in store:
+                store[identifier]
+
+        time_stage(results, 'cache: write {}'.format(label), write, len(responses), repeat, setup=remove_log)
+        result = time_stage(results, 'cache: read {}'.format(label), read, len(responses), repeat)
+        result['bytes'] = os.path.getsize(log_fname)
+        print("{:<40} {:>10} bytes".format('', result['bytes']))
+
+def bench_parsing(results, statuses, repeat):
+    time_stage(results, 'parse: twitter_handler per tweet', lambda: [fp.twitter_handler(status) for status in statuses], len(statuses), repeat)
+    time_stage(results, 'parse: TweetBatch.from_statuses', lambda: fp.TweetBatch.from_statuses(statuses), len(statuses), repeat)
+    batch = fp.TweetBatch.from_statuses(statuses)
+    time_stage(results, 'parse: MentionGraph.from_batch', lambda: fp.MentionGraph.from_batch(batch), len(statuses), repeat)
+
+def bench_sentiment(results, statuses, work_dir, repeat, single_limit=2000):
+    fname = os.path.join(work_dir, 'bench_sentiment.log')
+    cache_holder = {}
+
+    def fresh_cache():
+        if os.path.exists(fname):
+            os.remove(fname)
+        cache_holder['cache'] = fp.SentimentCache(fname, max_entries=max(len(statuses), 1))
+        fp.SENTIMENT_CACHE = cache_holder['cache'] # get_sentiment_score goes through the module cache
+
+    # the per-tweet path is slow, so only time it on a slice
+    handlers = [fp.twitter_handler(status) for status in statuses[:single_limit]]
+    time_stage(results, 'sentiment: get_sentiment_score per tweet', lambda: [handler.get_sentiment_score() for handler in handlers],
+        len(handlers), repeat, setup=fresh_cache)
+    time_stage(results, 'sentiment: score_sentiments (cold cache)', lambda: fp.score_sentiments(statuses, cache=cache_holder['cache']),
+        len(statuses), repeat, setup=fresh_cache)
+    time_stage(results, 'sentiment: score_sentiments (warm cache)', lambda: fp.score_sentiments(statuses, cache=cache_holder['cache']),
+        len(statuses), repeat)
+
+def bench_analytics(results, statuses, work_dir, repeat):
+    batch = fp.TweetBatch.from_statuses(statuses).score() # scoring is timed separately
+
+    def aggregate():
+        columns = fp.batch_columns(batch)
+        fp.aggregate_avg_retweet_count_by_classification(columns)
+        fp.aggregate_sentiment_retweets(columns)
+
+    time_stage(results, 'analytics: in-memory aggregates', aggregate, len(batch), repeat)
+    columns = fp.batch_columns(batch)
+    tweet_sentiment, avg_retweet = fp.aggregate_avg_retweet_count_by_classification(columns)
+    figures = fp.dashboard_figures(tweet_sentiment, avg_retweet, *fp.aggregate_sentiment_retweets(columns))
+    time_stage(results, 'analytics: render offline dashboard', lambda: fp.render_dashboard_offline(figures, work_dir), len(batch), repeat)
+
+def bench_index(results, statuses, work_dir, repeat, queries=1000):
+    batch = fp.TweetBatch.from_statuses(statuses)
+    fname = os.path.join(work_dir, 'bench.index')
+    build = lambda: fp.TweetIndex(fname).add_batch(batch).save()
+    time_stage(results, 'index: build + save TweetIndex', build, len(batch), repeat)
+    index = fp.TweetIndex(fname)
+    index.postings('trump') # load outside the timings
+    # the most frequent hashtag/mention paired with common words, as AND and OR queries
+    hashtags = Counter(hashtag.lower() for hashtag in batch.hashtags).most_common(1)
+    mentions = Counter(mention.lower() for mention in batch.mentions).most_common(1)
+    terms = ['trump'] + ['#' + hashtags[0][0]] * bool(hashtags) + ['@' + mentions[0][0]] * bool(mentions)
+    time_stage(results, 'index: AND query', lambda: [index.find_all('the', term) for term in itertools.islice(itertools.cycle(terms), queries)], queries, repeat)
+    time_stage(results, 'index: OR query', lambda: [index.find_any('the', term) for term in itertools.islice(itertools.cycle(terms), queries)], queries, repeat)
+
+def bench_end_to_end(results, tweets, work_dir, repeat, db=(None, None, None), latency=0.0):
+    """Serve tweets synthetic statuses from a FakeTwitterServer and time run_pipeline over
+    every page of a search and a timeline query. Each run starts from empty caches, so every
+    page goes over HTTP; db (None, None, None) skips loading"""
+    statuses = fake_twitter.generate_statuses(tweets)
+    saved_caches = (fp.CACHE_DICTION, fp.CREDS_DICTION, fp.TWEET_INDEX)
+    runs = itertools.count()
+
+    def fresh_run():
+        run_dir = os.path.join(work_dir, 'e2e_{}'.format(next(runs)))
+        os.makedirs(run_dir)
+        fp.CACHE_DICTION = fp.TTLCache(fp.LogCacheStore(os.path.join(run_dir, 'data.log'), codec=fp.CACHE_CODEC))
+        fp.CREDS_DICTION = fp.TTLCache(fp.LogCacheStore(os.path.join(run_dir, 'creds.log')))
+        fp.TWEET_INDEX = fp.TweetIndex(os.path.join(run_dir, 'data.index'))
+        fp.set_in_creds_cache('FakeTwitter', ('key', 'secret', 'owner_key', 'owner_secret', fake_twitter.FAKE_VERIFIER), 10)
+        if db[0]:
+            fp.setup_database(*db)
+
+    try:
+        with fake_twitter.FakeTwitterServer(statuses, latency=latency) as server:
+            queries = [(server.search_url, {'q': 'Donald Trump', 'count': 100}, False),
+                (server.timeline_url, {'screen_name': '@realdonaldtrump', 'count': 200}, True)]
+            result = time_stage(results, 'e2e: fake api -> run_pipeline', lambda: fp.run_pipeline(queries, 'FakeTwitter', *db, max_pages=None),
+                len(statuses), repeat, setup=fresh_run)
+            request_ms = sorted(1000 * secs for secs in server.request_secs)
+    finally:
+        fp.CACHE_DICTION, fp.CREDS_DICTION, fp.TWEET_INDEX = saved_caches
+    result['api_requests'] = len(request_ms) // repeat
+    result['api_p50_ms'] = request_ms[len(request_ms) // 2] if request_ms else None
+    result['api_p99_ms'] = request_ms[min(len(request_ms) - 1, len(request_ms) * 99 // 100)] if request_ms else None
+    print("{:<40} {:>10} requests, p50 {:.2f} ms, p99 {:.2f} ms".format('', result['api_requests'], result['api_p50_ms'] or 0, result['api_p99_ms'] or 0))
+
+def db_reachable(db_name, db_password, db_user):
+    if fp.DB_BACKEND != 'postgres':
+        return True # embedded: the file is created on first use
+    try:
+        psycopg2.connect(fp._db_dsn(db_name, db_password, db_user)).close()
+        return True
+    except psycopg2.Error:
+        return False
+
+def bench_database(results, statuses, db_name, db_password, db_user, repeat):
+    db = (db_name, db_password, db_user)
+    # postgres keeps the original stage names, so older reports still compare
+    prefix = 'db' if fp.DB_BACKEND == 'postgres' else 'db[{}]'.format(fp.DB_BACKEND)
+    batch = fp.TweetBatch.from_statuses(statuses).score() # scoring is timed separately
+    setup = lambda: fp.setup_database(*db)
+    time_stage(results, prefix + ': setup_database', setup, 1, repeat)
+    time_stage(results, prefix + ': insert_into_tweets', lambda: fp.insert_into_tweets(batch, *db), len(batch), repeat, setup=setup)
+    mention_count = len(batch.mentions)
+    time_stage(results, prefix + ': insert_into_trump_mentions', lambda: fp.insert_into_trump_mentions(batch, *db), mention_count, repeat,
+        setup=lambda: (setup(), fp.insert_into_tweets(batch, *db)))
+    time_stage(results, prefix + ': fetch_avg_retweet_count...', lambda: fp.fetch_avg_retweet_count_trump_tweets_by_classification(*db), len(batch), repeat)
+    time_stage(results, prefix + ': fetch_sentiment_retweets_abtrump', lambda: fp.fetch_sentiment_retweets_abtrump(*db), len(batch), repeat)
+    time_stage(results, prefix + ': ..._abtrump_arrays (named cursor)', lambda: fp.fetch_sentiment_retweets_abtrump_arrays(*db), len(batch), repeat)
+
+#--------------------------------------------------
+# Running & reporting
+#--------------------------------------------------
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(cache_fname=fp.CACHE_FNAME, tweets=None, unique_text=True, repeat=3, db_name=None,
+    db_password=fp.DB_PASSWORD, db_user=fp.DB_USER, stages=('cache', 'parse', 'sentiment', 'analytics', 'index', 'db'), db_backend=None,
+    api_latency=0.0):
+    """Run the selected stages and return a json-serializable report. The "e2e" stage
+    (not run by default) generates its own tweets, as many as tweets"""
+    base_statuses = load_cached_statuses(cache_fname)
+    statuses = replicate_statuses(base_statuses, tweets, unique_text)
+    print("Benchmarking {} tweets ({} cached originals)".format(len(statuses), len(base_statuses)))
+    results = []
+    work_dir = tempfile.mkdtemp(prefix='si507_bench_')
+    saved_debug, saved_sentiment_cache, saved_backend = fp.DEBUG, fp.SENTIMENT_CACHE, fp.DB_BACKEND
+    fp.DEBUG = False
+    fp.DB_BACKEND = db_backend or fp.DB_BACKEND
+    try:
+        if 'cache' in stages:
+            bench_cache(results, cache_fname, work_dir, repeat)
+            bench_cache_formats(results, cache_fname, work_dir, repeat)
+        if 'parse' in stages:
+            bench_parsing(results, statuses, repeat)
+        if 'sentiment' in stages:
+            bench_sentiment(results, statuses, work_dir, repeat)
+        if 'analytics' in stages:
+            bench_analytics(results, statuses, work_dir, repeat)
+        if 'index' in stages:
+            bench_index(results, statuses, work_dir, repeat)
+        if 'db' in stages:
+            if not db_name and fp.DB_BACKEND == 'sqlite':
+                db_name = os.path.join(work_dir, 'bench_db')
+            if db_name and db_reachable(db_name, db_password, db_user):
+                bench_database(results, statuses, db_name, db_password, db_user, repeat)
+            else:
+                print("Skipping db stages (pass --db-name of a reachable, disposable database, or --db-backend sqlite)")
+        if 'e2e' in stages:
+            e2e_db = (db_name or os.path.join(work_dir, 'bench_e2e_db'), db_password, db_user) if fp.DB_BACKEND == 'sqlite' else (db_name, db_password, db_user)
+            if not e2e_db[0] or not db_reachable(*e2e_db):
+                print("e2e: no reachable --db-name, so tweets are fetched, parsed and scored but not loaded")
+                e2e_db = (None, None, None)
+            bench_end_to_end(results, tweets or len(statuses), work_dir, repeat, e2e_db, api_latency)
+    finally:
+        fp.DEBUG, fp.SENTIMENT_CACHE = saved_debug, saved_sentiment_cache
+        db_backend = fp.DB_BACKEND
+        fp.DB_BACKEND = saved_backend
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'tweets': len(statuses),
+        'unique_text': unique_text,
+        'db_backend': db_backend,
+        'results': results
+    }
+
+def compare_reports(old_report, new_report):
+    """Print each stage's best time in both reports and the ratio new/old"""
+    old_by_stage = {result['stage']: result for result in old_report['results']}
+    if old_report.get('tweets') != new_report.get('tweets'):
+        print("Note: the reports cover different corpus sizes ({} vs {} tweets)".format(old_report.get('tweets'), new_report.get('tweets')))
+    print("{:<40} {:>10} {:>10} {:>8}".format('stage', 'old (s)', 'new (s)', 'ratio'))
+    for result in new_report['results']:
+        old = old_by_stage.get(result['stage'])
+        if not old:
+            continue
+        ratio = result['best_secs'] / old['best_secs'] if old['best_secs'] else float('inf')
+        flag = "  <-- slower" if ratio > 1.1 else ""
+        print("{:<40} {:>10.4f} {:>10.4f} {:>7.2f}x{}".format(result['stage'], old['best_secs'], result['best_secs'], ratio, flag))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each stage of the pipeline offline against cached Twitter responses")
+    parser.add_argument('--cache-file', default=fp.CACHE_FNAME, help="legacy json data cache to replay")
+    parser.add_argument('--tweets', type=int, default=None, help="replicate the cached tweets up to this many")
+    parser.add_argument('--duplicate-text', action='store_true', help="keep replicated texts identical (lets sentiment caching kick in)")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stages', default='cache,parse,sentiment,analytics,index,db', help="comma separated; add e2e for a full run against a local fake api")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="seconds the fake api adds to each response (e2e stage)")
+    parser.add_argument('--db-name', default=None, help="disposable database for the db stages (its tables are dropped)")
+    parser.add_argument('--db-backend', default=None, choices=sorted(fp.STORAGE_BACKENDS), help="storage backend for the db stages (default: secret_data.db_backend)")
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', default=None, help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.cache_file, args.tweets, not args.duplicate_text, args.repeat, args.db_name,
+        stages=args.stages.split(','), db_backend=args.db_backend, api_latency=args.api_latency)
+    with open(args.output, 'w') as output_file:
+        output_file.write(json.dumps(report, indent=2))
+    print("Results written to {}".format(args.output))
+    if args.compare:
+        with open(args.compare, 'r') as compare_file:
+            compare_reports(json.loads(compare_file.read()), report)
@@ -0,0 +1,427 @@
+"""Synthetic tweets and a local stand-in for the Twitter API, for end-to-end runs at scale
+without network access or credentials.
+
+generate_statuses() builds statuses with the fields and rough proportions of the ones in
+data_cache.json: retweets (with their retweeted_status), mentions and hashtags with entity
+indices, and reply chains. FakeTwitterServer serves them over local HTTP from
+/1.1/search/tweets.json and /1.1/statuses/user_timeline.json (count/max_id/since_id
+paging, optional latency, twitter's x-rate-limit-* headers and 429s) plus the three oauth
+endpoints get_tokens talks to. Signatures are not checked.
+
+Usage:
+    python SI507F17_fake_twitter.py --tweets 100000 --port 8080 --latency 0.05
+    python SI507F17_finalproject.py --api-base=http://127.0.0.1:8080 --offline
+"""
+import argparse
+import bisect
+import functools
+import json
+import math
+import random
+import re
+import threading
+import time
+import zlib
+from calendar import timegm
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+#--------------------------------------------------
+# Corpus model
+#--------------------------------------------------
+DEFAULT_WORDS = (
+    "great", "terrible", "wonderful", "bad", "sad", "happy", "fake", "strong", "weak", "beautiful",
+    "horrible", "amazing", "disgraceful", "best", "worst", "good", "failing", "tremendous", "nice", "angry",
+    "news", "people", "country", "economy", "jobs", "tax", "cuts", "border", "wall", "vote",
+    "election", "senate", "house", "media", "president", "america", "today", "tonight", "meeting", "deal",
+    "big", "new", "record", "market", "military", "congress", "bill", "law", "court", "report",
+    "the", "a", "is", "was", "will", "and", "of", "to", "for", "with", "on", "in", "very", "so", "we", "they",
+)
+DEFAULT_SCREEN_NAMES = (
+    "WhiteHouse", "FoxNews", "CNN", "nytimes", "foxandfriends", "VP", "SenateGOP", "NBCNews", "WSJ", "AP",
+    "washingtonpost", "POTUS", "DonaldJTrumpJr", "GOP", "TheDemocrats", "seanhannity", "FLOTUS", "IvankaTrump",
+)
+DEFAULT_HASHTAGS = ("MAGA", "TaxReform", "AmericaFirst", "FakeNews", "USA", "Trump", "news", "RT")
+TWEPOCH_MS = 1288834974657 # twitter's snowflake epoch: ids are (ms since it) << 22 | sequence
+NEWEST_TWEET_SECS = timegm((2017, 12, 14, 20, 0, 0)) # around when data_cache.json was fetched
+_DAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+_MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+_WORD_RE = re.compile(r"[A-Za-z']{3,}")
+
+class CorpusModel(object):
+    """What generated tweets are made of: vocabulary, other users, hashtags, and how often a
+    tweet is a retweet, a reply, mentions someone or carries a hashtag. from_cache()
+    measures all of these on a legacy json data cache"""
+
+    def __init__(self, words=DEFAULT_WORDS, screen_names=DEFAULT_SCREEN_NAMES, hashtags=DEFAULT_HASHTAGS,
+        retweet_rate=0.6, reply_rate=0.05, mention_rate=0.5, hashtag_rate=0.15, mean_retweets=2000.0):
+        self.words = tuple(words)
+        self.screen_names = tuple(screen_names)
+        self.hashtags = tuple(hashtags)
+        self.retweet_rate = retweet_rate
+        self.reply_rate = reply_rate
+        self.mention_rate = mention_rate
+        self.hashtag_rate = hashtag_rate
+        self.mean_retweets = mean_retweets
+
+    @classmethod
+    def from_cache(cls, cache_fname):
+        with open(cache_fname, 'r') as cache_file:
+            statuses = []
+            for entry in json.load(cache_file).values():
+                values = entry['values']
+                statuses.extend(values.get('statuses', []) if isinstance(values, dict) else values)
+        if not statuses:
+            return cls()
+        words, screen_names, hashtags = set(), set(), set()
+        for status in statuses:
+            words.update(word.lower() for word in _WORD_RE.findall(re.sub(r"https?://\S+|[@#]\w+", " ", status['text'])))
+            screen_names.update(mention['screen_name'] for mention in status['entities']['user_mentions'])
+            hashtags.update(hashtag['text'] for hashtag in status['entities']['hashtags'])
+        n = float(len(statuses))
+        return cls(sorted(words) or DEFAULT_WORDS, sorted(screen_names) or DEFAULT_SCREEN_NAMES, sorted(hashtags) or DEFAULT_HASHTAGS,
+            retweet_rate=sum('retweeted_status' in status for status in statuses) / n,
+            reply_rate=sum(bool(status.get('in_reply_to_status_id_str')) for status in statuses) / n,
+            mention_rate=sum(bool(status['entities']['user_mentions']) for status in statuses) / n,
+            hashtag_rate=sum(bool(status['entities']['hashtags']) for status in statuses) / n,
+            mean_retweets=max(sum(status['retweet_count'] for status in statuses) / n, 1.0))
+
+#--------------------------------------------------
+# Generator
+#--------------------------------------------------
+def format_created_at(epoch_secs):
+    # twitter's created_at ("Thu Dec 14 19:57:46 +0000 2017"), independent of the locale
+    t = time.gmtime(epoch_secs)
+    return "{} {} {:02d} {:02d}:{:02d}:{:02d} +0000 {}".format(_DAYS[t.tm_wday], _MONTHS[t.tm_mon - 1], t.tm_mday,
+        t.tm_hour, t.tm_min, t.tm_sec, t.tm_year)
+
+@functools.lru_cache(maxsize=None)
+def _user(screen_name):
+    # shared between statuses; nothing mutates it
+    user_id = zlib.crc32(screen_name.encode('utf-8'))
+    return {'id': user_id, 'id_str': str(user_id), 'screen_name': screen_name, 'name': screen_name.title(),
+        'followers_count': user_id % 100000, 'verified': user_id % 7 == 0, 'lang': 'en'}
+
+class _TextBuilder(object):
+    # text plus entities with [start, end) indices, built token by token
+    def __init__(self):
+        self.parts = []
+        self.length = 0
+        self.mentions = []
+        self.hashtags = []
+
+    def add(self, token):
+        if self.parts:
+            self.parts.append(" ")
+            self.length += 1
+        start = self.length
+        self.parts.append(token)
+        self.length += len(token)
+        return [start, self.length]
+
+    def mention(self, screen_name):
+        user = _user(screen_name)
+        self.mentions.append({'screen_name': screen_name, 'name': user['name'], 'id': user['id'], 'id_str': user['id_str'],
+            'indices': self.add("@" + screen_name)})
+
+    def hashtag(self, tag):
+        self.hashtags.append({'text': tag, 'indices': self.add("#" + tag)})
+
+    def entities(self):
+        return {'hashtags': self.hashtags, 'symbols': [], 'user_mentions': self.mentions, 'urls': []}
+
+def _make_status(tweet_id, created_secs, screen_name, builder, retweet_count):
+    return {
+        'created_at': format_created_at(created_secs), 'id': tweet_id, 'id_str': str(tweet_id), 'text': "".join(builder.parts),
+        'truncated': False, 'entities': builder.entities(), 'metadata': {'iso_language_code': 'en', 'result_type': 'recent'},
+        'source': '<a href="http://twitter.com" rel="nofollow">Twitter Web Client</a>',
+        'in_reply_to_status_id': None, 'in_reply_to_status_id_str': None, 'in_reply_to_user_id': None,
+        'in_reply_to_user_id_str': None, 'in_reply_to_screen_name': None, 'user': _user(screen_name),
+        'geo': None, 'coordinates': None, 'place': None, 'contributors': None, 'is_quote_status': False,
+        'retweet_count': retweet_count, 'favorite_count': 0 if builder.parts[0] == "RT" else retweet_count * 3,
+        'favorited': False, 'retweeted': False, 'lang': 'en'
+    }
+
+def generate_statuses(n, model=None, seed=0, author='realDonaldTrump', author_share=0.2, query=("Donald", "Trump"),
+    newest_secs=NEWEST_TWEET_SECS, mean_gap_secs=30.0):
+    """n synthetic statuses, newest first, with ids that grow with created_at like twitter's.
+
+    author_share of them are by author (original tweets only, like a timeline); the rest are
+    by the model's users and contain the query words, so a search for them finds those.
+    Retweets carry their (older) retweeted_status, replies point at an earlier tweet (which
+    may itself be a reply, giving chains). The same seed always gives the same corpus."""
+    model = model or CorpusModel()
+    rng = random.Random(seed)
+    sigma = 1.5 # retweet counts are heavy tailed: lognormal with the model's mean
+    mu = math.log(model.mean_retweets) - sigma * sigma / 2
+    gaps = [rng.expovariate(1.0 / mean_gap_secs) for _ in range(n)]
+    created = [newest_secs - sum_gap for sum_gap in _running_sums(gaps)] # newest first
+    statuses = []
+    for i in range(n - 1, -1, -1): # oldest first, so replies can point back at earlier tweets
+        created_secs = created[i]
+        tweet_id = ((int(created_secs * 1000) - TWEPOCH_MS) << 22) | (n - i) # strictly decreasing with i
+        by_author = rng.random() < author_share
+        screen_name = author if by_author else rng.choice(model.screen_names)
+        builder = _TextBuilder()
+        retweet_count = int(rng.lognormvariate(mu, sigma))
+        reply_to = statuses[-rng.randint(1, min(len(statuses), 50))] if statuses and rng.random() < model.reply_rate else None
+        retweet_of = None
+        if not by_author and not reply_to and rng.random() < model.retweet_rate:
+            retweet_of = rng.choice(model.screen_names + (author,))
+            builder.add("RT")
+            builder.mention(retweet_of)
+            builder.parts[-1] += ":"
+            builder.length += 1
+        elif reply_to:
+            builder.mention(reply_to['user']['screen_name'])
+        words = rng.choices(model.words, k=rng.randint(4, 16))
+        builder.add(" ".join(words + list(query) if not by_author else words))
+        if rng.random() < model.mention_rate:
+            for screen in rng.sample(model.screen_names, rng.randint(1, min(3, len(model.screen_names)))):
+                builder.mention(screen)
+        if rng.random() < model.hashtag_rate:
+            builder.hashtag(rng.choice(model.hashtags))
+        status = _make_status(tweet_id, int(created_secs), screen_name, builder, retweet_count)
+        if reply_to:
+            status.update({'in_reply_to_status_id': reply_to['id'], 'in_reply_to_status_id_str': reply_to['id_str'],
+                'in_reply_to_user_id': reply_to['user']['id'], 'in_reply_to_user_id_str': reply_to['user']['id_str'],
+                'in_reply_to_screen_name': reply_to['user']['screen_name']})
+        if retweet_of:
+            # the original: the text after "RT @user: ", its entities shifted to match
+            prefix = builder.mentions[0]['indices'][1] + 2
+            original_secs = int(created_secs) - rng.randint(60, 86400)
+            original_id = ((original_secs * 1000 - TWEPOCH_MS) << 22) | (n - i)
+            status['retweeted_status'] = dict(status, id=original_id, id_str=str(original_id), created_at=format_created_at(original_secs),
+                text=status['text'][prefix:], user=_user(retweet_of), favorite_count=retweet_count * 3,
+                entities={'hashtags': _shifted(builder.hashtags, prefix), 'symbols': [],
+                    'user_mentions': _shifted(builder.mentions[1:], prefix), 'urls': []})
+        statuses.append(status)
+    statuses.reverse()
+    return statuses
+
+def _shifted(entities, offset):
+    return [dict(entity, indices=[entity['indices'][0] - offset, entity['indices'][1] - offset]) for entity in entities]
+
+def _running_sums(values):
+    total = 0.0
+    for value in values:
+        total += value
+        yield total
+
+#--------------------------------------------------
+# Local HTTP stand-in
+#--------------------------------------------------
+SEARCH_PATH = "/1.1/search/tweets.json"
+TIMELINE_PATH = "/1.1/statuses/user_timeline.json"
+REQUEST_TOKEN_PATH = "/oauth/request_token"
+AUTHORIZE_PATH = "/oauth/authorize"
+ACCESS_TOKEN_PATH = "/oauth/access_token"
+FAKE_VERIFIER = "1234567"
+MAX_COUNT = {SEARCH_PATH: 100, TIMELINE_PATH: 200} # the api's caps on count
+RATE_LIMITS = {SEARCH_PATH: 180, TIMELINE_PATH: 900} # requests per window, per endpoint, like twitter's
+RATE_LIMIT_WINDOW_SECS = 900
+
+class _StatusView(object):
+    # some of the statuses, newest first; pages are bisected out by id
+    __slots__ = ('neg_ids', 'encoded')
+
+    def __init__(self, neg_ids, encoded):
+        self.neg_ids = neg_ids # -id, so the list is ascending
+        self.encoded = encoded # each status as json bytes, serialized once
+
+    def page(self, count, max_id=None, since_id=None):
+        start = 0 if max_id is None else bisect.bisect_left(self.neg_ids, -max_id)
+        end = len(self.neg_ids) if since_id is None else bisect.bisect_left(self.neg_ids, -since_id)
+        return self.encoded[start:max(start, min(start + count, end))]
+
+class _RateWindow(object):
+    __slots__ = ('limit', 'window_secs', 'start', 'used')
+
+    def __init__(self, limit, window_secs):
+        self.limit, self.window_secs = limit, window_secs
+        self.start, self.used = time.time(), 0
+
+    def take(self, now):
+        # (allowed, headers) for one more request
+        if now >= self.start + self.window_secs:
+            self.start, self.used = now, 0
+        self.used += 1
+        headers = {'x-rate-limit-limit': str(self.limit), 'x-rate-limit-remaining': str(max(self.limit - self.used, 0)),
+            'x-rate-limit-reset': str(int(math.ceil(self.start + self.window_secs)))}
+        return self.used <= self.limit, headers
+
+class FakeTwitterServer(object):
+    """Serves statuses (newest first or not; they are sorted) like search/tweets.json and
+    statuses/user_timeline.json, on a background thread.
+
+    Search matches statuses whose text contains every word of q (case-insensitive), the
+    timeline those whose user is screen_name; both page with count, max_id and since_id.
+    Every response waits latency (+ up to latency_jitter) seconds. rate_limits maps an
+    endpoint path to requests allowed per window_secs (None: no limits); responses carry
+    x-rate-limit-* headers and a 429 once a window is used up. requests counts the api
+    requests answered, rejected the 429s, and request_secs holds each one's service time."""
+
+    def __init__(self, statuses, latency=0.0, latency_jitter=0.0, rate_limits=None, window_secs=RATE_LIMIT_WINDOW_SECS,
+        host='127.0.0.1', port=0):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.rate_limits = rate_limits
+        self.window_secs = window_secs
+        self.requests = 0
+        self.rejected = 0
+        self.request_secs = []
+        self._lock = threading.Lock()
+        self._windows = {}
+        self.set_statuses(statuses)
+        self._httpd = ThreadingHTTPServer((host, port), _FakeTwitterHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake = self
+        self._thread = None
+
+    def set_statuses(self, statuses):
+        ordered = sorted(statuses, key=lambda status: -int(status['id_str']))
+        with self._lock:
+            self._statuses = ordered
+            self._encoded = [json.dumps(status).encode('utf-8') for status in ordered]
+            self._views = {} # ('q', words) / ('user', screen name) -> _StatusView, built on first use
+
+    def _view(self, key, matches):
+        with self._lock:
+            view = self._views.get(key)
+            if view is None:
+                hits = [i for i, status in enumerate(self._statuses) if matches(status)]
+                view = self._views[key] = _StatusView([-int(self._statuses[i]['id_str']) for i in hits], [self._encoded[i] for i in hits])
+            return view
+
+    def search_view(self, q):
+        words = tuple(q.lower().split())
+        return self._view(('q', words), lambda status: all(word in status['text'].lower() for word in words))
+
+    def timeline_view(self, screen_name):
+        screen_name = screen_name.lstrip('@').lower()
+        return self._view(('user', screen_name), lambda status: status['user']['screen_name'].lower() == screen_name)
+
+    def take_rate_limit(self, path):
+        if not self.rate_limits or path not in self.rate_limits:
+            return True, {}
+        with self._lock:
+            window = self._windows.get(path)
+            if window is None:
+                window = self._windows[path] = _RateWindow(self.rate_limits[path], self.window_secs)
+            allowed, headers = window.take(time.time())
+            if not allowed:
+                self.rejected += 1
+            return allowed, headers
+
+    def record(self, secs):
+        with self._lock:
+            self.requests += 1
+            self.request_secs.append(secs)
+
+    #### URLS ####
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    @property
+    def search_url(self):
+        return self.base_url + SEARCH_PATH
+
+    @property
+    def timeline_url(self):
+        return self.base_url + TIMELINE_PATH
+
+    #### LIFECYCLE ####
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+class _FakeTwitterHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, like the real api
+
+    def do_GET(self):
+        fake = self.server.fake
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        if url.path == AUTHORIZE_PATH:
+            return self._send(200, "verifier: {}".format(FAKE_VERIFIER).encode('utf-8'), 'text/plain')
+        if url.path not in MAX_COUNT:
+            return self._send(404, b'{"errors":[{"code":34,"message":"Sorry, that page does not exist."}]}')
+        start = time.perf_counter()
+        delay = fake.latency + (random.uniform(0, fake.latency_jitter) if fake.latency_jitter else 0)
+        if delay:
+            time.sleep(delay)
+        allowed, headers = fake.take_rate_limit(url.path)
+        if not allowed:
+            return self._send(429, b'{"errors":[{"code":88,"message":"Rate limit exceeded"}]}', headers=headers)
+        try:
+            count = min(int(query.get('count', 15)), MAX_COUNT[url.path])
+            max_id = int(query['max_id']) if 'max_id' in query else None
+            since_id = int(query['since_id']) if 'since_id' in query else None
+        except ValueError:
+            return self._send(400, b'{"errors":[{"code":44,"message":"Invalid parameter."}]}', headers=headers)
+        if url.path == SEARCH_PATH:
+            page = fake.search_view(query.get('q', '')).page(count, max_id, since_id)
+            metadata = json.dumps({'count': count, 'query': query.get('q', ''), 'since_id': since_id or 0, 'max_id': max_id})
+            body = b'{"statuses":[' + b','.join(page) + b'],"search_metadata":' + metadata.encode('utf-8') + b'}'
+        else:
+            body = b'[' + b','.join(fake.timeline_view(query.get('screen_name', '')).page(count, max_id, since_id)) + b']'
+        self._send(200, body, headers=headers)
+        fake.record(time.perf_counter() - start)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        path = urlparse(self.path).path
+        if path == REQUEST_TOKEN_PATH:
+            body = b'oauth_token=fake-request-token&oauth_token_secret=fake-request-secret&oauth_callback_confirmed=true'
+        elif path == ACCESS_TOKEN_PATH:
+            body = b'oauth_token=fake-access-token&oauth_token_secret=fake-access-secret&user_id=1&screen_name=fake'
+        else:
+            return self._send(404, b'{"errors":[{"code":34,"message":"Sorry, that page does not exist."}]}')
+        self._send(200, body, 'application/x-www-form-urlencoded')
+
+    def _send(self, status, body, content_type='application/json;charset=utf-8', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve synthetic tweets from a local stand-in for the Twitter API")
+    parser.add_argument('--tweets', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--model-cache', default=None, help="legacy json data cache to model the tweets on (e.g. data_cache.json)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every api response")
+    parser.add_argument('--latency-jitter', type=float, default=0.0)
+    parser.add_argument('--rate-limit', action='store_true', help="enforce twitter's per-endpoint rate limits")
+    args = parser.parse_args()
+    model = CorpusModel.from_cache(args.model_cache) if args.model_cache else None
+    statuses = generate_statuses(args.tweets, model, args.seed)
+    server = FakeTwitterServer(statuses, args.latency, args.latency_jitter, RATE_LIMITS if args.rate_limit else None,
+        host=args.host, port=args.port)
+    print("Serving {} tweets at {} (search: {}, timeline: {})".format(len(statuses), server.base_url, SEARCH_PATH, TIMELINE_PATH))
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
@@ -1,8 +1,32 @@
 import re
+import os
+import mmap
+import atexit
+import threading
+import queue
+import time
+import hashlib
+import zlib
+import lzma
+import heapq
+import itertools
+import functools
+import calendar
+from array import array
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections.abc import MutableMapping
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+import sqlite3
 import requests
 import requests_oauthlib
+import requests.adapters
+from urllib3.util.retry import Retry
 import json
 import secret_data
 import webbrowser
@@ -12,7 +36,9 @@ import sys
 import plotly
 import plotly.plotly as py
 import plotly.graph_objs as go
+import plotly.offline
 import decimal
+import numpy as np
 
 
 ##### CACHING SETUP #####
@@ -26,95 +52,723 @@ DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
 DEBUG = True
 CACHE_FNAME = "data_cache.json"
 CREDS_CACHE_FILE = "creds_cache.json"
+# Append-only logs that replaced the json files above (which are migrated on first load)
+CACHE_LOG_FNAME = "data_cache.log"
+CREDS_LOG_FNAME = "creds_cache.log"
+# Compact a log once at least this many bytes AND this fraction of the file are dead records
+COMPACT_MIN_DEAD_BYTES = 1024 * 1024
+COMPACT_DEAD_RATIO = 0.5
+STORE_VALUE_MEMO_ENTRIES = 64 # recently read values a log store keeps decoded; the rest stay on disk
+CACHE_MAX_ENTRIES = 10000 # least recently used responses are evicted past this many...
+CACHE_MAX_BYTES = 256 * 1024 * 1024 # ...or past this many bytes of log records
+CACHE_REPLAY = False # serve cached entries whatever their age (offline replays of data_cache.json)
+CACHE_FORMAT = "projected" # "projected" keeps only the status fields the pipeline reads, "raw" the full api responses
+CACHE_CODEC = "zlib" # how data cache records are compressed on disk: None, "zlib" or "lzma"
+TWEET_INDEX_FNAME = "data_cache.index" # keyword/hashtag/mention index over the cached tweets
 
 #--------------------------------------------------
-# Load cache files: data and credentials
+# Instrumentation: per-stage timers and counters
 #--------------------------------------------------
-# Load data cache
-try:
-    with open(CACHE_FNAME, 'r') as cache_file:
-        cache_json = cache_file.read()
-        CACHE_DICTION = json.loads(cache_json)
-except:
-    CACHE_DICTION = {}
-
-# Load creds cache
-try:
-    with open(CREDS_CACHE_FILE,'r') as creds_file:
-        cache_creds = creds_file.read()
-        CREDS_DICTION = json.loads(cache_creds)
-except:
-    CREDS_DICTION = {}
+INSTRUMENT = False # collect timings/counters (python SI507F17_finalproject.py --instrument)
+PROFILE_MODE = None # "cprofile" or "tracemalloc" to profile a whole run (--profile=cprofile)
 
-#---------------------------------------------
-# Cache functions
-#---------------------------------------------
-def has_cache_expired(timestamp_str, expire_in_hrs=10):
-    """Check if cache timestamp is over expire_in_hrs old"""
-    # gives current datetime
-    now = datetime.now()
+class _NullTimer(object):
+    # what timed() hands out while INSTRUMENT is off: entering and leaving it does nothing
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class _StageTimer(object):
+    __slots__ = ('instruments', 'stage', 'start')
+
+    def __init__(self, instruments, stage):
+        self.instruments = instruments
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instruments.record(self.stage, time.perf_counter() - self.start)
+        return False
+
+class Instrumentation(object):
+    """Per-stage call counts/durations and named event counters, safe to use from threads"""
 
-    # datetime.strptime converts a formatted string into datetime object
-    cache_timestamp = datetime.strptime(timestamp_str, DATETIME_FORMAT)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
 
-    # subtracting two datetime objects gives you a timedelta object
-    delta = now - cache_timestamp
-    delta_in_hrs = (delta.seconds)/3600
-    print("Delta in hours calculated as {}".format(delta_in_hrs))
+    def reset(self):
+        with self._lock:
+            self.stages = {} # stage -> [calls, total secs, max secs]
+            self.counters = {}
 
+    def record(self, stage, elapsed):
+        with self._lock:
+            stats = self.stages.setdefault(stage, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
 
-    # now that we have hours as integers, we can just use comparison
-    # and decide if cache has expired or not
-    if delta_in_hrs > expire_in_hrs:
-        return True # It's been longer than expiry time
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        lines = ["{:<32} {:>8} {:>12} {:>12} {:>12}".format('stage', 'calls', 'total (s)', 'mean (ms)', 'max (ms)')]
+        for stage, (calls, total, longest) in sorted(self.stages.items(), key=lambda item: -item[1][1]):
+            lines.append("{:<32} {:>8} {:>12.4f} {:>12.3f} {:>12.3f}".format(stage, calls, total, 1000 * total / calls, 1000 * longest))
+        for name, value in sorted(self.counters.items()):
+            lines.append("{:<32} {:>8}".format(name, value))
+        return "\n".join(lines)
+
+INSTRUMENTS = Instrumentation()
+
+def timed(stage):
+    """Context manager timing a stage into INSTRUMENTS; a shared no-op when INSTRUMENT is off"""
+    if not INSTRUMENT:
+        return _NULL_TIMER
+    return _StageTimer(INSTRUMENTS, stage)
+
+def count_event(name, n=1):
+    if INSTRUMENT:
+        INSTRUMENTS.count(name, n)
+
+_PROFILER = {}
+
+def start_profiling(mode):
+    """Start capturing a cProfile ("cprofile") or tracemalloc ("tracemalloc") profile"""
+    if mode == "cprofile":
+        import cProfile
+        _PROFILER['cprofile'] = cProfile.Profile()
+        _PROFILER['cprofile'].enable()
+    elif mode == "tracemalloc":
+        import tracemalloc
+        tracemalloc.start()
+        _PROFILER['tracemalloc'] = True
     else:
-        return False # It's still a valid cache
+        raise ValueError("Unknown profile mode: {}".format(mode))
+
+def stop_profiling(top=20):
+    """Stop whatever start_profiling started and return its top entries as text"""
+    if 'cprofile' in _PROFILER:
+        import io
+        import pstats
+        profiler = _PROFILER.pop('cprofile')
+        profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(top)
+        return out.getvalue()
+    if _PROFILER.pop('tracemalloc', None):
+        import tracemalloc
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        lines = ["Allocated now: {:.1f} MB, peak: {:.1f} MB".format(current / 1e6, peak / 1e6)]
+        lines.extend(str(stat) for stat in snapshot.statistics('lineno')[:top])
+        return "\n".join(lines)
+    return ""
+
+#--------------------------------------------------
+# Append-only cache store
+#--------------------------------------------------
+def atomic_write(fname, chunks):
+    """Write chunks (bytes) to a temp file, fsync it and swap it in place of fname,
+    so a crash leaves either the old file or the new one -- never half of each"""
+    tmp_fname = fname + ".tmp"
+    with open(tmp_fname, 'wb') as tmp_file:
+        for chunk in chunks:
+            tmp_file.write(chunk)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_fname, fname)
+    try:
+        dir_fd = os.open(os.path.dirname(os.path.abspath(fname)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd) # make the rename itself durable
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass # not every platform lets you fsync a directory
+
+RECORD_CODECS = {
+    'zlib': (zlib.compress, zlib.decompress), # fast, roughly 10x smaller for raw tweet json
+    'lzma': (lzma.compress, lzma.decompress) # smaller still, but several times slower to write
+}
+
+class LogCacheStore(MutableMapping):
+    """Dictionary-like cache backed by an append-only record log.
+
+    Every set/delete appends one record to the log, so a write costs O(entry size)
+    instead of re-serializing the whole cache. An in-memory index maps each identifier
+    to the offset of its latest record. Superseded records are dropped by compaction,
+    which runs on a background thread once enough of the file is dead.
+
+    Nothing is read until the store is first used. The index is then loaded from a
+    small sidecar file (fname + ".idx") and only records appended after it was written
+    are scanned; values are decoded one at a time, straight out of a memory map of the log.
+    Only the last STORE_VALUE_MEMO_ENTRIES values read are kept decoded, so resident memory
+    doesn't grow with the size of the cache.
+
+    Record layout: a json header line {"k": identifier, "n": value_length}, then
+    value_length bytes of json, then a newline. Deletes are headers with "del" set, and
+    entries written with an expiry carry it as an epoch deadline in "x", so expiry can be
+    checked from the index without decoding the value. With a codec the value bytes are
+    compressed json and "c" names the codec; reads decompress whatever each record says,
+    so a log can mix records written with and without one. When migrating legacy_fname,
+    legacy_deadline(value) gives the "x" deadline written for each entry, and on_migrate(store)
+    is called once the migrated log has loaded."""
+
+    INDEX_VERSION = 3
+
+    def __init__(self, fname, legacy_fname=None, codec=None, legacy_deadline=None, on_migrate=None):
+        if codec is not None and codec not in RECORD_CODECS:
+            raise ValueError("Unknown record codec: {}".format(codec))
+        self.fname = fname
+        self.index_fname = fname + ".idx"
+        self.legacy_fname = legacy_fname
+        self.legacy_deadline = legacy_deadline
+        self.on_migrate = on_migrate
+        self.codec = codec
+        self._lock = threading.RLock()
+        self._index = {} # identifier -> (value_offset, value_length, record_length, expires_at, codec)
+        self._values = OrderedDict() # identifier -> decoded value, the most recently read last
+        self._file_size = 0
+        self._live_bytes = 0
+        self._compacting = False
+        self._loaded = False
+        self._index_dirty = False
+        self._mmap = None
+
+    #### LOADING ####
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            migrated = self._load()
+            self._loaded = True
+            atexit.register(self.flush_index)
+            # after _loaded is set, so the callback can read the store
+            if migrated and self.on_migrate is not None:
+                self.on_migrate(self)
+
+    def _load(self):
+        """Load the log (migrating legacy_fname first if there is no log yet); True if it migrated"""
+        migrated = False
+        if not os.path.exists(self.fname) and self.legacy_fname and os.path.exists(self.legacy_fname):
+            migrated = self._migrate_legacy()
+        try:
+            log_file = open(self.fname, 'rb')
+        except FileNotFoundError:
+            return migrated
+        with log_file:
+            start = self._load_sidecar(os.fstat(log_file.fileno()))
+            self._scan(log_file, start)
+        return migrated
+
+    def _load_sidecar(self, log_stat):
+        """Load the saved index if it still describes this log file; returns the offset
+        the log has to be scanned from (0 means the sidecar was missing or stale)"""
+        try:
+            with open(self.index_fname, 'r') as index_file:
+                sidecar = json.loads(index_file.read())
+        except (OSError, ValueError):
+            return 0
+        if sidecar.get('version') != self.INDEX_VERSION:
+            return 0
+        # compaction swaps in a new file, so a different inode means different offsets
+        if sidecar.get('log_inode') != log_stat.st_ino or sidecar.get('log_size', 0) > log_stat.st_size:
+            return 0
+        self._index = {k: tuple(v) for k, v in sidecar['entries'].items()}
+        self._live_bytes = sum(entry[2] for entry in self._index.values())
+        return sidecar['log_size']
+
+    def flush_index(self):
+        """Save the in-memory index next to the log so the next start skips the scan"""
+        with self._lock:
+            if not self._index_dirty or not os.path.exists(self.fname):
+                return
+            sidecar = {
+                'version': self.INDEX_VERSION,
+                'log_inode': os.stat(self.fname).st_ino,
+                'log_size': self._file_size,
+                'entries': self._index
+            }
+            atomic_write(self.index_fname, [json.dumps(sidecar).encode('utf-8')])
+            self._index_dirty = False
+
+    def _scan(self, log_file, start):
+        """Walk the records from start, seeking over the values; a torn record at the
+        end (from a crash mid-append) is cut off"""
+        log_file.seek(0, os.SEEK_END)
+        end = log_file.tell()
+        offset = start
+        log_file.seek(offset)
+        while offset < end:
+            header_line = log_file.readline()
+            try:
+                header = json.loads(header_line.decode('utf-8'))
+                value_length = header['n']
+            except (ValueError, KeyError, TypeError):
+                break
+            value_offset = offset + len(header_line)
+            record_end = value_offset + value_length + 1
+            if not header_line.endswith(b"\n") or record_end > end:
+                break
+            self._apply(header, value_offset, value_length, record_end - offset)
+            offset = record_end
+            log_file.seek(offset)
+        if offset < end:
+            if DEBUG:
+                print("Dropping torn record at the end of {}".format(self.fname))
+            with open(self.fname, 'r+b') as fix_file:
+                fix_file.truncate(offset)
+        self._file_size = offset
+
+    def _apply(self, header, value_offset, value_length, record_length):
+        identifier = header['k']
+        old = self._index.pop(identifier, None)
+        if old:
+            self._live_bytes -= old[2]
+        self._values.pop(identifier, None)
+        if not header.get('del'):
+            self._index[identifier] = (value_offset, value_length, record_length, header.get('x'), header.get('c'))
+            self._live_bytes += record_length
+        self._index_dirty = True
+
+    def _migrate_legacy(self):
+        """Convert a whole-file json cache (the old format) into a log, atomically"""
+        try:
+            with open(self.legacy_fname, 'r') as legacy_file:
+                legacy_diction = json.loads(legacy_file.read())
+        except ValueError:
+            return False
+        if DEBUG:
+            print("Migrating {} to {}".format(self.legacy_fname, self.fname))
+        # the deadline goes in the header now, so nothing has to decode these values to index them later
+        atomic_write(self.fname, (self._encode_record(k, v, expires_at=self._legacy_deadline(v)) for k, v in legacy_diction.items()))
+        return True
+
+    def _legacy_deadline(self, value):
+        if self.legacy_deadline is None:
+            return None
+        try:
+            return self.legacy_deadline(value)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return None # left for whoever reads the value to make sense of
+
+    #### WRITING ####
+    def _encode_record(self, identifier, value, deleted=False, expires_at=None):
+        payload = b"" if deleted else json.dumps(value, separators=(',', ':')).encode('utf-8')
+        header = {'k': identifier}
+        if deleted:
+            header['del'] = 1
+        else:
+            if expires_at is not None:
+                header['x'] = expires_at
+            if self.codec:
+                payload = RECORD_CODECS[self.codec][0](payload)
+                header['c'] = self.codec
+        header['n'] = len(payload)
+        return json.dumps(header).encode('utf-8') + b"\n" + payload + b"\n"
+
+    def _append(self, identifier, value, deleted=False, expires_at=None):
+        self._append_many([(identifier, value, deleted, expires_at)])
+
+    def _append_many(self, entries):
+        """Append (identifier, value, deleted, expires_at) records with one write and one fsync"""
+        records = [self._encode_record(*entry) for entry in entries]
+        with self._lock:
+            self._ensure_loaded()
+            with open(self.fname, 'ab') as log_file:
+                log_file.write(b"".join(records))
+                log_file.flush()
+                os.fsync(log_file.fileno())
+            for (identifier, value, deleted, expires_at), record in zip(entries, records):
+                header_length = record.index(b"\n") + 1
+                offset = self._file_size
+                self._file_size += len(record)
+                self._apply({'k': identifier, 'del': deleted, 'x': expires_at, 'c': self.codec}, offset + header_length,
+                    len(record) - header_length - 1, len(record))
+            self._maybe_compact()
+
+    def put(self, identifier, value, expires_at=None):
+        """Set identifier, recording an epoch deadline for it in the record header"""
+        self._append(identifier, value, expires_at=expires_at)
+
+    def set_many(self, items):
+        """Add several (identifier, value) pairs in a single append"""
+        entries = [(identifier, value, False, None) for identifier, value in items]
+        if entries:
+            self._append_many(entries)
+
+    def delete_many(self, identifiers):
+        """Remove several identifiers in a single append; unknown ones are ignored"""
+        with self._lock:
+            self._ensure_loaded()
+            entries = [(identifier, None, True, None) for identifier in set(identifiers) if identifier in self._index]
+            if entries:
+                self._append_many(entries)
 
+    #### COMPACTION ####
+    def dead_bytes(self):
+        self._ensure_loaded()
+        return self._file_size - self._live_bytes
+
+    def _maybe_compact(self):
+        dead = self.dead_bytes()
+        if self._compacting or dead < COMPACT_MIN_DEAD_BYTES or dead < self._file_size * COMPACT_DEAD_RATIO:
+            return
+        self._compacting = True
+        threading.Thread(target=self.compact, daemon=True).start()
+
+    def compact(self):
+        """Rewrite the log with only the live records (copied as raw bytes, never
+        decoded) and swap it in atomically"""
+        with self._lock:
+            try:
+                self._ensure_loaded()
+                if not os.path.exists(self.fname):
+                    return
+                new_index = {}
+                with open(self.fname, 'rb') as log_file:
+                    def live_records():
+                        new_offset = 0
+                        for identifier, (value_offset, value_length, record_length, expires_at, codec) in self._index.items():
+                            header_length = record_length - value_length - 1
+                            log_file.seek(value_offset - header_length)
+                            record = log_file.read(record_length)
+                            new_index[identifier] = (new_offset + header_length, value_length, record_length, expires_at, codec)
+                            new_offset += record_length
+                            yield record
+                    atomic_write(self.fname, live_records())
+                self._close_mmap()
+                self._index = new_index
+                self._file_size = self._live_bytes = sum(entry[2] for entry in new_index.values())
+                self._index_dirty = True
+                self.flush_index()
+            finally:
+                self._compacting = False
+
+    #### READING ####
+    def _close_mmap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _read_value(self, value_offset, value_length):
+        # the map is fixed-size, so remap when the record was appended after mapping
+        if self._mmap is None or value_offset + value_length > len(self._mmap):
+            self._close_mmap()
+            with open(self.fname, 'rb') as log_file:
+                self._mmap = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap[value_offset:value_offset + value_length]
+
+    #### MAPPING INTERFACE ####
+    def __getitem__(self, identifier):
+        with self._lock:
+            self._ensure_loaded()
+            if identifier in self._values:
+                self._values.move_to_end(identifier)
+                return self._values[identifier]
+            value_offset, value_length, _, _, codec = self._index[identifier]
+            payload = self._read_value(value_offset, value_length)
+            if codec:
+                payload = RECORD_CODECS[codec][1](payload)
+            value = json.loads(payload.decode('utf-8'))
+            self._values[identifier] = value
+            if len(self._values) > STORE_VALUE_MEMO_ENTRIES:
+                self._values.popitem(last=False)
+            return value
+
+    def __setitem__(self, identifier, value):
+        self._append(identifier, value)
+
+    def __delitem__(self, identifier):
+        with self._lock:
+            self._ensure_loaded()
+            if identifier not in self._index:
+                raise KeyError(identifier)
+            self._append(identifier, None, deleted=True)
+
+    def __contains__(self, identifier):
+        self._ensure_loaded()
+        return identifier in self._index
+
+    def __iter__(self):
+        self._ensure_loaded()
+        return iter(list(self._index))
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._index)
+
+    def expires_at(self, identifier):
+        """Epoch deadline stored with identifier (None if it was written without one)"""
+        self._ensure_loaded()
+        return self._index[identifier][3]
+
+    def record_size(self, identifier):
+        self._ensure_loaded()
+        return self._index[identifier][2]
+
+#--------------------------------------------------
+# Expiring, size-bounded cache
+#--------------------------------------------------
+def cache_deadline(entry):
+    """Epoch time at which a cache entry ({'values', 'timestamp', 'expire_in_hrs'...}) goes stale"""
+    if entry.get('expires_at') is not None:
+        return entry['expires_at']
+    # entries written before deadlines were stored: work it out from the timestamp once
+    cache_timestamp = datetime.strptime(entry['timestamp'], DATETIME_FORMAT)
+    return cache_timestamp.timestamp() + entry['expire_in_hrs'] * 3600
+
+class TTLCache(MutableMapping):
+    """Dictionary-like view over a LogCacheStore that expires and evicts entries.
+
+    Each entry's expiry is kept as an epoch deadline (in the store's record header), so a
+    lookup is one float comparison. Deadlines also go in a heap, which lets sweep_expired()
+    drop everything that has gone stale in one append instead of waiting for each key to
+    be asked for again. Past max_entries entries or max_bytes of records the least
+    recently used ones are evicted. hits/misses/expirations/evictions are counted.
+    on_remove(store, identifiers), if given, is called before entries expire, are evicted
+    or are deleted, while their values can still be read."""
+
+    def __init__(self, store, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES, on_remove=None):
+        self.store = store
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.on_remove = on_remove
+        self._lock = threading.RLock()
+        self._deadlines = None # identifier -> epoch deadline, built on first use
+        self._heap = [] # (deadline, identifier); pairs for replaced/removed entries are skipped when popped
+        self._lru = OrderedDict() # identifier -> record bytes, least recently used first
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def _ensure_indexed(self):
+        if self._deadlines is not None:
+            return
+        with self._lock:
+            if self._deadlines is not None:
+                return
+            deadlines = {}
+            for identifier in self.store:
+                deadline = self.store.expires_at(identifier)
+                if deadline is None:
+                    deadline = cache_deadline(self.store[identifier])
+                deadlines[identifier] = deadline
+                self._heap.append((deadline, identifier))
+                self._track_size(identifier)
+            heapq.heapify(self._heap)
+            self._deadlines = deadlines
+
+    def _track_size(self, identifier):
+        size = self.store.record_size(identifier)
+        self._bytes += size - self._lru.pop(identifier, 0)
+        self._lru[identifier] = size
+
+    def _forget(self, identifier):
+        self._deadlines.pop(identifier, None)
+        self._bytes -= self._lru.pop(identifier, 0)
+
+    def _remove(self, identifiers):
+        if self.on_remove is not None:
+            self.on_remove(self.store, identifiers)
+        self.store.delete_many(identifiers)
+
+    #### EXPIRY & EVICTION ####
+    def lookup(self, identifier):
+        """The entry for identifier, or None if it is missing or has expired"""
+        with self._lock:
+            self._ensure_indexed()
+            deadline = self._deadlines.get(identifier)
+            if deadline is None:
+                self.misses += 1
+                count_event("cache.miss")
+                return None
+            if deadline <= time.time() and not CACHE_REPLAY:
+                self.expirations += 1
+                count_event("cache.expired")
+                del self[identifier]
+                return None
+            self.hits += 1
+            count_event("cache.hit")
+            return self[identifier]
+
+    def sweep_expired(self, now=None):
+        """Remove every entry whose deadline has passed; returns how many were removed"""
+        if CACHE_REPLAY:
+            return 0
+        now = time.time() if now is None else now
+        with self._lock:
+            self._ensure_indexed()
+            expired = []
+            while self._heap and self._heap[0][0] <= now:
+                deadline, identifier = heapq.heappop(self._heap)
+                if self._deadlines.get(identifier) == deadline:
+                    expired.append(identifier)
+                    self._forget(identifier)
+            if expired:
+                self._remove(expired)
+                self.expirations += len(expired)
+                count_event("cache.expired", len(expired))
+            return len(expired)
+
+    def _evict(self):
+        victims = []
+        while len(self._lru) > 1 and (len(self._lru) > self.max_entries or self._bytes > self.max_bytes):
+            identifier = next(iter(self._lru))
+            victims.append(identifier)
+            self._forget(identifier)
+        if victims:
+            self._remove(victims)
+            self.evictions += len(victims)
+            count_event("cache.evicted", len(victims))
+        if len(self._heap) > 2 * len(self._deadlines) + 64: # too many skipped pairs: rebuild
+            self._heap = [(deadline, identifier) for identifier, deadline in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def stats(self):
+        with self._lock:
+            self._ensure_indexed()
+            return {
+                'entries': len(self._lru),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'expirations': self.expirations,
+                'evictions': self.evictions
+            }
+
+    #### MAPPING INTERFACE ####
+    def __getitem__(self, identifier):
+        with self._lock:
+            value = self.store[identifier]
+            if self._deadlines is not None and identifier in self._lru:
+                self._lru.move_to_end(identifier)
+            return value
+
+    def __setitem__(self, identifier, value):
+        deadline = cache_deadline(value)
+        with self._lock:
+            self._ensure_indexed()
+            self.sweep_expired()
+            self.store.put(identifier, value, deadline)
+            self._deadlines[identifier] = deadline
+            heapq.heappush(self._heap, (deadline, identifier))
+            self._track_size(identifier)
+            self._evict()
+
+    def __delitem__(self, identifier):
+        with self._lock:
+            self._ensure_indexed()
+            if identifier not in self.store:
+                raise KeyError(identifier)
+            self._remove([identifier])
+            self._forget(identifier)
+
+    def __contains__(self, identifier):
+        return identifier in self.store
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+#--------------------------------------------------
+# Cache stores: data and credentials (opened lazily on first use)
+#--------------------------------------------------
+# tweets migrated from the old cache never went through a pipeline run, so index them all once;
+# pages that expire or are evicted take their tweets out of the index again
+CACHE_DICTION = TTLCache(LogCacheStore(CACHE_LOG_FNAME, legacy_fname=CACHE_FNAME, codec=CACHE_CODEC, legacy_deadline=cache_deadline,
+    on_migrate=lambda store: rebuild_tweet_index(cache=store)), on_remove=lambda store, identifiers: unindex_cached_pages(store, identifiers))
+CREDS_DICTION = TTLCache(LogCacheStore(CREDS_LOG_FNAME, legacy_fname=CREDS_CACHE_FILE, legacy_deadline=cache_deadline))
+
+#---------------------------------------------
+# Cache functions
+#---------------------------------------------
 def get_from_cache(identifier, dictionary):
     """If unique identifier exists in specified cache dictionary and has not expired, 
     return the data associated with it from the request, else return None"""
     identifier = identifier.upper() # Assuming none will differ with case sensitivity here
-    if identifier in dictionary:
-        data_assoc_dict = dictionary[identifier]
-        if has_cache_expired(data_assoc_dict['timestamp'],data_assoc_dict["expire_in_hrs"]):
-            if DEBUG:
-                print("Cache has expired for {}".format(identifier))
-            # also remove old copy from cache
-            del dictionary[identifier]
-            data = None
+    with timed("cache.lookup"):
+        if isinstance(dictionary, TTLCache):
+            data_assoc_dict = dictionary.lookup(identifier)
+            return data_assoc_dict['values'] if data_assoc_dict is not None else None
+        if identifier in dictionary:
+            data_assoc_dict = dictionary[identifier]
+            if cache_deadline(data_assoc_dict) <= time.time() and not CACHE_REPLAY:
+                count_event("cache.expired")
+                # also remove old copy from cache
+                del dictionary[identifier]
+                data = None
+            else:
+                count_event("cache.hit")
+                data = dictionary[identifier]['values']
         else:
-            print("Cache has not epired.")
-            data = dictionary[identifier]['values']
-    else:
-        data = None
+            count_event("cache.miss")
+            data = None
     return data
 
+STATUS_FIELDS = ('id', 'id_str', 'text', 'created_at', 'in_reply_to_screen_name', 'retweet_count')
 
-def set_in_data_cache(identifier, data, expire_in_hrs):
-    """Add identifier and its associated values (literal data) to the data cache dictionary, and save the whole dictionary to a file as json"""
-    identifier = identifier.upper()
-    CACHE_DICTION[identifier] = {
-        'values': data,
-        'timestamp': datetime.now().strftime(DATETIME_FORMAT),
-        'expire_in_hrs': expire_in_hrs
+def project_status(status):
+    """A status cut down to the fields twitter_handler, TweetBatch and pagination read
+    (the full user profile, entity indices, urls, colours etc. are dropped)"""
+    projected = {field: status[field] for field in STATUS_FIELDS if field in status}
+    projected['user'] = {'screen_name': status['user']['screen_name'], 'name': status['user']['name']}
+    entities = status['entities']
+    projected['entities'] = {
+        'user_mentions': [{'screen_name': mention['screen_name']} for mention in entities['user_mentions']],
+        'hashtags': [{'text': hashtag['text']} for hashtag in entities['hashtags']]
     }
+    return projected
 
-    with open(CACHE_FNAME, 'w') as cache_file:
-        cache_json = json.dumps(CACHE_DICTION)
-        cache_file.write(cache_json)
+def project_twitter_data(data):
+    """Project every status in a search response or timeline, keeping the response's shape;
+    anything else (e.g. an error payload) is returned unchanged"""
+    if isinstance(data, list):
+        return [project_status(status) for status in data]
+    if isinstance(data, dict) and 'statuses' in data:
+        return {'statuses': [project_status(status) for status in data['statuses']]}
+    return data
 
-def set_in_creds_cache(identifier, data, expire_in_hrs):
-    """Add identifier and its associated values (literal data) to the credentials cache dictionary, and save the whole dictionary to a file as json"""
-    identifier = identifier.upper() # make unique
-    CREDS_DICTION[identifier] = {
+def _cache_entry(data, expire_in_hrs):
+    now = datetime.now()
+    return {
         'values': data,
-        'timestamp': datetime.now().strftime(DATETIME_FORMAT),
-        'expire_in_hrs': expire_in_hrs
+        'timestamp': now.strftime(DATETIME_FORMAT),
+        'expire_in_hrs': expire_in_hrs,
+        'expires_at': now.timestamp() + expire_in_hrs * 3600
     }
 
-    with open(CREDS_CACHE_FILE, 'w') as cache_file:
-        cache_json = json.dumps(CREDS_DICTION)
-        cache_file.write(cache_json)
+
+def set_in_data_cache(identifier, data, expire_in_hrs):
+    """Add identifier and its associated values (literal data) to the data cache log"""
+    identifier = identifier.upper()
+    if CACHE_FORMAT == "projected":
+        data = project_twitter_data(data)
+    CACHE_DICTION[identifier] = _cache_entry(data, expire_in_hrs) # appends a single record to the cache log
+
+def set_in_creds_cache(identifier, data, expire_in_hrs):
+    """Add identifier and its associated values (literal data) to the credentials cache log"""
+    identifier = identifier.upper() # make unique
+    CREDS_DICTION[identifier] = _cache_entry(data, expire_in_hrs) # appends a single record to the creds log
 
 ##### END CACHE FUNCTIONS ####
 
@@ -127,9 +781,18 @@ CLIENT_KEY = secret_data.client_key
 CLIENT_SECRET = secret_data.client_secret
 
 ### Specific to API URLs, not private -- THESE ARE TWITTER SPECIFIC TO FETCH TOKENS
-REQUEST_TOKEN_URL = "https://api.twitter.com/oauth/request_token"
-BASE_AUTH_URL = "https://api.twitter.com/oauth/authorize"
-ACCESS_TOKEN_URL = "https://api.twitter.com/oauth/access_token"
+TWITTER_API_BASE = "https://api.twitter.com" # --api-base points everything at a stand-in (see SI507F17_fake_twitter.py)
+REQUEST_TOKEN_URL = TWITTER_API_BASE + "/oauth/request_token"
+BASE_AUTH_URL = TWITTER_API_BASE + "/oauth/authorize"
+ACCESS_TOKEN_URL = TWITTER_API_BASE + "/oauth/access_token"
+
+def use_twitter_api_base(api_base):
+    """Send the oauth handshake and the __main__ queries to api_base instead of api.twitter.com"""
+    global TWITTER_API_BASE, REQUEST_TOKEN_URL, BASE_AUTH_URL, ACCESS_TOKEN_URL
+    TWITTER_API_BASE = api_base.rstrip("/")
+    REQUEST_TOKEN_URL = TWITTER_API_BASE + "/oauth/request_token"
+    BASE_AUTH_URL = TWITTER_API_BASE + "/oauth/authorize"
+    ACCESS_TOKEN_URL = TWITTER_API_BASE + "/oauth/access_token"
 
 
 def get_tokens(client_key=CLIENT_KEY, client_secret=CLIENT_SECRET,request_token_url=REQUEST_TOKEN_URL,
@@ -167,15 +830,13 @@ def get_tokens(client_key=CLIENT_KEY, client_secret=CLIENT_SECRET,request_token_
 def get_tokens_from_api(service_name_ident, expire_in_hrs=10): # Default: 1 hr for creds expiration
     creds_data = get_from_cache(service_name_ident, CREDS_DICTION)
     if creds_data:
-        if DEBUG:
-            print("Loading creds from cache...")
-            print()
+        count_event("creds.from_cache")
     else:
         if DEBUG:
             print("Fetching fresh credentials...")
             print("Prepare to log in via browser.")
             print()
-        creds_data = get_tokens()
+        creds_data = get_tokens(request_token_url=REQUEST_TOKEN_URL, base_authorization_url=BASE_AUTH_URL, access_token_url=ACCESS_TOKEN_URL)
         set_in_creds_cache(service_name_ident, creds_data, expire_in_hrs=expire_in_hrs)
     return creds_data
 
@@ -185,35 +846,341 @@ def create_request_identifier(url, params_diction):
     total_ident = url + "?" + params_str
     return total_ident.upper() # Creating the identifier
 
-def get_twitter_data(request_url,service_ident, params_diction, expire_in_hrs=10):
-    """Check in cache first, otherwise fetch it from api and save in cache and then return that data"""
+#### ONE LONG-LIVED OAUTH SESSION PER SERVICE, SO REQUESTS REUSE KEEP-ALIVE CONNECTIONS ####
+HTTP_POOL_CONNECTIONS = 4 # distinct hosts kept in the connection pool
+HTTP_POOL_MAXSIZE = 16 # connections kept open per host
+HTTP_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.5 # sleeps 0.5s, 1s, 2s... between retries
+HTTP_RETRY_STATUSES = (500, 502, 503, 504)
+HTTP_TIMEOUT_SECS = 30
+SESSION_CREDS_RECHECK_SECS = 300 # how often the session looks for new/expired creds
+
+def expire_cached_credentials(service_name_ident):
+    """Drop cached creds so the next get_tokens_from_api call fetches fresh ones"""
+    CREDS_DICTION.pop(service_name_ident.upper(), None)
+
+class TwitterSession(object):
+    """Thread-safe wrapper around a single requests_oauthlib.OAuth1Session.
+
+    The session is built once from the service's credentials and reused for every
+    request, with a pooled HTTPAdapter that retries connection errors and 5xx responses
+    with exponential backoff. It is rebuilt when the cached credentials change (e.g. they
+    expired and were fetched again) or when the API answers 401 Unauthorized."""
+
+    def __init__(self, service_ident, creds_loader=None):
+        self.service_ident = service_ident
+        self._creds_loader = creds_loader or get_tokens_from_api
+        self._lock = threading.Lock()
+        self._session = None
+        self._creds = None
+        self._creds_checked_at = 0
+
+    def _build(self, creds):
+        client_key, client_secret, resource_owner_key, resource_owner_secret = creds[:4]
+        session = requests_oauthlib.OAuth1Session(client_key, client_secret=client_secret, resource_owner_key=resource_owner_key,
+            resource_owner_secret=resource_owner_secret)
+        # once the retries run out the last 5xx is returned, for cache_twitter_response to turn into a TwitterAPIError
+        retry = Retry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR, status_forcelist=HTTP_RETRY_STATUSES,
+            raise_on_status=False)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def session(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._session is None or now - self._creds_checked_at > SESSION_CREDS_RECHECK_SECS:
+                creds = list(self._creds_loader(self.service_ident))
+                self._creds_checked_at = now
+                if self._session is None or creds != self._creds:
+                    if self._session is not None:
+                        self._session.close()
+                    self._session = self._build(creds)
+                    self._creds = creds
+            return self._session
+
+    def invalidate(self):
+        """Forget the session and its credentials; the next request re-authenticates"""
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+            self._creds = None
+        expire_cached_credentials(self.service_ident)
+
+    def get(self, url, params=None):
+        with timed("http.fetch"):
+            resp = self.session().get(url, params=params, timeout=HTTP_TIMEOUT_SECS)
+            if resp.status_code == 401: # token was revoked or expired on twitter's side
+                if DEBUG:
+                    print("Credentials rejected, re-authenticating...")
+                self.invalidate()
+                resp = self.session().get(url, params=params, timeout=HTTP_TIMEOUT_SECS)
+        count_event("http.requests")
+        count_event("http.bytes", len(resp.content))
+        return resp
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+
+_TWITTER_SESSIONS = {}
+_TWITTER_SESSIONS_LOCK = threading.Lock()
+
+def get_twitter_session(service_ident):
+    with _TWITTER_SESSIONS_LOCK:
+        if service_ident not in _TWITTER_SESSIONS:
+            _TWITTER_SESSIONS[service_ident] = TwitterSession(service_ident)
+        return _TWITTER_SESSIONS[service_ident]
+
+class TwitterAPIError(Exception):
+    """The api answered with an error (a 429 rate limit, a 5xx that outlasted the retries...)
+    instead of data. reset_at is the x-rate-limit-reset epoch time, when the response had one"""
+
+    def __init__(self, status_code, errors=None, reset_at=None):
+        self.status_code = status_code
+        self.errors = errors or []
+        self.reset_at = reset_at
+        messages = "; ".join(str(error.get('message', error)) if isinstance(error, dict) else str(error) for error in self.errors)
+        super().__init__("Twitter api error {}{}".format(status_code, ": " + messages if messages else ""))
+
+    @classmethod
+    def from_response(cls, resp, data=None):
+        if data is None:
+            try:
+                data = json.loads(resp.text)
+            except ValueError:
+                pass
+        reset_at = resp.headers.get('x-rate-limit-reset')
+        return cls(resp.status_code, twitter_errors(data), float(reset_at) if reset_at is not None else None)
+
+def twitter_errors(data):
+    """The error list of an api error payload ({"errors": [...]}), or None for real data"""
+    if isinstance(data, dict) and 'errors' in data and 'statuses' not in data:
+        return data['errors']
+    return None
+
+def cache_twitter_response(ident, resp, expire_in_hrs=10):
+    """Parse a response and save it in the cache. Only a 200 carrying data is cached;
+    anything else (429, 5xx, an error payload) raises TwitterAPIError"""
+    if resp.status_code != 200:
+        raise TwitterAPIError.from_response(resp)
+    data = json.loads(resp.text)
+    if twitter_errors(data) is not None:
+        raise TwitterAPIError.from_response(resp, data)
+    set_in_data_cache(ident, data, expire_in_hrs)
+    return data
+
+def fetch_and_cache_twitter_data(ident, request_url, service_ident, params_diction, expire_in_hrs=10, budget=None, stop=None):
+    """Fetch from the api (no cache lookup), save the parsed json in the cache and return (data, response).
+    With a RateLimitBudget the request waits for room in the endpoint's window and a 429 is
+    waited out and retried; setting the stop Event abandons that wait and returns (None, None)"""
+    # Reuse the service's long-lived oauth session (built from get_tokens_from_api creds)
+    # Work of encoding and "signing" the request happens behind the sences, thanks to the OAuth1Session inside it
+    session = get_twitter_session(service_ident)
+    while True:
+        if budget is not None and not budget.acquire_blocking(stop):
+            return None, None
+        resp = session.get(request_url,params=params_diction)
+        if budget is None:
+            break
+        budget.update(resp)
+        if resp.status_code != 429:
+            break
+    # Get the string data and set it in the cache for next time
+    data = cache_twitter_response(ident, resp, expire_in_hrs)
+    return data, resp
+
+def get_twitter_data(request_url,service_ident, params_diction, expire_in_hrs=10, budget=None, stop=None, refresh=False):
+    """Check in cache first, otherwise fetch it from api and save in cache and then return that data.
+    With refresh the cache isn't checked (the fresh response still replaces the cached one).
+    Raises TwitterAPIError when the api answers with an error instead of data"""
     ident = create_request_identifier(request_url, params_diction)
-    data = get_from_cache(ident,CACHE_DICTION)
-    if data:
-        if DEBUG:
-            print("Loading from data cache: {}... data".format(ident))
+    data = None if refresh else get_from_cache(ident,CACHE_DICTION)
+    if data and twitter_errors(data) is None: # error payloads cached by older versions don't count
+        count_event("fetch.from_cache")
     else:
-        if DEBUG:
-            print("Fetching new data from {}".format(request_url))
-        # Get credentials
-        client_key, client_secret, resource_owner_key, resource_owner_secret, verifier = get_tokens_from_api(service_ident)
-        # Create a new instance of oauth to make a request with
-        oauth_inst = requests_oauthlib.OAuth1Session(client_key, client_secret=client_secret,resource_owner_key=resource_owner_key,
-        	resource_owner_secret=resource_owner_secret)
-        # Call the get method on oauth instance
-        # Work of encoding and "signing" the request happens behind the sences, thanks to the OAuth1Session instance in oauth_inst
-        resp = oauth_inst.get(request_url,params=params_diction)
-        # Get the string data and set it in the cache for next time
-        string_of_response = resp.text
-        data = json.loads(string_of_response)
-        set_in_data_cache(ident, data, expire_in_hrs)
+        count_event("fetch.from_api")
+        data, _ = fetch_and_cache_twitter_data(ident, request_url, service_ident, params_diction, expire_in_hrs, budget, stop)
     return data
+
+#### PAGINATED FETCHING: FOLLOW max_id BACK THROUGH THE RESULTS, ONE CACHED REQUEST PER PAGE ####
+TWITTER_MAX_PAGES = 10 # default cap on pages fetched per query
+
+def page_statuses(data):
+    """Pull the list of statuses out of a response: search wraps them in a dict, timelines don't"""
+    if isinstance(data, dict):
+        return data.get('statuses', [])
+    return data or []
+
+def iter_twitter_pages(request_url, service_ident, params_diction, max_pages=TWITTER_MAX_PAGES, expire_in_hrs=10,
+    budget=None, stop=None, refresh_head=False):
+    """Generator of pages (lists of statuses), newest first. After each page the max_id
+    cursor is moved below the oldest id seen; a since_id in params_diction is passed
+    through and bounds the walk. Every page goes through get_twitter_data, so it is
+    cached under its own identifier and a partial run resumes from the cache. An error
+    from the api (e.g. a 429 part way through) raises TwitterAPIError rather than
+    ending the walk early. budget and stop are passed on to fetch_and_cache_twitter_data.
+    refresh_head fetches the first (newest) page from the api even when it is cached, for
+    walks that are after whatever has arrived since the last one."""
+    params = dict(params_diction)
+    pages = 0
+    while max_pages is None or pages < max_pages:
+        statuses = page_statuses(get_twitter_data(request_url, service_ident, params, expire_in_hrs, budget, stop,
+            refresh=refresh_head and pages == 0))
+        pages += 1
+        if not statuses:
+            return
+        yield statuses
+        next_max_id = min(int(status['id_str']) for status in statuses) - 1
+        if 'max_id' in params and next_max_id >= int(params['max_id']):
+            return # the cursor didn't move, so there's nothing older to ask for
+        if 'since_id' in params and next_max_id <= int(params['since_id']):
+            return
+        params['max_id'] = next_max_id
+
+def iter_twitter_data(request_url, service_ident, params_diction, max_pages=TWITTER_MAX_PAGES, expire_in_hrs=10):
+    """Generator of individual tweets across pages, yielded as each page arrives"""
+    for statuses in iter_twitter_pages(request_url, service_ident, params_diction, max_pages, expire_in_hrs):
+        for status in statuses:
+            yield status
+
+#### CONCURRENT FETCHING: MANY QUERIES AT ONCE, WITHIN EACH ENDPOINT'S RATE LIMIT ####
+FETCH_MAX_CONCURRENCY = 8 # requests in flight at once
+RATE_LIMIT_MIN_BACKOFF_SECS = 1 # wait after a 429 that doesn't say when its window resets, doubled each time
+RATE_LIMIT_MAX_BACKOFF_SECS = 60
+
+class RateLimitBudget(object):
+    """Requests left for one endpoint in the current rate-limit window, as reported by
+    twitter's x-rate-limit-remaining / x-rate-limit-reset (epoch seconds) headers. A 429
+    without a usable reset time backs off exponentially instead of retrying at once.
+    Shared by the async fetcher and the pipeline's fetch threads, so it is locked."""
+
+    def __init__(self):
+        self.remaining = None # unknown until the first response
+        self.reset_at = 0
+        self.backoff = RATE_LIMIT_MIN_BACKOFF_SECS
+        self._lock = threading.Lock()
+
+    def _take(self):
+        # spend one request: 0 if it can go now, otherwise the seconds until the window resets
+        with self._lock:
+            if self.remaining is not None and self.remaining <= 0:
+                wait = self.reset_at - time.time()
+                if wait > 0:
+                    if DEBUG:
+                        print("Rate limit reached, waiting {:.1f}s for the window to reset".format(wait))
+                    return wait
+                self.remaining = None # new window; the next response tells us its size
+            if self.remaining is not None:
+                self.remaining -= 1
+            return 0
+
+    async def acquire(self):
+        wait = self._take()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self._take()
+
+    def acquire_blocking(self, stop=None):
+        """acquire() for threads; returns False if the stop Event is set while waiting"""
+        wait = self._take()
+        while wait:
+            if stop is None:
+                time.sleep(wait)
+            elif stop.wait(wait):
+                return False
+            wait = self._take()
+        return True
+
+    def update(self, resp):
+        with self._lock:
+            remaining = resp.headers.get('x-rate-limit-remaining')
+            reset_at = resp.headers.get('x-rate-limit-reset')
+            if reset_at is not None and float(reset_at) != self.reset_at:
+                self.reset_at = float(reset_at)
+                self.remaining = None # a new window, so the header's count wins
+            if remaining is not None:
+                # responses can come back out of order, so never raise the count within a window
+                remaining = int(remaining)
+                self.remaining = remaining if self.remaining is None else min(self.remaining, remaining)
+            if resp.status_code == 429:
+                self.remaining = 0
+                now = time.time()
+                if self.reset_at <= now:
+                    self.reset_at = now + self.backoff
+                    self.backoff = min(self.backoff * 2, RATE_LIMIT_MAX_BACKOFF_SECS)
+            else:
+                self.backoff = RATE_LIMIT_MIN_BACKOFF_SECS
+
+RATE_LIMIT_BUDGETS = {} # request_url -> RateLimitBudget, kept across runs
+
+async def _fetch_one(loop, executor, semaphore, request_url, service_ident, params_diction, expire_in_hrs):
+    ident = create_request_identifier(request_url, params_diction)
+    data = get_from_cache(ident, CACHE_DICTION)
+    if data and twitter_errors(data) is None: # as in get_twitter_data, cached error payloads are fetched again
+        return data
+    budget = RATE_LIMIT_BUDGETS.setdefault(request_url, RateLimitBudget())
+    async with semaphore:
+        while True:
+            await budget.acquire()
+            session = get_twitter_session(service_ident)
+            resp = await loop.run_in_executor(executor, session.get, request_url, params_diction)
+            budget.update(resp)
+            if resp.status_code != 429:
+                break
+    # parsing and the cache write (an fsync'd append) stay off the event loop
+    return await loop.run_in_executor(executor, cache_twitter_response, ident, resp, expire_in_hrs)
+
+async def fetch_many_twitter_data_async(queries, service_ident, max_concurrency=FETCH_MAX_CONCURRENCY, expire_in_hrs=10):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        return await asyncio.gather(*[_fetch_one(loop, executor, semaphore, request_url, service_ident, params_diction, expire_in_hrs)
+            for request_url, params_diction in queries])
+
+def fetch_many_twitter_data(queries, service_ident, max_concurrency=FETCH_MAX_CONCURRENCY, expire_in_hrs=10):
+    """Run several get_twitter_data-style queries ((request_url, params_diction) pairs)
+    concurrently. Cached queries are answered from the cache; the rest run at most
+    max_concurrency at a time and wait out an endpoint's window once its budget is spent.
+    Returns the responses in the order of queries."""
+    return asyncio.run(fetch_many_twitter_data_async(queries, service_ident, max_concurrency, expire_in_hrs))
+
 #### END CODE TO FETCH DATA/TOKENS FROM API OR CACHE ####
 
 #### BEGIN CODE TO DEFINE CLASS TO PROCESS DATA FETCHED FROM TWITTER ####
 
+#### created_at ("Thu Dec 14 19:57:46 +0000 2017") AS EPOCH SECONDS ####
+TWITTER_TIME_FORMAT = "%a %b %d %H:%M:%S %z %Y"
+_MONTHS = {month: i for i, month in enumerate(calendar.month_abbr) if month}
+
+@functools.lru_cache(maxsize=4096)
+def _created_at_day(month_day_year):
+	# "Dec 14 2017" -> epoch seconds at midnight UTC; tweets share a handful of days
+	month, day, year = month_day_year.split()
+	return calendar.timegm((int(year), _MONTHS[month], int(day), 0, 0, 0))
+
+def parse_created_at(created_at):
+	"""Epoch seconds (UTC) of a tweet's created_at. The fields sit at fixed offsets, so
+	this slices them out instead of calling strptime, and the date part is cached"""
+	try:
+		if len(created_at) != 30 or created_at[20] not in '+-':
+			raise ValueError(created_at)
+		offset = int(created_at[21:23]) * 3600 + int(created_at[23:25]) * 60
+		return (_created_at_day(created_at[4:10] + created_at[25:]) + int(created_at[11:13]) * 3600
+			+ int(created_at[14:16]) * 60 + int(created_at[17:19]) - (offset if created_at[20] == '+' else -offset))
+	except (ValueError, KeyError):
+		return int(datetime.strptime(created_at, TWITTER_TIME_FORMAT).timestamp())
+
 ### CLASS TO TRANSFORM TWITTER RESULTS INTO OBJECT FOR EASE OF MIGRATION TO SQL ###
 class twitter_handler(object):
+	# __slots__ instead of a per-instance __dict__; handlers are built once per tweet
+	__slots__ = ('text', 'tweet_id', 'mentions', 'in_reply_to_screen_name', 'user_screen_name',
+		'user_name', 'retweet_count', 'hashtags', 'timestamp_UTC', 'created_at')
+
 	def __init__(self, dict_object):
 		self.text = dict_object['text']
 		self.tweet_id = dict_object['id_str']
@@ -224,29 +1191,17 @@ class twitter_handler(object):
 		self.retweet_count = dict_object['retweet_count']
 		self.hashtags = [x for x in dict_object['entities']['hashtags']]
 		self.timestamp_UTC = dict_object['created_at']
+		self.created_at = parse_created_at(self.timestamp_UTC) # epoch seconds
 
 ### UTILIZE TEXTBLOB TO GET SENTIMENT SCORE ###
 	def get_sentiment_score(self):
-		# leverage textblob.TextBlob PatternAnalyzer approach
+		# thin wrapper over score_sentiments for a single tweet
 		# function should return a dict of Sentiment(polarity, classification)
-		blob = TextBlob(self.text)
-
+		sentiments = score_sentiments([self])
 		sentiment_resp = {}
-		sentiment_resp['score'] = blob.sentiment.polarity
-		sentiment_resp['subjectivity'] = blob.sentiment.subjectivity
-		#if 
-		if sentiment_resp['score'] >= 0.5:
-			sentiment_resp['classification'] = "Very Positive"
-		elif sentiment_resp['score'] > 0 and sentiment_resp['score'] < 0.5:
-			sentiment_resp['classification'] = "Positive"
-		elif sentiment_resp['score'] <= -0.5:
-			sentiment_resp['classification'] = "Very Negative"
-		elif sentiment_resp['score'] < 0 and sentiment_resp['score'] > -0.5:
-			sentiment_resp['classification'] = "Negative"
-		elif sentiment_resp['score'] == 0:
-			sentiment_resp['classification'] = "Neutral"
-		#sentiment_resp['classification'] = classification
-
+		sentiment_resp['score'] = sentiments['score'][0]
+		sentiment_resp['subjectivity'] = sentiments['subjectivity'][0]
+		sentiment_resp['classification'] = sentiments['classification'][0]
 		return sentiment_resp
 
 	def __contains__(self, input_str):
@@ -261,21 +1216,583 @@ class twitter_handler(object):
 	def __str__(self):
 		return 'This is a tweet with ID: {}'.format(self.tweet_id)
 
+#### BATCH SENTIMENT SCORING ####
+#### EACH DISTINCT TEXT GOES THROUGH TEXTBLOB ONCE; BIG BATCHES ARE SPREAD OVER A PROCESS POOL ####
+SENTIMENT_POOL_MIN_BATCH = 500 # batches with fewer distinct texts are scored in this process
+SENTIMENT_WORKERS = None # process pool size, None = one per core
+SENTIMENT_CHUNKSIZE = 64 # texts handed to a worker at a time
+SENTIMENT_CACHE_FNAME = "sentiment_cache.log"
+SENTIMENT_CACHE_MAX_ENTRIES = 100000
+
+def classify_sentiment(score):
+	if score >= 0.5:
+		return "Very Positive"
+	elif score > 0 and score < 0.5:
+		return "Positive"
+	elif score <= -0.5:
+		return "Very Negative"
+	elif score < 0 and score > -0.5:
+		return "Negative"
+	elif score == 0:
+		return "Neutral"
+
+def _tweet_text(tweet):
+	# accepts a twitter_handler, a raw status dict or the text itself
+	if isinstance(tweet, twitter_handler):
+		return tweet.text
+	if isinstance(tweet, dict):
+		return tweet['text']
+	return tweet
+
+def _score_text(text):
+	# leverage textblob.TextBlob PatternAnalyzer approach, reading blob.sentiment once
+	sentiment = TextBlob(text).sentiment
+	return sentiment.polarity, sentiment.subjectivity
+
+def normalize_tweet_text(text):
+	# runs of whitespace don't change TextBlob's result, so they shouldn't change the key either
+	return " ".join(text.split())
+
+def sentiment_cache_key(text):
+	return hashlib.sha1(normalize_tweet_text(text).encode('utf-8')).hexdigest()
+
+class SentimentCache(object):
+	"""Persistent, content-addressed cache of (score, subjectivity) pairs.
+
+	Keys are hashes of the normalized tweet text, so every retweet of the same status
+	shares one entry. Entries live in an append-only log next to the data cache and an
+	LRU order caps the cache at max_entries; the oldest are evicted first. Only the keys
+	are read at startup (from the log's index); each value is decoded from the log when it
+	is looked up. Entries hit since the last write are appended again with the next write
+	(or at exit), so the log's record order is the LRU order the next run starts from."""
+
+	def __init__(self, fname, max_entries=SENTIMENT_CACHE_MAX_ENTRIES):
+		self.store = LogCacheStore(fname)
+		self.max_entries = max_entries
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._lru = None # key -> None, least recently used first
+		self._touched = {} # key -> value for entries hit since the last write
+		self._lock = threading.RLock()
+
+	def _ensure_loaded(self):
+		if self._lru is None:
+			# the store's index lists keys in the order their latest records were written
+			self._lru = OrderedDict.fromkeys(self.store)
+			atexit.register(self.flush)
+
+	def get_many(self, keys):
+		"""Return a dict of key -> (score, subjectivity) for the keys that are cached"""
+		found = {}
+		with self._lock:
+			self._ensure_loaded()
+			for key in keys:
+				if key in self._lru:
+					self._lru.move_to_end(key)
+					found[key] = self._touched[key] = tuple(self.store[key])
+					self.hits += 1
+				else:
+					self.misses += 1
+		return found
+
+	def put_many(self, items):
+		"""Add key -> (score, subjectivity) pairs, evicting least recently used entries"""
+		with self._lock:
+			self._ensure_loaded()
+			for key, value in items.items():
+				self._touched[key] = tuple(value)
+				self._lru[key] = None
+				self._lru.move_to_end(key)
+			evicted = []
+			while len(self._lru) > self.max_entries:
+				evicted.append(self._lru.popitem(last=False)[0])
+			self.evictions += len(evicted)
+			self._write()
+			self.store.delete_many(evicted)
+
+	def _write(self):
+		# append everything touched in LRU order, oldest first, so the log ends up in LRU order too;
+		# each touched key was moved to the end, so they are all in the tail
+		tail = itertools.islice(reversed(self._lru), len(self._touched))
+		touched = [key for key in tail if key in self._touched][::-1]
+		if touched:
+			self.store.set_many((key, list(self._touched[key])) for key in touched)
+		self._touched = {}
+
+	def flush(self):
+		"""Write out the recency of entries hit since the last write"""
+		with self._lock:
+			if self._lru is not None and self._touched and os.path.isdir(os.path.dirname(os.path.abspath(self.store.fname))):
+				self._write()
+
+	def stats(self):
+		return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+			'entries': len(self._lru) if self._lru is not None else len(self.store)}
+
+	def __len__(self):
+		with self._lock:
+			self._ensure_loaded()
+			return len(self._lru)
+
+SENTIMENT_CACHE = SentimentCache(SENTIMENT_CACHE_FNAME)
+
+_SENTIMENT_POOLS = {} # workers -> ProcessPoolExecutor, kept for the rest of the run
+_SENTIMENT_POOLS_LOCK = threading.Lock()
+
+def get_sentiment_pool(workers=SENTIMENT_WORKERS):
+	"""The process pool big batches are scored on. It is started the first time a batch
+	needs it and reused after that, so process startup and the TextBlob import are paid
+	once per run rather than once per batch; it is shut down at exit"""
+	with _SENTIMENT_POOLS_LOCK:
+		if workers not in _SENTIMENT_POOLS:
+			if not _SENTIMENT_POOLS:
+				atexit.register(shutdown_sentiment_pools)
+			# workers come from a clean server process, not forked from whichever thread asked first
+			methods = multiprocessing.get_all_start_methods()
+			context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else None)
+			_SENTIMENT_POOLS[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+		return _SENTIMENT_POOLS[workers]
+
+def shutdown_sentiment_pools():
+	with _SENTIMENT_POOLS_LOCK:
+		for pool in _SENTIMENT_POOLS.values():
+			pool.shutdown()
+		_SENTIMENT_POOLS.clear()
+
+def score_sentiments(tweets, workers=SENTIMENT_WORKERS, cache=None):
+	"""Score a batch of tweets (handlers, status dicts or strings) and return a dict of
+	parallel 'score', 'subjectivity' and 'classification' lists, in input order.
+	Texts already in the sentiment cache (SENTIMENT_CACHE by default) are not re-analysed.
+	Batches of at least SENTIMENT_POOL_MIN_BATCH uncached texts go to the shared
+	get_sentiment_pool(workers)"""
+	if cache is None:
+		cache = SENTIMENT_CACHE
+	with timed("sentiment.score"):
+		return _score_sentiments(tweets, workers, cache)
+
+def _score_sentiments(tweets, workers, cache):
+	texts = [_tweet_text(tweet) for tweet in tweets]
+	keys = [sentiment_cache_key(text) for text in texts]
+	by_key = cache.get_many(set(keys))
+
+	pending = {} # key -> text, one per distinct uncached text
+	for key, text in zip(keys, texts):
+		if key not in by_key:
+			pending.setdefault(key, text)
+	if pending:
+		pending_keys = list(pending)
+		pending_texts = [pending[key] for key in pending_keys]
+		if len(pending_texts) >= SENTIMENT_POOL_MIN_BATCH and workers != 1:
+			results = list(get_sentiment_pool(workers).map(_score_text, pending_texts, chunksize=SENTIMENT_CHUNKSIZE))
+		else:
+			results = [_score_text(text) for text in pending_texts]
+		scored = dict(zip(pending_keys, results))
+		count_event("sentiment.analysed", len(scored))
+		cache.put_many(scored)
+		by_key.update(scored)
+
+	count_event("sentiment.texts", len(texts))
+	sentiments = {'score': [], 'subjectivity': [], 'classification': []}
+	for key in keys:
+		score, subjectivity = by_key[key]
+		sentiments['score'].append(score)
+		sentiments['subjectivity'].append(subjectivity)
+		sentiments['classification'].append(classify_sentiment(score))
+	return sentiments
+
+#### COLUMNAR BATCH OF TWEETS: ONE PASS OVER A RESPONSE, PARALLEL ARRAYS INSTEAD OF OBJECTS ####
+class TweetBatch(object):
+	"""The twitter_handler fields of many tweets, stored column by column.
+
+	Built in a single pass over a list of statuses without keeping the raw status dicts
+	alive. Numbers live in typed arrays, repeated user names are interned, and each tweet's
+	mentions/hashtags are slices of one flat list (mention_offsets[i]:mention_offsets[i + 1]).
+	score() fills the sentiment columns, after which the batch feeds the bulk loaders."""
+
+	__slots__ = ('ids', 'texts', 'in_reply_to', 'retweet_counts', 'screen_names', 'user_names',
+		'created_at', 'mentions', 'mention_offsets', 'hashtags', 'hashtag_offsets',
+		'scores', 'subjectivities', 'classifications')
+
+	def __init__(self):
+		self.ids = array('q')
+		self.texts = []
+		self.in_reply_to = []
+		self.retweet_counts = array('q')
+		self.screen_names = []
+		self.user_names = []
+		self.created_at = array('q') # epoch seconds
+		self.mentions = []
+		self.mention_offsets = array('q', [0])
+		self.hashtags = []
+		self.hashtag_offsets = array('q', [0])
+		self.scores = array('d')
+		self.subjectivities = array('d')
+		self.classifications = []
+
+	@classmethod
+	def from_statuses(cls, statuses):
+		batch = cls()
+		batch.extend(statuses)
+		return batch
+
+	def extend(self, statuses):
+		for status in statuses:
+			entities = status['entities']
+			user = status['user']
+			self.ids.append(int(status['id_str']))
+			self.texts.append(status['text'])
+			reply_to = status['in_reply_to_screen_name']
+			self.in_reply_to.append(sys.intern(reply_to) if reply_to else reply_to)
+			self.retweet_counts.append(status['retweet_count'])
+			self.screen_names.append(sys.intern(user['screen_name']))
+			self.user_names.append(sys.intern(user['name']))
+			self.created_at.append(parse_created_at(status['created_at']))
+			self.mentions.extend(sys.intern(mention['screen_name']) for mention in entities['user_mentions'])
+			self.mention_offsets.append(len(self.mentions))
+			self.hashtags.extend(sys.intern(hashtag['text']) for hashtag in entities['hashtags'])
+			self.hashtag_offsets.append(len(self.hashtags))
+		return self
+
+	def __len__(self):
+		return len(self.ids)
+
+	def mentions_of(self, i):
+		return self.mentions[self.mention_offsets[i]:self.mention_offsets[i + 1]]
+
+	def hashtags_of(self, i):
+		return self.hashtags[self.hashtag_offsets[i]:self.hashtag_offsets[i + 1]]
+
+	def is_scored(self):
+		return len(self.scores) == len(self.ids)
+
+	def score(self, workers=SENTIMENT_WORKERS, cache=None):
+		"""Fill the sentiment columns for tweets not scored yet (see score_sentiments)"""
+		start = len(self.scores)
+		if start < len(self.ids):
+			sentiments = score_sentiments(self.texts[start:], workers=workers, cache=cache)
+			self.scores.extend(sentiments['score'])
+			self.subjectivities.extend(sentiments['subjectivity'])
+			self.classifications.extend(sentiments['classification'])
+		return self
+
+	def tweet_rows(self):
+		"""Rows for the tweets table, first occurrence of each id only"""
+		self.score()
+		seen = set()
+		for i, tweet_id in enumerate(self.ids):
+			if tweet_id in seen:
+				continue
+			seen.add(tweet_id)
+			yield (str(tweet_id), self.texts[i], self.in_reply_to[i], self.scores[i], self.classifications[i],
+				self.retweet_counts[i], self.screen_names[i], self.user_names[i], self.created_at[i])
+
+	def mention_rows(self):
+		"""(parent_tweet_id, user_screen_name) rows for the trump_mentions table"""
+		for i, tweet_id in enumerate(self.ids):
+			for mention in self.mentions_of(i):
+				yield (str(tweet_id), mention)
+
+def as_tweet_batch(tweets):
+	# the loaders accept either a TweetBatch or a list of raw statuses
+	if isinstance(tweets, TweetBatch):
+		return tweets
+	return TweetBatch.from_statuses(tweets)
+
+class MentionGraph(object):
+	"""Who-mentions-whom index over tweets, built in one pass.
+
+	tweet_mentions maps each tweet id to the distinct screen names it mentions and
+	mentioned_in maps a screen name back to those tweet ids; counts holds each user's
+	mention count and pair_counts how often two users are mentioned in the same tweet
+	(keyed by the alphabetically ordered pair). A tweet id seen twice is only counted once."""
+
+	def __init__(self):
+		self.tweet_mentions = {} # tweet id -> tuple of screen names
+		self.mentioned_in = {} # screen name -> [tweet id, ...]
+		self.counts = Counter()
+		self.pair_counts = Counter()
+
+	@classmethod
+	def from_batch(cls, batch):
+		graph = cls()
+		graph.add_batch(batch)
+		return graph
+
+	def add_batch(self, batch):
+		batch = as_tweet_batch(batch)
+		for i, tweet_id in enumerate(batch.ids):
+			if tweet_id in self.tweet_mentions:
+				continue
+			users = tuple(sorted(set(batch.mentions_of(i))))
+			self.tweet_mentions[tweet_id] = users
+			for user in users:
+				self.mentioned_in.setdefault(user, []).append(tweet_id)
+			self.counts.update(users)
+			if len(users) > 1:
+				self.pair_counts.update(itertools.combinations(users, 2))
+		return self
+
+	def __len__(self):
+		return len(self.tweet_mentions)
+
+	def top_mentioned(self, k=10):
+		"""[(screen name, mention count)] for the k most mentioned users, ties by name"""
+		return heapq.nsmallest(k, self.counts.items(), key=lambda item: (-item[1], item[0]))
+
+	def co_mentioned(self, screen_name, k=10):
+		"""[(screen name, shared tweets)] for the users most often mentioned alongside screen_name"""
+		partners = Counter()
+		for tweet_id in self.mentioned_in.get(screen_name, ()):
+			partners.update(self.tweet_mentions[tweet_id])
+		del partners[screen_name]
+		return heapq.nsmallest(k, partners.items(), key=lambda item: (-item[1], item[0]))
+
+	def top_pairs(self, k=10):
+		"""[((screen name, screen name), shared tweets)] for the k most frequent co-mentions"""
+		return heapq.nsmallest(k, self.pair_counts.items(), key=lambda item: (-item[1], item[0]))
+
+	def rows(self, tweet_ids=None):
+		"""(parent_tweet_id, user_screen_name) rows for the trump_mentions table, for every
+		tweet or just the tweet_ids given"""
+		if tweet_ids is None:
+			tweet_ids = self.tweet_mentions
+		for tweet_id in tweet_ids:
+			for user in self.tweet_mentions.get(tweet_id, ()):
+				yield (str(tweet_id), user)
+
+def as_mention_graph(tweets):
+	# a MentionGraph, a TweetBatch or a list of raw statuses
+	if isinstance(tweets, MentionGraph):
+		return tweets
+	return MentionGraph.from_batch(tweets)
+
+#### INVERTED INDEX: WORDS, #HASHTAGS AND @MENTIONS -> SORTED ARRAYS OF TWEET IDS ####
+_URL_RE = re.compile(r"https?://\S+")
+_TERM_RE = re.compile(r"[#@]?\w+")
+
+def normalize_term(term):
+	return term.strip().lower()
+
+def tweet_terms(text, hashtags=(), mentions=()):
+	"""The index terms of one tweet: its lowercased words (links left out) plus "#tag" and
+	"@screen_name" for its hashtag and mention entities"""
+	terms = set(word for word in _TERM_RE.findall(_URL_RE.sub(" ", text.lower())) if word[0] not in "#@")
+	terms.update("#" + hashtag.lower() for hashtag in hashtags)
+	terms.update("@" + mention.lower() for mention in mentions)
+	return terms
+
+class TweetIndex(object):
+	"""Term -> tweet id index, built up from the TweetBatch of each page a run parses.
+
+	Each posting list is a sorted int64 NumPy array. Ids added since the last query wait in
+	a per-term list and are merged in when that term is next looked up, so adding a page is
+	a few dict appends. AND queries intersect from the shortest list with binary searches,
+	OR queries are sorted unions. The index loads lazily from fname and is saved back at
+	exit (or by save()) as delta-encoded ids, zlib-compressed.
+
+	It covers the tweets on cached pages: CACHE_DICTION calls unindex_cached_pages when a
+	page expires or is evicted. A tweet that is also on another page still in the cache
+	drops out with it, and comes back when a run next reads that page."""
+
+	VERSION = 1
+
+	def __init__(self, fname=None):
+		self.fname = fname
+		self._lock = threading.RLock()
+		self._postings = {} # term -> sorted unique np.int64 array
+		self._pending = {} # term -> [tweet id, ...] not merged yet
+		self._loaded = fname is None
+		self._dirty = False
+
+	#### LOADING & SAVING ####
+	def _ensure_loaded(self):
+		if self._loaded:
+			return
+		with self._lock:
+			if self._loaded:
+				return
+			self._load()
+			self._loaded = True
+			atexit.register(self.save)
+
+	def _load(self):
+		try:
+			with open(self.fname, 'rb') as index_file:
+				header = json.loads(index_file.readline().decode('utf-8'))
+				payload = index_file.read()
+		except (OSError, ValueError):
+			return
+		if header.get('version') != self.VERSION:
+			return
+		deltas = np.frombuffer(zlib.decompress(payload), dtype=np.int64)
+		ends = np.cumsum(header['lengths'])
+		for term, start, end in zip(header['terms'], ends - header['lengths'], ends):
+			self._postings[term] = np.cumsum(deltas[start:end])
+
+	def save(self):
+		"""Write the index to fname (atomically) if anything was added since it was loaded"""
+		with self._lock:
+			if not self._dirty or not self.fname or not os.path.isdir(os.path.dirname(os.path.abspath(self.fname))):
+				return
+			self._merge_all()
+			terms = sorted(self._postings)
+			postings = [self._postings[term] for term in terms]
+			lengths = np.array([len(ids) for ids in postings], dtype=np.int64)
+			ids = np.concatenate(postings) if postings else np.empty(0, dtype=np.int64)
+			deltas = np.concatenate((ids[:1], np.diff(ids)))
+			starts = np.cumsum(lengths) - lengths
+			deltas[starts] = ids[starts] # each list restarts from its first id
+			header = {'version': self.VERSION, 'terms': terms, 'lengths': lengths.tolist()}
+			atomic_write(self.fname, [json.dumps(header).encode('utf-8') + b"\n", zlib.compress(deltas.tobytes())])
+			self._dirty = False
+
+	#### ADDING ####
+	def add(self, tweet_id, text, hashtags=(), mentions=()):
+		with self._lock:
+			self._ensure_loaded()
+			for term in tweet_terms(text, hashtags, mentions):
+				self._pending.setdefault(term, []).append(tweet_id)
+			self._dirty = True
+
+	def add_batch(self, batch):
+		batch = as_tweet_batch(batch)
+		with self._lock:
+			self._ensure_loaded()
+			pending = self._pending
+			for i, tweet_id in enumerate(batch.ids):
+				for term in tweet_terms(batch.texts[i], batch.hashtags_of(i), batch.mentions_of(i)):
+					ids = pending.get(term)
+					if ids is None:
+						pending[term] = ids = []
+					ids.append(tweet_id)
+			self._dirty = True
+		return self
+
+	#### REMOVING ####
+	def remove_ids(self, tweet_ids):
+		"""Drop tweet_ids from every posting list; terms left with no tweets are dropped too"""
+		tweet_ids = np.unique(np.asarray(tweet_ids, dtype=np.int64))
+		if not len(tweet_ids):
+			return self
+		with self._lock:
+			self._ensure_loaded()
+			self._merge_all()
+			for term, ids in list(self._postings.items()):
+				kept = ids[~np.isin(ids, tweet_ids, assume_unique=True)]
+				if len(kept) == len(ids):
+					continue
+				if len(kept):
+					self._postings[term] = kept
+				else:
+					del self._postings[term]
+				self._dirty = True
+		return self
+
+	def _merge(self, term):
+		pending = self._pending.pop(term, None)
+		if pending:
+			merged = np.array(pending, dtype=np.int64)
+			if term in self._postings:
+				merged = np.concatenate([self._postings[term], merged])
+			self._postings[term] = np.unique(merged)
+		return self._postings.get(term)
+
+	def _merge_all(self):
+		for term in list(self._pending):
+			self._merge(term)
+
+	#### QUERIES ####
+	def postings(self, term):
+		"""Sorted array of the ids of tweets containing term (a word, "#tag" or "@user")"""
+		with self._lock:
+			self._ensure_loaded()
+			ids = self._merge(normalize_term(term))
+			return ids if ids is not None else np.empty(0, dtype=np.int64)
+
+	def find_all(self, *terms):
+		"""Ids of the tweets containing every term (AND)"""
+		postings = sorted((self.postings(term) for term in terms), key=len)
+		if not postings:
+			return np.empty(0, dtype=np.int64)
+		result = postings[0]
+		for ids in postings[1:]:
+			if not len(result):
+				break
+			# binary-search each (fewer) candidate in the longer list
+			positions = np.searchsorted(ids, result)
+			positions[positions == len(ids)] = 0
+			result = result[ids[positions] == result] if len(ids) else ids
+		return result
+
+	def find_any(self, *terms):
+		"""Ids of the tweets containing at least one of the terms (OR)"""
+		postings = [self.postings(term) for term in terms]
+		if not postings:
+			return np.empty(0, dtype=np.int64)
+		# a stable (radix) sort is quick on runs of already-sorted ids
+		ids = np.sort(np.concatenate(postings), kind='stable')
+		if len(ids):
+			ids = ids[np.concatenate(([True], ids[1:] != ids[:-1]))]
+		return ids
+
+	def __contains__(self, term):
+		return len(self.postings(term)) > 0
+
+	def __len__(self):
+		# number of distinct terms
+		with self._lock:
+			self._ensure_loaded()
+			return len(set(self._postings) | set(self._pending))
+
+TWEET_INDEX = TweetIndex(TWEET_INDEX_FNAME)
+
+def rebuild_tweet_index(index=None, cache=None):
+	"""Index every tweet in the data cache from scratch (e.g. when the index file was lost)"""
+	index = TWEET_INDEX if index is None else index
+	cache = CACHE_DICTION if cache is None else cache
+	# read the pages before taking the index lock: the cache holds its own lock while it
+	# calls unindex_cached_pages, so taking them the other way round could deadlock
+	pages = [page_statuses(cache[identifier]['values']) for identifier in list(cache)]
+	with index._lock:
+		index._ensure_loaded()
+		index._postings, index._pending = {}, {}
+		for statuses in pages:
+			if statuses:
+				index.add_batch(TweetBatch.from_statuses(statuses))
+		index._dirty = True
+	return index
+
+def unindex_cached_pages(store, identifiers, index=None):
+	"""TTLCache on_remove hook: take the tweets on the pages being removed out of the index"""
+	index = TWEET_INDEX if index is None else index
+	tweet_ids = []
+	for identifier in identifiers:
+		if identifier in store:
+			tweet_ids.extend(int(status['id_str']) for status in page_statuses(store[identifier]['values']) if 'id_str' in status)
+	index.remove_ids(tweet_ids)
+
 #### BEGIN CODE FOR SQL FUNCTIONS ####
 #### WILL BE CREATING 2 TABLES: TWEETS (W/ SENTIMENT SCORE) & trump_MENTIONS ####
 DB_NAME = secret_data.db_name
 DB_USER = secret_data.db_user
 DB_PASSWORD = secret_data.db_password
+DB_BACKEND = getattr(secret_data, 'db_backend', 'postgres') # "postgres", or "sqlite" for an in-process <db_name>.sqlite3 file
 
 #### CODE TO ESTABLISH CONNECTION & CURSOR #####
 #### CODE TAKEN THE MODIFIED FROM LECTURE EXAMPLE ####
+def _db_dsn(db_name, db_password, db_user):
+    if db_password != "":
+        return "dbname='{0}' user='{1}' password='{2}'".format(db_name, db_user, db_password)
+    return "dbname='{0}' user='{1}'".format(db_name, db_user)
+
 def get_connection_and_cursor(db_name, db_password, db_user):
+    if DB_BACKEND != "postgres":
+        return get_storage_backend().connect(db_name, db_password, db_user)
     try:
+        db_connection = psycopg2.connect(_db_dsn(db_name, db_password, db_user))
         if db_password != "":
-            db_connection = psycopg2.connect("dbname='{0}' user='{1}' password='{2}'".format(db_name, db_user, db_password))
             print("Success connecting to database")
-        else:
-            db_connection = psycopg2.connect("dbname='{0}' user='{1}'".format(db_name, db_user))
     except:
         print("Unable to connect to the database. Check server and credentials.")
         sys.exit(1) # Stop running program if there's no db connection.
@@ -284,20 +1801,358 @@ def get_connection_and_cursor(db_name, db_password, db_user):
 
     return db_connection, db_cursor
 
-#### CODE TO SET UP DATABASE WITH TABLES ####
-def setup_database(db_name, db_password, db_user):
-	conn, cur = get_connection_and_cursor(db_name, db_password, db_user)
-	print("Connection Established")
+#### POOLED CONNECTIONS: ONE POOL PER (DB, USER), SHARED BY EVERY DB FUNCTION BELOW ####
+DB_POOL_MINCONN = 1
+DB_POOL_MAXCONN = 5
+DB_POOL_PING_AFTER_SECS = 30 # ping connections that sat idle in the pool longer than this
 
-	commands = [
+class DatabasePool(object):
+    """ThreadedConnectionPool that blocks (instead of raising) when every connection is
+    checked out, and health-checks connections as they are handed out"""
+
+    def __init__(self, dsn, minconn=DB_POOL_MINCONN, maxconn=DB_POOL_MAXCONN):
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, dsn)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._returned_at = {} # id(conn) -> time it was last put back
+
+    @staticmethod
+    def _is_healthy(conn, idle_secs):
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False # the server side of the connection is gone
+        if idle_secs < DB_POOL_PING_AFTER_SECS:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        self._slots.acquire()
+        try:
+            while True:
+                conn = self.pool.getconn()
+                idle_secs = time.monotonic() - self._returned_at.pop(id(conn), time.monotonic())
+                if self._is_healthy(conn, idle_secs):
+                    return conn
+                self.pool.putconn(conn, close=True) # drop it; the pool opens a fresh one
+        except:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        try:
+            broken = bool(conn.closed)
+            if not broken:
+                self._returned_at[id(conn)] = time.monotonic()
+            self.pool.putconn(conn, close=broken)
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        self.pool.closeall()
+
+_DB_POOLS = {}
+_DB_POOLS_LOCK = threading.Lock()
+
+def get_connection_pool(db_name, db_password, db_user):
+    key = (db_name, db_user, db_password)
+    with _DB_POOLS_LOCK:
+        if key not in _DB_POOLS:
+            try:
+                _DB_POOLS[key] = DatabasePool(_db_dsn(db_name, db_password, db_user))
+            except psycopg2.Error:
+                print("Unable to connect to the database. Check server and credentials.")
+                sys.exit(1) # Stop running program if there's no db connection.
+        return _DB_POOLS[key]
+
+def close_connection_pools():
+    with _DB_POOLS_LOCK:
+        for pool in _DB_POOLS.values():
+            pool.closeall()
+        _DB_POOLS.clear()
+
+atexit.register(close_connection_pools)
+
+@contextmanager
+def postgres_connection(db_name, db_password, db_user):
+    """Borrow a pooled connection and a RealDictCursor on it. Commits when the block
+    finishes, rolls back if it raises, and always hands the connection back"""
+    pool = get_connection_pool(db_name, db_password, db_user)
+    conn = pool.getconn()
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        try:
+            yield conn, cur
+            conn.commit()
+        except:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            cur.close()
+    finally:
+        pool.putconn(conn)
+
+#### SQLITE: THE SAME TABLES IN AN IN-PROCESS FILE, NO SERVER NEEDED ####
+SQLITE_BUSY_TIMEOUT_SECS = 30 # how long a writer waits for another connection's lock
+
+def sqlite_fname(db_name):
+    return db_name + ".sqlite3"
+
+class SQLiteCursor(object):
+    """sqlite3 cursor that takes the %s placeholders the psycopg2 queries use; rows are
+    sqlite3.Row, so row['column'] works as with a RealDictCursor"""
+    __slots__ = ('cursor',)
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=None):
+        if params is None:
+            return self.cursor.execute(sql)
+        return self.cursor.execute(sql.replace('%s', '?'), params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor.executemany(sql.replace('%s', '?'), seq_of_params)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def close(self):
+        self.cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+def _sqlite_connect(db_name):
+    conn = sqlite3.connect(sqlite_fname(db_name), timeout=SQLITE_BUSY_TIMEOUT_SECS)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL") # readers don't block the writer (and vice versa)
+    conn.execute("PRAGMA synchronous=NORMAL") # in WAL mode this only gives up durability of the last commits on power loss
+    return conn
+
+@contextmanager
+def sqlite_connection(db_name, db_password=None, db_user=None):
+    """Open the db_name sqlite file and yield (conn, SQLiteCursor); commits when the block
+    finishes, rolls back if it raises. Password and user are ignored"""
+    conn = _sqlite_connect(db_name)
+    try:
+        cur = SQLiteCursor(conn.cursor())
+        try:
+            yield conn, cur
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+    finally:
+        conn.close()
+
+#### STORAGE BACKENDS: WHAT DIFFERS BETWEEN POSTGRES AND SQLITE ####
+# per (user, hour) and (user, day) totals in tweet_time_rollups, for windowed queries
+TIME_ROLLUP_BUCKETS = {'hour': 3600, 'day': 86400} # bucket name -> bucket_secs
+_TIME_BUCKETS = "(VALUES {}) AS buckets".format(", ".join("({})".format(secs) for secs in sorted(TIME_ROLLUP_BUCKETS.values())))
+
+def _time_rollup_insert(source):
+	# group source rows (a table with tweets' columns) into every bucket size
+	return """
+		INSERT INTO tweet_time_rollups (bucket_secs, bucket_start, user_screen_name, tweet_count, retweet_sum, sentiment_sum)
+		SELECT buckets.column1, created_at - created_at % buckets.column1, user_screen_name,
+			COUNT(*), COALESCE(SUM(retweet_count), 0), COALESCE(SUM(sentiment_score), 0)
+		FROM {} CROSS JOIN {} WHERE created_at IS NOT NULL GROUP BY 1, 2, 3""".format(source, _TIME_BUCKETS)
+
+_POSTGRES_TIME_ROLLUP_REMOVE = """
+			UPDATE tweet_time_rollups r SET tweet_count = r.tweet_count - o.n, retweet_sum = r.retweet_sum - o.retweets,
+				sentiment_sum = r.sentiment_sum - o.sentiment
+			FROM (SELECT buckets.column1 AS bucket_secs, created_at - created_at % buckets.column1 AS bucket_start, user_screen_name,
+					COUNT(*) AS n, COALESCE(SUM(retweet_count), 0) AS retweets, COALESCE(SUM(sentiment_score), 0) AS sentiment
+				FROM old_rows CROSS JOIN {} WHERE created_at IS NOT NULL GROUP BY 1, 2, 3) o
+			WHERE r.bucket_secs = o.bucket_secs AND r.bucket_start = o.bucket_start AND r.user_screen_name = o.user_screen_name;""".format(_TIME_BUCKETS)
+_POSTGRES_TIME_ROLLUP_ADD = _time_rollup_insert("new_rows") + """
+			ON CONFLICT (bucket_secs, bucket_start, user_screen_name) DO UPDATE
+			SET tweet_count = tweet_time_rollups.tweet_count + EXCLUDED.tweet_count, retweet_sum = tweet_time_rollups.retweet_sum + EXCLUDED.retweet_sum,
+				sentiment_sum = tweet_time_rollups.sentiment_sum + EXCLUDED.sentiment_sum;"""
+
+_SQLITE_TIME_ROLLUP_ADD = """
+		INSERT INTO tweet_time_rollups (bucket_secs, bucket_start, user_screen_name, tweet_count, retweet_sum, sentiment_sum)
+		SELECT column1, NEW.created_at - NEW.created_at % column1, NEW.user_screen_name, 1, COALESCE(NEW.retweet_count, 0), COALESCE(NEW.sentiment_score, 0)
+		FROM {} WHERE NEW.created_at IS NOT NULL
+		ON CONFLICT (bucket_secs, bucket_start, user_screen_name) DO UPDATE
+		SET tweet_count = tweet_count + 1, retweet_sum = retweet_sum + excluded.retweet_sum, sentiment_sum = sentiment_sum + excluded.sentiment_sum;""".format(_TIME_BUCKETS)
+_SQLITE_TIME_ROLLUP_REMOVE = """
+		UPDATE tweet_time_rollups SET tweet_count = tweet_count - 1, retweet_sum = retweet_sum - COALESCE(OLD.retweet_count, 0),
+			sentiment_sum = sentiment_sum - COALESCE(OLD.sentiment_score, 0)
+		WHERE bucket_start = OLD.created_at - OLD.created_at % bucket_secs AND user_screen_name = OLD.user_screen_name;"""
+
+# per (user, classification) totals in tweet_rollups, kept current by triggers
+# postgres: statement-level triggers, one grouped update of the rollup per bulk insert, not one per row
+POSTGRES_ROLLUP_TRIGGERS = [
+	"""
+	CREATE OR REPLACE FUNCTION tweets_rollup_maintain() RETURNS trigger AS $$
+	BEGIN
+		IF TG_OP IN ('UPDATE', 'DELETE') THEN""" + _POSTGRES_TIME_ROLLUP_REMOVE + """
+			UPDATE tweet_rollups r SET tweet_count = r.tweet_count - o.n, retweet_sum = r.retweet_sum - o.retweets
+			FROM (SELECT user_screen_name, sentiment_classification, COUNT(*) AS n, COALESCE(SUM(retweet_count), 0) AS retweets
+				FROM old_rows GROUP BY user_screen_name, sentiment_classification) o
+			WHERE r.user_screen_name = o.user_screen_name AND r.sentiment_classification = o.sentiment_classification;
+		END IF;
+		IF TG_OP IN ('INSERT', 'UPDATE') THEN""" + _POSTGRES_TIME_ROLLUP_ADD + """
+			INSERT INTO tweet_rollups (user_screen_name, sentiment_classification, tweet_count, retweet_sum)
+			SELECT user_screen_name, sentiment_classification, COUNT(*), COALESCE(SUM(retweet_count), 0)
+			FROM new_rows GROUP BY user_screen_name, sentiment_classification
+			ON CONFLICT (user_screen_name, sentiment_classification) DO UPDATE
+			SET tweet_count = tweet_rollups.tweet_count + EXCLUDED.tweet_count, retweet_sum = tweet_rollups.retweet_sum + EXCLUDED.retweet_sum;
+		END IF;
+		RETURN NULL;
+	END;
+	$$ LANGUAGE plpgsql
+	""",
+	"""
+	DROP TRIGGER IF EXISTS tweets_rollup_insert ON tweets;
+	CREATE TRIGGER tweets_rollup_insert AFTER INSERT ON tweets
+		REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE tweets_rollup_maintain()
+	""",
+	"""
+	DROP TRIGGER IF EXISTS tweets_rollup_update ON tweets;
+	CREATE TRIGGER tweets_rollup_update AFTER UPDATE ON tweets
+		REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE tweets_rollup_maintain()
+	""",
+	"""
+	DROP TRIGGER IF EXISTS tweets_rollup_delete ON tweets;
+	CREATE TRIGGER tweets_rollup_delete AFTER DELETE ON tweets
+		REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE tweets_rollup_maintain()
+	"""
+]
+
+# sqlite has no transition tables, so its triggers are per row (cheap in-process)
+_SQLITE_ROLLUP_ADD = _SQLITE_TIME_ROLLUP_ADD + """
+		INSERT INTO tweet_rollups (user_screen_name, sentiment_classification, tweet_count, retweet_sum)
+		VALUES (NEW.user_screen_name, NEW.sentiment_classification, 1, COALESCE(NEW.retweet_count, 0))
+		ON CONFLICT (user_screen_name, sentiment_classification) DO UPDATE
+		SET tweet_count = tweet_count + 1, retweet_sum = retweet_sum + excluded.retweet_sum;"""
+_SQLITE_ROLLUP_REMOVE = _SQLITE_TIME_ROLLUP_REMOVE + """
+		UPDATE tweet_rollups SET tweet_count = tweet_count - 1, retweet_sum = retweet_sum - COALESCE(OLD.retweet_count, 0)
+		WHERE user_screen_name = OLD.user_screen_name AND sentiment_classification = OLD.sentiment_classification;"""
+SQLITE_ROLLUP_TRIGGERS = [
+	"CREATE TRIGGER IF NOT EXISTS tweets_rollup_insert AFTER INSERT ON tweets BEGIN" + _SQLITE_ROLLUP_ADD + "\n\tEND",
+	"CREATE TRIGGER IF NOT EXISTS tweets_rollup_update AFTER UPDATE ON tweets BEGIN" + _SQLITE_ROLLUP_REMOVE + _SQLITE_ROLLUP_ADD + "\n\tEND",
+	"CREATE TRIGGER IF NOT EXISTS tweets_rollup_delete AFTER DELETE ON tweets BEGIN" + _SQLITE_ROLLUP_REMOVE + "\n\tEND"
+]
+
+class PostgresBackend(object):
+	name = "postgres"
+	rollup_triggers = POSTGRES_ROLLUP_TRIGGERS
+	# tweets arrive roughly in time order, so a BRIN index (min/max per block range) is tiny
+	# and lets range scans skip every block outside the window
+	created_at_index = "CREATE INDEX IF NOT EXISTS tweets_created_at_idx ON tweets USING BRIN (created_at)"
+
+	def connection(self, db_name, db_password, db_user):
+		return postgres_connection(db_name, db_password, db_user)
+
+	def connect(self, db_name, db_password, db_user):
+		return get_connection_and_cursor(db_name, db_password, db_user)
+
+	def insert_rows(self, cur, insert_sql, rows):
+		# insert_sql has a single VALUES %s, which execute_values expands to the whole batch
+		psycopg2.extras.execute_values(cur, insert_sql, rows, page_size=len(rows))
+
+	def add_column(self, cur, table, column, column_type):
+		cur.execute("ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {}".format(table, column, column_type))
+
+	def stream_cursor(self, conn, name, itersize):
+		# a named cursor lives on the server and hands rows over itersize at a time, as plain tuples
+		stream_cur = conn.cursor(name, cursor_factory=psycopg2.extensions.cursor)
+		stream_cur.itersize = itersize
+		return stream_cur
+
+class SQLiteBackend(object):
+	name = "sqlite"
+	rollup_triggers = SQLITE_ROLLUP_TRIGGERS
+	created_at_index = "CREATE INDEX IF NOT EXISTS tweets_created_at_idx ON tweets (created_at)" # no BRIN: a plain b-tree
+
+	def connection(self, db_name, db_password, db_user):
+		return sqlite_connection(db_name, db_password, db_user)
+
+	def connect(self, db_name, db_password, db_user):
+		conn = _sqlite_connect(db_name)
+		return conn, SQLiteCursor(conn.cursor())
+
+	def insert_rows(self, cur, insert_sql, rows):
+		placeholders = "({})".format(", ".join(["%s"] * len(rows[0])))
+		cur.executemany(insert_sql.replace("VALUES %s", "VALUES " + placeholders, 1), rows)
+
+	def add_column(self, cur, table, column, column_type):
+		# no ADD COLUMN IF NOT EXISTS in sqlite
+		cur.execute("PRAGMA table_info({})".format(table))
+		if column not in [row['name'] for row in cur.fetchall()]:
+			cur.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, column_type))
+
+	def stream_cursor(self, conn, name, itersize):
+		# sqlite cursors already step through results lazily; just skip the Row objects
+		stream_cur = conn.cursor()
+		stream_cur.row_factory = None
+		return SQLiteCursor(stream_cur)
+
+STORAGE_BACKENDS = {
+	'postgres': PostgresBackend(),
+	'sqlite': SQLiteBackend()
+}
+
+def get_storage_backend(name=None):
+	name = name or DB_BACKEND
+	if name not in STORAGE_BACKENDS:
+		raise ValueError("Unknown db_backend: {} (expected one of {})".format(name, ", ".join(sorted(STORAGE_BACKENDS))))
+	return STORAGE_BACKENDS[name]
+
+def db_connection(db_name, db_password, db_user):
+	"""Context manager yielding (conn, cur) on the configured backend (DB_BACKEND); commits
+	when the block finishes and rolls back if it raises"""
+	return get_storage_backend().connection(db_name, db_password, db_user)
+
+#### CODE TO SET UP DATABASE WITH TABLES ####
+#### incremental=True KEEPS EXISTING TABLES (AND THEIR ROWS) INSTEAD OF DROPPING THEM ####
+def setup_database(db_name, db_password, db_user, incremental=False):
+	backend = get_storage_backend()
+	drop_commands = [
+		"""
+		DROP TABLE IF EXISTS tweet_time_rollups
+		""",
+		"""
+		DROP TABLE IF EXISTS tweet_rollups
+		""",
+		"""
+		DROP TABLE IF EXISTS ingest_watermarks
+		""",
 		"""
 		DROP TABLE IF EXISTS trump_mentions
 		""",
 		"""
 		DROP TABLE IF EXISTS tweets
-		""",
 		"""
-		CREATE TABLE tweets (
+	]
+	commands = [
+		"""
+		CREATE TABLE IF NOT EXISTS tweets (
 			id VARCHAR(50) UNIQUE,
 			tweet_text VARCHAR(200),
 			in_reply_to VARCHAR(200),
@@ -305,139 +2160,463 @@ def setup_database(db_name, db_password, db_user):
 			sentiment_classification VARCHAR(20),
 			retweet_count INT,
 			user_screen_name VARCHAR(50),
-			user_name VARCHAR(50)
+			user_name VARCHAR(50),
+			created_at BIGINT
 			)
 		""",
 		"""
-		CREATE TABLE trump_mentions (
+		CREATE TABLE IF NOT EXISTS trump_mentions (
 			parent_tweet_id VARCHAR(50) references tweets(id),
-			user_screen_name VARCHAR(50)
+			user_screen_name VARCHAR(50),
+			UNIQUE (parent_tweet_id, user_screen_name)
+			)
+		""",
+		"""
+		CREATE TABLE IF NOT EXISTS ingest_watermarks (
+			query_ident VARCHAR(500) PRIMARY KEY,
+			last_id_str VARCHAR(50),
+			updated_at TIMESTAMP
 			)
 		"""
 	]
+	# tables created before created_at was stored (kept by incremental mode) get the column added first
+	index_commands = [
+		"""
+		CREATE INDEX IF NOT EXISTS tweets_user_classification_idx ON tweets (user_screen_name, sentiment_classification)
+		""",
+		# lookups by tweet use the (parent_tweet_id, user_screen_name) unique index; this one serves lookups by user
+		"""
+		CREATE INDEX IF NOT EXISTS trump_mentions_user_idx ON trump_mentions (user_screen_name, parent_tweet_id)
+		""",
+		# per (user, classification) totals, kept current by the triggers below
+		"""
+		CREATE TABLE IF NOT EXISTS tweet_rollups (
+			user_screen_name VARCHAR(50),
+			sentiment_classification VARCHAR(20),
+			tweet_count BIGINT NOT NULL,
+			retweet_sum BIGINT NOT NULL,
+			PRIMARY KEY (user_screen_name, sentiment_classification)
+			)
+		""",
+		# backfill when the rollup is new but tweets already has rows (incremental mode on an older db)
+		"""
+		INSERT INTO tweet_rollups (user_screen_name, sentiment_classification, tweet_count, retweet_sum)
+		SELECT user_screen_name, sentiment_classification, COUNT(*), COALESCE(SUM(retweet_count), 0) FROM tweets
+		WHERE NOT EXISTS (SELECT 1 FROM tweet_rollups) GROUP BY user_screen_name, sentiment_classification
+		""",
+		backend.created_at_index,
+		# (user, hour) and (user, day) totals for windowed queries, backfilled and maintained the same way
+		"""
+		CREATE TABLE IF NOT EXISTS tweet_time_rollups (
+			bucket_secs INT,
+			bucket_start BIGINT,
+			user_screen_name VARCHAR(50),
+			tweet_count BIGINT NOT NULL,
+			retweet_sum BIGINT NOT NULL,
+			sentiment_sum DOUBLE PRECISION NOT NULL,
+			PRIMARY KEY (bucket_secs, bucket_start, user_screen_name)
+			)
+		""",
+		_time_rollup_insert("tweets") + " HAVING NOT EXISTS (SELECT 1 FROM tweet_time_rollups)"
+	] + backend.rollup_triggers # the rollups are then kept current by triggers
 			# user_name VARCHAR(50),
 			# indices VARCHAR(15),
 			# user_id INT
+	if not incremental:
+		commands = drop_commands + commands
 	# print("About to execute sql commands")
-	for sql_command in commands:
-		cur.execute(sql_command)
-		# print("1 command executed")
-	conn.commit()
-	print("##### 2 SQL tables created #####")
-
-def insert_into_tweets(dict_object, db_name, db_password, db_user):
-	conn, cur = get_connection_and_cursor(db_name,db_password, db_user)
-	#counter=0
-	for tweet in dict_object:
-		row = twitter_handler(tweet)
-		cur.execute("""INSERT INTO tweets (id, tweet_text, in_reply_to, sentiment_score, sentiment_classification, retweet_count, user_screen_name, user_name) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
-			(row.tweet_id,
-			row.text,
-			row.in_reply_to_screen_name,
-			row.get_sentiment_score()['score'],
-			row.get_sentiment_score()['classification'],
-			row.retweet_count,
-			row.user_screen_name,
-			row.user_name)
-			)
-		# counter=counter+1
-	conn.commit()
-	#print("{} Rows Inserted Into tweets table".format(counter))
-
-def insert_into_trump_mentions(dict_object, db_name, db_password, db_user):
-	conn, cur = get_connection_and_cursor(db_name, db_password, db_user)
-
-	for tweet in dict_object:
-		row = twitter_handler(tweet)
-		for mention in row.mentions:
-			cur.execute("""INSERT INTO trump_mentions (parent_tweet_id, user_screen_name) VALUES (%s, %s)""", 
-				(row.tweet_id, 
-				mention)
-			)
-		conn.commit()
+	with db_connection(db_name, db_password, db_user) as (conn, cur), timed("db.setup"):
+		print("Connection Established")
+		for sql_command in commands:
+			cur.execute(sql_command)
+			# print("1 command executed")
+		backend.add_column(cur, 'tweets', 'created_at', 'BIGINT')
+		for sql_command in index_commands:
+			cur.execute(sql_command)
+	if incremental:
+		print("##### SQL tables ready (existing rows kept) #####")
+	else:
+		print("##### 2 SQL tables created #####")
+
+#### BULK LOADING: ROWS GO OVER IN BATCHES OF BULK_BATCH_SIZE, ONE TRANSACTION PER BATCH ####
+BULK_BATCH_SIZE = 1000
+
+def bulk_load(conn, cur, insert_sql, rows, table_name, batch_size=BULK_BATCH_SIZE):
+	"""Stream an iterable of row tuples into a table (insert_sql must contain a single
+	VALUES %s), committing once per batch. Postgres gets one multi-row INSERT per batch
+	(execute_values), sqlite an executemany. Returns (row count, rows/sec)"""
+	backend = get_storage_backend()
+	start = time.perf_counter()
+	row_count = 0
+	batch = []
+	with timed("db.insert." + table_name):
+		for row in rows:
+			batch.append(row)
+			if len(batch) >= batch_size:
+				backend.insert_rows(cur, insert_sql, batch)
+				conn.commit()
+				row_count += len(batch)
+				batch = []
+		if batch:
+			backend.insert_rows(cur, insert_sql, batch)
+			conn.commit()
+			row_count += len(batch)
+	count_event("db.rows." + table_name, row_count)
+	elapsed = time.perf_counter() - start
+	rows_per_sec = row_count / elapsed if elapsed > 0 else float(row_count)
+	print("{} rows loaded into {} ({:.0f} rows/sec)".format(row_count, table_name, rows_per_sec))
+	return row_count, rows_per_sec
+
+def insert_into_tweets(dict_object, db_name, db_password, db_user, batch_size=BULK_BATCH_SIZE):
+	# dict_object can be a list of statuses or a TweetBatch
+	# a tweet that is already stored only gets its retweet count refreshed
+	batch = as_tweet_batch(dict_object).score() # one TextBlob pass per distinct text
+	with db_connection(db_name, db_password, db_user) as (conn, cur):
+		return bulk_load(conn, cur, """INSERT INTO tweets (id, tweet_text, in_reply_to, sentiment_score, sentiment_classification, retweet_count, user_screen_name, user_name, created_at) VALUES %s
+			ON CONFLICT (id) DO UPDATE SET retweet_count = EXCLUDED.retweet_count, created_at = COALESCE(tweets.created_at, EXCLUDED.created_at)""",
+			batch.tweet_rows(), 'tweets', batch_size)
+
+def insert_into_trump_mentions(dict_object, db_name, db_password, db_user, batch_size=BULK_BATCH_SIZE, tweet_ids=None):
+	# dict_object can be a list of statuses, a TweetBatch or a MentionGraph; with tweet_ids
+	# only those tweets' rows are loaded (e.g. one page's worth of a graph built up across pages)
+	graph = as_mention_graph(dict_object)
+	with db_connection(db_name, db_password, db_user) as (conn, cur):
+		return bulk_load(conn, cur, """INSERT INTO trump_mentions (parent_tweet_id, user_screen_name) VALUES %s
+			ON CONFLICT DO NOTHING""",
+			graph.rows(tweet_ids), 'trump_mentions', batch_size)
+
+#### INCREMENTAL INGESTION: EACH QUERY REMEMBERS THE NEWEST TWEET ID IT HAS LOADED ####
+def get_watermark(query_ident, db_name, db_password, db_user):
+	with db_connection(db_name, db_password, db_user) as (conn, cur):
+		cur.execute("SELECT last_id_str FROM ingest_watermarks WHERE query_ident = %s", (query_ident,))
+		row = cur.fetchone()
+	return row['last_id_str'] if row else None
+
+def set_watermark(query_ident, last_id_str, db_name, db_password, db_user):
+	with db_connection(db_name, db_password, db_user) as (conn, cur):
+		cur.execute("""INSERT INTO ingest_watermarks (query_ident, last_id_str, updated_at) VALUES (%s, %s, CURRENT_TIMESTAMP)
+			ON CONFLICT (query_ident) DO UPDATE SET last_id_str = EXCLUDED.last_id_str, updated_at = EXCLUDED.updated_at""",
+			(query_ident, last_id_str))
+
+def ingest_incremental(request_url, service_ident, params_diction, db_name, db_password, db_user,
+	with_mentions=False, max_pages=TWITTER_MAX_PAGES):
+	"""Fetch only tweets newer than the query's watermark (via since_id), upsert them and
+	move the watermark up. The newest page is always asked of the api, never the cache. If
+	max_pages ends the walk before it gets back to the watermark, the tweets fetched are
+	still loaded but the watermark stays put, so a later run still asks for the gap.
+	Tables must already exist (setup_database(..., incremental=True)).
+	Returns the number of tweets loaded."""
+	query_ident = create_request_identifier(request_url, params_diction)
+	last_id_str = get_watermark(query_ident, db_name, db_password, db_user)
+	params = dict(params_diction)
+	if last_id_str:
+		params['since_id'] = last_id_str
+	pages = list(iter_twitter_pages(request_url, service_ident, params, max_pages, refresh_head=True))
+	statuses = [status for page in pages for status in page]
+	if not statuses:
+		print("No new tweets since {}".format(last_id_str))
+		return 0
+	# a first run has no watermark to get back to; max_pages just bounds how much history it loads
+	reached_watermark = (not last_id_str or max_pages is None or len(pages) < max_pages
+		or min(int(status['id_str']) for status in pages[-1]) - 1 <= int(last_id_str))
+	batch = TweetBatch.from_statuses(statuses)
+	TWEET_INDEX.add_batch(batch)
+	insert_into_tweets(batch, db_name, db_password, db_user)
+	if with_mentions:
+		insert_into_trump_mentions(batch, db_name, db_password, db_user)
+	if reached_watermark:
+		set_watermark(query_ident, str(max(batch.ids)), db_name, db_password, db_user)
+	else:
+		print("Stopped after {} pages before reaching id {}; the watermark stays there until a run with more max_pages gets back to it".format(
+			len(pages), last_id_str))
+	return len(batch)
+
+#### STAGED PIPELINE: FETCH -> PARSE -> SCORE -> LOAD, OVERLAPPED, WITH BOUNDED QUEUES BETWEEN ####
+PIPELINE_QUEUE_SIZE = 4 # pages waiting between two stages; a full queue makes the stage before it wait
+_PIPELINE_DONE = object() # end-of-stream marker passed down the queues
+
+class _PipelineRun(object):
+	# queues plus a stop flag: the first stage to fail stops every other one, so none is
+	# left blocked on a full or empty queue
+	def __init__(self):
+		self.stop = threading.Event()
+		self.errors = []
+
+	def put(self, q, item):
+		while not self.stop.is_set():
+			try:
+				q.put(item, timeout=0.1)
+				return
+			except queue.Full:
+				pass
+
+	def get(self, q):
+		while not self.stop.is_set():
+			try:
+				return q.get(timeout=0.1)
+			except queue.Empty:
+				pass
+		return _PIPELINE_DONE
+
+	def start(self, name, target, *args):
+		def run():
+			try:
+				target(*args)
+			except BaseException as exc:
+				self.errors.append(exc)
+				self.stop.set()
+		thread = threading.Thread(target=run, name="pipeline-" + name, daemon=True)
+		thread.start()
+		return thread
+
+def run_pipeline(queries, service_ident, db_name=None, db_password=None, db_user=None, max_pages=1,
+	queue_size=PIPELINE_QUEUE_SIZE, workers=SENTIMENT_WORKERS, expire_in_hrs=10):
+	"""Fetch, parse, score and load queries [(request_url, params_diction, with_mentions)]
+	page by page, with every stage running at once: one fetching thread per query, a parsing
+	thread (one TweetBatch per page, which is also added to TWEET_INDEX), a scoring thread
+	(score_sentiments, so only big batches go to the shared process pool) and a loading
+	thread that writes each page's tweets and then its mentions, taken from the run's
+	MentionGraph. Tables must already exist; with db_name None nothing is loaded. Fetches share
+	RATE_LIMIT_BUDGETS with fetch_many_twitter_data, and an api error on any page stops
+	the run and is raised.
+
+	Returns {'batches': [[TweetBatch per page] per query], 'tweets': [count per query],
+	'mention_graph': MentionGraph of the with_mentions queries}"""
+	run = _PipelineRun()
+	pages_q, parsed_q, scored_q = queue.Queue(queue_size), queue.Queue(queue_size), queue.Queue(queue_size)
+	batches = [[] for _ in queries]
+	mention_graph = MentionGraph()
+
+	def fetch(query_index, request_url, params_diction, budget):
+		for statuses in iter_twitter_pages(request_url, service_ident, params_diction, max_pages, expire_in_hrs, budget, run.stop):
+			run.put(pages_q, (query_index, statuses))
+			if run.stop.is_set():
+				return
+		run.put(pages_q, _PIPELINE_DONE)
+
+	def parse():
+		fetchers_left = len(queries)
+		while fetchers_left:
+			item = run.get(pages_q)
+			if item is _PIPELINE_DONE:
+				if run.stop.is_set():
+					return
+				fetchers_left -= 1
+				continue
+			query_index, statuses = item
+			with timed("pipeline.parse"):
+				batch = TweetBatch.from_statuses(statuses)
+			with timed("pipeline.index"):
+				TWEET_INDEX.add_batch(batch)
+			run.put(parsed_q, (query_index, batch))
+		run.put(parsed_q, _PIPELINE_DONE)
+
+	def score():
+		while True:
+			item = run.get(parsed_q)
+			if item is _PIPELINE_DONE:
+				break
+			item[1].score(workers=workers)
+			run.put(scored_q, item)
+		run.put(scored_q, _PIPELINE_DONE)
+
+	def load():
+		while True:
+			item = run.get(scored_q)
+			if item is _PIPELINE_DONE:
+				return
+			query_index, batch = item
+			batches[query_index].append(batch)
+			with_mentions = queries[query_index][2]
+			if with_mentions:
+				mention_graph.add_batch(batch)
+			if db_name is not None:
+				with timed("pipeline.load"):
+					insert_into_tweets(batch, db_name, db_password, db_user)
+					if with_mentions:
+						insert_into_trump_mentions(mention_graph, db_name, db_password, db_user, tweet_ids=batch.ids)
+
+	threads = [run.start("fetch-{}".format(i), fetch, i, request_url, params_diction, RATE_LIMIT_BUDGETS.setdefault(request_url, RateLimitBudget()))
+		for i, (request_url, params_diction, _) in enumerate(queries)]
+	threads += [run.start("parse", parse), run.start("score", score), run.start("load", load)]
+	for thread in threads:
+		thread.join()
+	if run.errors:
+		raise run.errors[0]
+	return {
+		'batches': batches,
+		'tweets': [sum(len(batch) for batch in query_batches) for query_batches in batches],
+		'mention_graph': mention_graph
+	}
 
 ### SOME SQL FUNCTIONS TO FETCH DATA ####
 def fetch_avg_retweet_count_trump_tweets_by_classification(db_name, db_password, db_user):
-	conn, cur = get_connection_and_cursor(db_name, db_password, db_user)
-	sql = "SELECT sentiment_classification, AVG(retweet_count) FROM tweets WHERE user_screen_name = 'realDonaldTrump' GROUP BY sentiment_classification"
-	cur.execute(sql)
+	# read from the rollup, so this costs the same however many rows tweets has
+	sql = """SELECT sentiment_classification, retweet_sum * 1.0 / tweet_count AS avg FROM tweet_rollups
+		WHERE user_screen_name = 'realDonaldTrump' AND tweet_count > 0 ORDER BY sentiment_classification"""
 	x_axis = []
 	y_axis = []
-	for row in cur.fetchall():
-		x_axis.append(row['sentiment_classification'])
-		y_axis.append(int(row['avg']))
-	conn.commit()
+	with db_connection(db_name, db_password, db_user) as (conn, cur), timed("db.query.avg_retweets"):
+		cur.execute(sql)
+		for row in cur.fetchall():
+			x_axis.append(row['sentiment_classification'])
+			y_axis.append(int(row['avg']))
 	print(len(x_axis), 'records returned')
 	return x_axis, y_axis
 
+### Users Trump mentions most, and who they're mentioned alongside
+def fetch_top_mentioned(db_name, db_password, db_user, k=10):
+	# grouped straight off trump_mentions_user_idx
+	sql = """SELECT user_screen_name, COUNT(*) AS mentions FROM trump_mentions
+		GROUP BY user_screen_name ORDER BY mentions DESC, user_screen_name LIMIT %s"""
+	with db_connection(db_name, db_password, db_user) as (conn, cur), timed("db.query.top_mentioned"):
+		cur.execute(sql, (k,))
+		return [(row['user_screen_name'], int(row['mentions'])) for row in cur.fetchall()]
+
+def fetch_co_mentions(screen_name, db_name, db_password, db_user, k=10):
+	sql = """SELECT b.user_screen_name, COUNT(*) AS shared FROM trump_mentions a
+		JOIN trump_mentions b ON b.parent_tweet_id = a.parent_tweet_id AND b.user_screen_name <> a.user_screen_name
+		WHERE a.user_screen_name = %s GROUP BY b.user_screen_name ORDER BY shared DESC, b.user_screen_name LIMIT %s"""
+	with db_connection(db_name, db_password, db_user) as (conn, cur), timed("db.query.co_mentions"):
+		cur.execute(sql, (screen_name, k))
+		return [(row['user_screen_name'], int(row['shared'])) for row in cur.fetchall()]
+
 ### Most recent 100 tweets about Trump - sentiment score plot vs retweets
 def fetch_sentiment_retweets_abtrump(db_name, db_password, db_user):
-	conn, cur = get_connection_and_cursor(db_name, db_password, db_user)
 	sql = "SELECT sentiment_score, retweet_count FROM tweets WHERE user_screen_name <> 'realDonaldTrump'"
-	cur.execute(sql)
 	x_axis = []
 	y_axis = []
-	for row in cur.fetchall():
-		x_axis.append(int(row['retweet_count']))
-		y_axis.append(decimal.Decimal(row['sentiment_score']))
-	conn.commit()
+	with db_connection(db_name, db_password, db_user) as (conn, cur), timed("db.query.sentiment_retweets"):
+		cur.execute(sql)
+		for row in cur.fetchall():
+			x_axis.append(int(row['retweet_count']))
+			y_axis.append(decimal.Decimal(row['sentiment_score']))
 	print(len(x_axis), ' records returned')
 	return x_axis, y_axis
 
-if __name__ == "__main__":
-	if not CLIENT_KEY or not CLIENT_SECRET:
-		print("You need to fill in client_key and client_secret in the secret_data.py file.")
-		exit()
-	if not REQUEST_TOKEN_URL or not BASE_AUTH_URL:
-		print("You need to fill in this API's specific OAuth2 URLs in this file.")
-	if not DB_NAME or not DB_USER:
-		print("You need to create a database named (default is 'SI507_Final_Project') and fill in the db_name and db_user in the secret_data.py file accordingly")
-		exit()
+#### STREAMING QUERIES: SERVER-SIDE CURSOR, RESULTS COLLECTED INTO TYPED NUMPY ARRAYS ####
+STREAM_ITERSIZE = 10000 # rows pulled from the server per round trip
+_STREAM_CURSOR_IDS = itertools.count()
 
-    # Invoke functions
-	twitter_search_term_baseurl = "https://api.twitter.com/1.1/search/tweets.json"
-	twitter_search_term_params = {"q":"Donald Trump", "count":100}
-	twitter_search_user_baseurl = "https://api.twitter.com/1.1/statuses/user_timeline.json"
-	twitter_search_user_params = {"screen_name":"@realdonaldtrump", "count":199}
+def stream_query_arrays(sql, params, dtypes, db_name, db_password, db_user, itersize=STREAM_ITERSIZE):
+	"""Run sql through a named (server-side) cursor (a plain one on sqlite, whose cursors
+	already step through results lazily) and return one NumPy array per selected
+	column, with dtypes giving each column's type. Rows arrive itersize at a time as plain
+	tuples and each chunk is converted straight into arrays, so neither a dict per row nor
+	the whole result set is ever held in Python objects."""
+	chunks = [[] for _ in dtypes]
+	backend = get_storage_backend()
+	with db_connection(db_name, db_password, db_user) as (conn, cur), timed("db.query.stream"):
+		cursor_name = "stream_{}".format(next(_STREAM_CURSOR_IDS))
+		with backend.stream_cursor(conn, cursor_name, itersize) as stream_cur:
+			stream_cur.execute(sql, params)
+			while True:
+				rows = stream_cur.fetchmany(itersize)
+				if not rows:
+					break
+				for column_chunks, column, dtype in zip(chunks, zip(*rows), dtypes):
+					column_chunks.append(np.fromiter(column, dtype=dtype, count=len(rows)))
+	return tuple(np.concatenate(column_chunks) if column_chunks else np.empty(0, dtype=dtype)
+		for column_chunks, dtype in zip(chunks, dtypes))
 
-	print("#########\nFetching Tweets about Trump\n#########")
-	twitter_search_trump = get_twitter_data(twitter_search_term_baseurl,"Twitter",twitter_search_term_params)
-	print(len(twitter_search_trump['statuses']), 'tweets returned') # Default expire_in_hrs
-	print("#########\nFetching Tweets by Trump\#########")
-	twitter_by_trump = get_twitter_data(twitter_search_user_baseurl, "Twitter", twitter_search_user_params)
-	print(len(twitter_by_trump), 'tweets returned')
-	# t = twitter_handler(twitter_search_trump['statuses'][0])
-	# print(t.get_sentiment_score()	)
-	# print(type(t.get_sentiment_score()['score']))
-	# print (repr(t))
-	# print(str(t))
-
-	# for tweet in twitter_search_trump['statuses']:
-	# 	t = twitter_handler(tweet)
-	# 	print(t.get_sentiment_score())
-		# print(t.user_name, t.user_screen_name, t.tweet_id, t.in_reply_to_screen_name, t.retweet_count,t.get_sentiment_score()['score'],t.get_sentiment_score()['classification'])
-		# print("#####################")
-	# for tweet in twitter_by_trump:
-	# 	tt = twitter_handler(tweet)
-		# print(tt.mentions)
-		# print(tt.text)
-		# print(tt.get_sentiment_score()['classification'])
-	print("#########\nClearing Database\n#########")
-	setup_database(DB_NAME, DB_PASSWORD, DB_USER)
-	print("#########\nDatabase Restaged\n#########\nInsert Tweets about Trump\n#########")
-	insert_into_tweets(twitter_search_trump['statuses'], DB_NAME, DB_PASSWORD, DB_USER)
-	print("#########\nInsert Tweets by Trump\n#########")
-	insert_into_tweets(twitter_by_trump, DB_NAME, DB_PASSWORD, DB_USER)
-	print("#########\nInserting Users Mentioned By Trump\n#########")
-	insert_into_trump_mentions(twitter_by_trump, DB_NAME, DB_PASSWORD, DB_USER)
-	print("#########\nSQL Tables Populated\n#########")
-	## VISUALS ####
-	## WILL NEED TO FETCH FROM SQL TO PUSH TO PLOTLY ####
-	plotly.tools.set_credentials_file(username=secret_data.plotly_username, api_key=secret_data.plotly_api_key)
-	
-	#### STARTING WITH BAR CHART OF AVG RETWEET COUNT AGAINST CLASSIFIER FOR TRUMP TWEETS ####
-	tweet_sentiment, avg_retweet = fetch_avg_retweet_count_trump_tweets_by_classification(DB_NAME, DB_PASSWORD, DB_USER)
+def fetch_sentiment_retweets_abtrump_arrays(db_name, db_password, db_user, itersize=STREAM_ITERSIZE):
+	# same data as fetch_sentiment_retweets_abtrump, as (int64 retweet counts, float64 scores)
+	sql = "SELECT retweet_count, CAST(sentiment_score AS DOUBLE PRECISION) FROM tweets WHERE user_screen_name <> 'realDonaldTrump'"
+	x_axis, y_axis = stream_query_arrays(sql, None, (np.int64, np.float64), db_name, db_password, db_user, itersize)
+	print(len(x_axis), ' records returned')
+	return x_axis, y_axis
+
+### Time windows: per-hour/per-day rollups, and raw tweets in a range of created_at
+def _time_window_sql(column, start, end, screen_name):
+	# WHERE clauses (and their params) for start <= column < end, each bound optional
+	clauses, params = [], []
+	if start is not None:
+		clauses.append(column + " >= %s")
+		params.append(int(start))
+	if end is not None:
+		clauses.append(column + " < %s")
+		params.append(int(end))
+	if screen_name is not None:
+		clauses.append("user_screen_name = %s")
+		params.append(screen_name)
+	return clauses, params
+
+def fetch_time_rollups(db_name, db_password, db_user, bucket='hour', start=None, end=None, screen_name='realDonaldTrump'):
+	"""[(bucket start (epoch secs), tweet count, avg retweets, avg sentiment)] for the hour or
+	day buckets starting in [start, end), read from tweet_time_rollups; screen_name=None
+	sums over all users"""
+	clauses, params = _time_window_sql("bucket_start", start, end, screen_name)
+	sql = """SELECT bucket_start, SUM(tweet_count) AS tweets, SUM(retweet_sum) AS retweets, SUM(sentiment_sum) AS sentiment
+		FROM tweet_time_rollups WHERE {} GROUP BY bucket_start HAVING SUM(tweet_count) > 0 ORDER BY bucket_start""".format(
+		" AND ".join(["bucket_secs = %s"] + clauses))
+	with db_connection(db_name, db_password, db_user) as (conn, cur), timed("db.query.time_rollups"):
+		cur.execute(sql, [TIME_ROLLUP_BUCKETS[bucket]] + params)
+		return [(int(row['bucket_start']), int(row['tweets']), float(row['retweets']) / int(row['tweets']),
+			float(row['sentiment']) / int(row['tweets'])) for row in cur.fetchall()]
+
+def fetch_tweets_between(start, end, db_name, db_password, db_user, screen_name=None, itersize=STREAM_ITERSIZE):
+	# (int64 created_at, int64 retweet counts, float64 scores) of tweets created in [start, end),
+	# ordered by time; the range predicate is answered from tweets_created_at_idx
+	clauses, params = _time_window_sql("created_at", start, end, screen_name)
+	sql = """SELECT created_at, retweet_count, CAST(sentiment_score AS DOUBLE PRECISION) FROM tweets
+		WHERE {} ORDER BY created_at""".format(" AND ".join(["created_at IS NOT NULL"] + clauses))
+	return stream_query_arrays(sql, params, (np.int64, np.int64, np.float64), db_name, db_password, db_user, itersize)
 
+#### IN-PROCESS ANALYTICS: THE SAME AGGREGATES AS THE FETCH FUNCTIONS, STRAIGHT FROM THE BATCHES ####
+def batch_columns(*batches):
+	"""NumPy columns (id, retweet_count, score, classification, screen_name, created_at) over the scored
+	batches, keeping the first occurrence of each tweet id like tweet_rows does"""
+	batches = [as_tweet_batch(batch).score() for batch in batches]
+	ids = np.concatenate([np.array(batch.ids, dtype=np.int64) for batch in batches])
+	_, first = np.unique(ids, return_index=True)
+	first.sort() # back in load order
+	return {
+		'id': ids[first],
+		'retweet_count': np.concatenate([np.array(batch.retweet_counts, dtype=np.int64) for batch in batches])[first],
+		'score': np.concatenate([np.array(batch.scores, dtype=np.float64) for batch in batches])[first],
+		'classification': np.array([c for batch in batches for c in batch.classifications])[first],
+		'screen_name': np.array([name for batch in batches for name in batch.screen_names])[first],
+		'created_at': np.concatenate([np.array(batch.created_at, dtype=np.int64) for batch in batches])[first]
+	}
+
+def aggregate_avg_retweet_count_by_classification(columns, screen_name='realDonaldTrump'):
+	# fetch_avg_retweet_count_trump_tweets_by_classification as a group-by over the columns
+	mask = columns['screen_name'] == screen_name
+	classifications, groups = np.unique(columns['classification'][mask], return_inverse=True)
+	counts = np.bincount(groups, minlength=len(classifications))
+	retweet_sums = np.bincount(groups, weights=columns['retweet_count'][mask], minlength=len(classifications)).astype(np.int64)
+	return [str(c) for c in classifications], [int(avg) for avg in retweet_sums // counts]
+
+def aggregate_time_rollups(columns, bucket='hour', start=None, end=None, screen_name='realDonaldTrump'):
+	# fetch_time_rollups over the columns: [(bucket start, tweet count, avg retweets, avg sentiment)]
+	bucket_secs = TIME_ROLLUP_BUCKETS[bucket]
+	created_at = columns['created_at']
+	bucket_starts = created_at - created_at % bucket_secs
+	mask = np.ones(len(created_at), dtype=bool)
+	if start is not None:
+		mask &= bucket_starts >= start
+	if end is not None:
+		mask &= bucket_starts < end
+	if screen_name is not None:
+		mask &= columns['screen_name'] == screen_name
+	starts, groups = np.unique(bucket_starts[mask], return_inverse=True)
+	counts = np.bincount(groups, minlength=len(starts))
+	retweet_sums = np.bincount(groups, weights=columns['retweet_count'][mask], minlength=len(starts))
+	score_sums = np.bincount(groups, weights=columns['score'][mask], minlength=len(starts))
+	return [(int(bucket_start), int(n), float(retweets) / n, float(scores) / n)
+		for bucket_start, n, retweets, scores in zip(starts, counts, retweet_sums, score_sums)]
+
+def aggregate_sentiment_retweets(columns, excluded_screen_name='realDonaldTrump'):
+	# fetch_sentiment_retweets_abtrump_arrays over the columns: (retweet counts, scores)
+	mask = columns['screen_name'] != excluded_screen_name
+	return columns['retweet_count'][mask], columns['score'][mask]
+
+#### CHARTS: UPLOADED TO PLOTLY'S CLOUD, OR WRITTEN AS STANDALONE HTML FILES ####
+DASHBOARD_DIR = "dashboard"
+
+def dashboard_figures(tweet_sentiment, avg_retweet, retweet_counts, sentiment_scores):
+	"""The two charts, as [(plotly filename, figure)]"""
+	#### BAR CHART OF AVG RETWEET COUNT AGAINST CLASSIFIER FOR TRUMP TWEETS ####
 	data = [go.Bar(
 		x = tweet_sentiment,
 		y = avg_retweet
@@ -446,23 +2625,132 @@ if __name__ == "__main__":
 		xaxis=dict(title='Sentiment Classification'),
 		yaxis=dict(title='Average Retweet Count')
 		)
-	fig = go.Figure(data=data, layout=layout)
-	py.plot(fig, filename='Avg Retweet Count by Sentiment Category')
-	#### Sentiment scores vs retweet counts 
-	x, y = fetch_sentiment_retweets_abtrump(DB_NAME, DB_PASSWORD, DB_USER)
+	bar_fig = go.Figure(data=data, layout=layout)
+	#### Sentiment scores vs retweet counts
 	trace = go.Scatter(
-		x = y,
-		y = x,
+		x = sentiment_scores,
+		y = retweet_counts,
 		mode = 'markers',
-		marker =dict(size='10')
+		marker =dict(size=10)
 		)
 	layout2 = go.Layout(
 		title="Retweet Counts vs Sentiment Scores for Last 100 Tweets about President Trump",
 		xaxis=dict(title='Sentiment Score'),
 		yaxis=dict(title='Retweet Count')
 		)
-	data2 = [trace]
-	fig = go.Figure(data=data2, layout=layout2)
-	py.plot(fig, filename="Sentiment Scores vs Retweet Counts for Last 100 Tweets about President Trump")
+	scatter_fig = go.Figure(data=[trace], layout=layout2)
+	return [('Avg Retweet Count by Sentiment Category', bar_fig),
+		("Sentiment Scores vs Retweet Counts for Last 100 Tweets about President Trump", scatter_fig)]
+
+DASHBOARD_PAGE = """<html>
+<head><meta charset="utf-8" /><title>{title}</title><script type="text/javascript">{plotlyjs}</script></head>
+<body>
+{charts}
+</body>
+</html>
+"""
 
+def render_dashboard_offline(figures, output_dir=DASHBOARD_DIR, title="Trump Tweet Sentiment"):
+	"""Write the figures to one self-contained html page (plotly.js is inlined once, so it
+	opens without network access) and return its path"""
+	os.makedirs(output_dir, exist_ok=True)
+	path = os.path.join(output_dir, "dashboard.html")
+	with timed("charts.render"):
+		charts = [plotly.offline.plot(fig, output_type='div', include_plotlyjs=False, show_link=False) for _, fig in figures]
+		with open(path, 'w') as page_file:
+			page_file.write(DASHBOARD_PAGE.format(title=title, plotlyjs=plotly.offline.get_plotlyjs(), charts="\n".join(charts)))
+	return path
+
+if __name__ == "__main__":
+	INSTRUMENT = INSTRUMENT or "--instrument" in sys.argv
+	api_base = None
+	for arg in sys.argv:
+		if arg.startswith("--profile="):
+			PROFILE_MODE = arg.split("=", 1)[1]
+		elif arg.startswith("--api-base="):
+			api_base = arg.split("=", 1)[1]
+			use_twitter_api_base(api_base)
+
+	# a stand-in api (SI507F17_fake_twitter.py) accepts any consumer key, including empty ones
+	if not api_base and (not CLIENT_KEY or not CLIENT_SECRET):
+		print("You need to fill in client_key and client_secret in the secret_data.py file.")
+		exit()
+	if not REQUEST_TOKEN_URL or not BASE_AUTH_URL:
+		print("You need to fill in this API's specific OAuth2 URLs in this file.")
+	if not DB_NAME or not DB_USER:
+		print("You need to create a database named (default is 'SI507_Final_Project') and fill in the db_name and db_user in the secret_data.py file accordingly")
+		exit()
+	if PROFILE_MODE:
+		start_profiling(PROFILE_MODE)
+
+    # Invoke functions
+	twitter_search_term_baseurl = TWITTER_API_BASE + "/1.1/search/tweets.json"
+	twitter_search_term_params = {"q":"Donald Trump", "count":100}
+	twitter_search_user_baseurl = TWITTER_API_BASE + "/1.1/statuses/user_timeline.json"
+	twitter_search_user_params = {"screen_name":"@realdonaldtrump", "count":199}
+
+	# --offline: chart the in-memory batches to local html files, skipping the database and plotly's cloud
+	offline = "--offline" in sys.argv
+	if "--incremental" in sys.argv:
+		# only load tweets newer than the last run, keeping everything already in the tables
+		print("#########\nIncremental load\n#########")
+		setup_database(DB_NAME, DB_PASSWORD, DB_USER, incremental=True)
+		print(ingest_incremental(twitter_search_term_baseurl, "Twitter", twitter_search_term_params, DB_NAME, DB_PASSWORD, DB_USER), 'new tweets about Trump')
+		print(ingest_incremental(twitter_search_user_baseurl, "Twitter", twitter_search_user_params, DB_NAME, DB_PASSWORD, DB_USER, with_mentions=True), 'new tweets by Trump')
+	else:
+		db = (None, None, None) if offline else (DB_NAME, DB_PASSWORD, DB_USER)
+		if not offline:
+			print("#########\nClearing Database\n#########")
+			setup_database(DB_NAME, DB_PASSWORD, DB_USER)
+		print("#########\nFetching, Scoring & Loading Tweets about Trump & Tweets by Trump\n#########")
+		# fetching, parsing, scoring and loading overlap; each page is parsed once for both tables
+		pipeline = run_pipeline([
+			(twitter_search_term_baseurl, twitter_search_term_params, False),
+			(twitter_search_user_baseurl, twitter_search_user_params, True)], "Twitter", *db) # Default expire_in_hrs
+		about_trump_batches, by_trump_batches = pipeline['batches']
+		print(pipeline['tweets'][0], 'tweets about Trump returned')
+		print(pipeline['tweets'][1], 'tweets by Trump returned')
+		# t = twitter_handler(twitter_search_trump['statuses'][0])
+		# print(t.get_sentiment_score()	)
+		# print(type(t.get_sentiment_score()['score']))
+		# print (repr(t))
+		# print(str(t))
+
+		# for tweet in twitter_search_trump['statuses']:
+		# 	t = twitter_handler(tweet)
+		# 	print(t.get_sentiment_score())
+			# print(t.user_name, t.user_screen_name, t.tweet_id, t.in_reply_to_screen_name, t.retweet_count,t.get_sentiment_score()['score'],t.get_sentiment_score()['classification'])
+			# print("#####################")
+		# for tweet in twitter_by_trump:
+		# 	tt = twitter_handler(tweet)
+			# print(tt.mentions)
+			# print(tt.text)
+			# print(tt.get_sentiment_score()['classification'])
+		if not offline:
+			print("#########\nSQL Tables Populated\n#########")
+		for screen_name, mentions in pipeline['mention_graph'].top_mentioned(5):
+			print("@{} mentioned {} times".format(screen_name, mentions))
+	## VISUALS ####
+	if offline and "--incremental" not in sys.argv:
+		# incremental runs only hold the new tweets in memory, so they still chart from sql
+		columns = batch_columns(*(about_trump_batches + by_trump_batches))
+		tweet_sentiment, avg_retweet = aggregate_avg_retweet_count_by_classification(columns)
+		x, y = aggregate_sentiment_retweets(columns)
+	else:
+		tweet_sentiment, avg_retweet = fetch_avg_retweet_count_trump_tweets_by_classification(DB_NAME, DB_PASSWORD, DB_USER)
+		x, y = fetch_sentiment_retweets_abtrump_arrays(DB_NAME, DB_PASSWORD, DB_USER)
+	figures = dashboard_figures(tweet_sentiment, avg_retweet, x, y)
+	if offline:
+		print("Charts written to {}".format(render_dashboard_offline(figures)))
+	else:
+		## PUSH TO PLOTLY ####
+		plotly.tools.set_credentials_file(username=secret_data.plotly_username, api_key=secret_data.plotly_api_key)
+		for filename, fig in figures:
+			py.plot(fig, filename=filename)
 
+	if INSTRUMENT:
+		print("#########\nPipeline timings\n#########")
+		print(INSTRUMENTS.report())
+	if PROFILE_MODE:
+		print("#########\n{} profile\n#########".format(PROFILE_MODE))
+		print(stop_profiling())
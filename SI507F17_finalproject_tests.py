@@ -1,7 +1,23 @@
 import unittest
+import os
+import io
+import contextlib
+import tempfile
+import threading
+import time
+from datetime import timedelta
+import SI507F17_finalproject
+import SI507F17_benchmarks
+import SI507F17_fake_twitter
+from unittest import mock
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from SI507F17_finalproject import *
 from secret_data import *
 
+# the api tests replay the data_cache.json snapshot that ships with the repo, however old it is
+SI507F17_finalproject.CACHE_REPLAY = True
+
 ## class 1
 class Tests_Class(unittest.TestCase):
 	# Method 1
@@ -128,6 +144,1040 @@ class Tests_SQL(unittest.TestCase):
 
 		self.assertTrue(val[0] == 0)
 
+	def test_db_upsert_37(self):
+		setup_database(self.db_name, self.db_pass, self.db_user, incremental=True)
+		statuses = [dict(status, retweet_count=status['retweet_count'] + 7) for status in self.data['statuses']]
+		insert_into_tweets(statuses, self.db_name, self.db_pass, self.db_user)
+		with db_connection(self.db_name, self.db_pass, self.db_user) as (conn, cur):
+			cur.execute("SELECT COUNT(*) FROM tweets")
+			self.assertEqual(cur.fetchone()['count'], 100)
+			cur.execute("SELECT retweet_count FROM tweets WHERE id = %s", (statuses[0]['id_str'],))
+			self.assertEqual(cur.fetchone()['retweet_count'], statuses[0]['retweet_count'])
+
+	def test_db_watermark_38(self):
+		self.assertIsNone(get_watermark('QUERY', self.db_name, self.db_pass, self.db_user))
+		set_watermark('QUERY', '123', self.db_name, self.db_pass, self.db_user)
+		set_watermark('QUERY', '456', self.db_name, self.db_pass, self.db_user)
+		self.assertEqual(get_watermark('QUERY', self.db_name, self.db_pass, self.db_user), '456')
+
+	def test_db_rollup_matches_group_by_43(self):
+		insert_into_tweets(self.data['statuses'][:10], self.db_name, self.db_pass, self.db_user) # upserts, no new rows
+		statuses = [dict(status, retweet_count=status['retweet_count'] + 3) for status in self.data['statuses'][:20]]
+		insert_into_tweets(statuses, self.db_name, self.db_pass, self.db_user)
+		with db_connection(self.db_name, self.db_pass, self.db_user) as (conn, cur):
+			cur.execute("""SELECT user_screen_name, sentiment_classification, COUNT(*) AS n, SUM(retweet_count) AS retweets
+				FROM tweets GROUP BY 1, 2 ORDER BY 1, 2""")
+			expected = [(row['user_screen_name'], row['sentiment_classification'], row['n'], row['retweets']) for row in cur.fetchall()]
+			cur.execute("""SELECT user_screen_name, sentiment_classification, tweet_count, retweet_sum
+				FROM tweet_rollups WHERE tweet_count > 0 ORDER BY 1, 2""")
+			rollup = [(row['user_screen_name'], row['sentiment_classification'], row['tweet_count'], row['retweet_sum']) for row in cur.fetchall()]
+		self.assertEqual(rollup, expected)
+
+	def test_db_stream_arrays_44(self):
+		retweets, scores = fetch_sentiment_retweets_abtrump(self.db_name, self.db_pass, self.db_user)
+		retweet_array, score_array = fetch_sentiment_retweets_abtrump_arrays(self.db_name, self.db_pass, self.db_user, itersize=7)
+		self.assertEqual(retweet_array.dtype, np.int64)
+		self.assertEqual(score_array.dtype, np.float64)
+		self.assertEqual(list(retweet_array), retweets)
+		self.assertEqual(list(score_array), [float(score) for score in scores])
+
+	def test_db_pool_reuse_26(self):
+		with db_connection(self.db_name, self.db_pass, self.db_user) as (conn, cur):
+			first_conn = conn
+		with db_connection(self.db_name, self.db_pass, self.db_user) as (conn, cur):
+			self.assertIs(conn, first_conn)
+
+	def test_db_pool_rollback_27(self):
+		with self.assertRaises(ValueError):
+			with db_connection(self.db_name, self.db_pass, self.db_user) as (conn, cur):
+				cur.execute("DELETE FROM tweets")
+				raise ValueError("abort")
+		with db_connection(self.db_name, self.db_pass, self.db_user) as (conn, cur):
+			cur.execute("SELECT COUNT(*) FROM tweets")
+			self.assertEqual(cur.fetchone()['count'], 100)
+
+class Tests_Cache_Store(unittest.TestCase):
+	def setUp(self):
+		self.tmp_dir = tempfile.TemporaryDirectory()
+		self.fname = os.path.join(self.tmp_dir.name, 'test_cache.log')
+
+	def tearDown(self):
+		self.tmp_dir.cleanup()
+
+	def test_store_roundtrip_16(self):
+		store = LogCacheStore(self.fname)
+		store['A'] = {'values': [1, 2, 3]}
+		store['B'] = {'values': 'b'}
+		del store['B']
+		reopened = LogCacheStore(self.fname)
+		self.assertEqual(reopened['A'], {'values': [1, 2, 3]})
+		self.assertFalse('B' in reopened)
+
+	def test_store_migrates_legacy_json_17(self):
+		legacy = os.path.join(self.tmp_dir.name, 'legacy.json')
+		with open(legacy, 'w') as legacy_file:
+			legacy_file.write(json.dumps({'KEY': {'values': 42}}))
+		store = LogCacheStore(self.fname, legacy_fname=legacy)
+		self.assertEqual(store['KEY'], {'values': 42})
+		self.assertTrue(os.path.exists(self.fname))
+
+	def test_store_drops_torn_record_18(self):
+		store = LogCacheStore(self.fname)
+		store['A'] = {'values': 1}
+		size = os.path.getsize(self.fname)
+		with open(self.fname, 'ab') as log_file:
+			log_file.write(b'{"k": "B", "n": 500}\npartial')
+		reopened = LogCacheStore(self.fname)
+		self.assertEqual(len(reopened), 1)
+		self.assertEqual(os.path.getsize(self.fname), size)
+
+	def test_store_compaction_19(self):
+		store = LogCacheStore(self.fname)
+		for i in range(20):
+			store['A'] = {'values': i}
+		store.compact()
+		self.assertEqual(store.dead_bytes(), 0)
+		self.assertEqual(LogCacheStore(self.fname)['A'], {'values': 19})
+
+	def test_store_is_lazy_20(self):
+		legacy = os.path.join(self.tmp_dir.name, 'legacy.json')
+		with open(legacy, 'w') as legacy_file:
+			legacy_file.write(json.dumps({'KEY': {'values': 42}}))
+		store = LogCacheStore(self.fname, legacy_fname=legacy)
+		self.assertFalse(os.path.exists(self.fname))
+		self.assertTrue('KEY' in store)
+		self.assertTrue(os.path.exists(self.fname))
+
+	def test_store_sidecar_index_21(self):
+		store = LogCacheStore(self.fname)
+		store['A'] = {'values': 1}
+		store.flush_index()
+		store['B'] = {'values': 2} # appended after the sidecar was written
+		reopened = LogCacheStore(self.fname)
+		self.assertEqual(reopened['A'], {'values': 1})
+		self.assertEqual(reopened['B'], {'values': 2})
+		store.compact() # new file, so the old offsets must not be trusted
+		store['C'] = {'values': 3}
+		reopened = LogCacheStore(self.fname)
+		self.assertEqual(sorted(reopened), ['A', 'B', 'C'])
+		self.assertEqual(reopened['C'], {'values': 3})
+
+	def test_store_memo_is_bounded_81(self):
+		store = LogCacheStore(self.fname)
+		store.set_many(('K{}'.format(i), {'values': i}) for i in range(200))
+		self.assertEqual(len(store._values), 0) # writes aren't kept in memory
+		for i in range(200):
+			self.assertEqual(store['K{}'.format(i)], {'values': i})
+		self.assertEqual(list(store._values), ['K{}'.format(i) for i in range(200 - STORE_VALUE_MEMO_ENTRIES, 200)])
+
+class Tests_TTL_Cache(unittest.TestCase):
+	def setUp(self):
+		self.tmp_dir = tempfile.TemporaryDirectory()
+		self.fname = os.path.join(self.tmp_dir.name, 'ttl_cache.log')
+		SI507F17_finalproject.CACHE_REPLAY = False
+
+	def tearDown(self):
+		SI507F17_finalproject.CACHE_REPLAY = True
+		self.tmp_dir.cleanup()
+
+	def entry(self, value, expires_at):
+		return {'values': value, 'timestamp': '2017-12-14 14:58:03.721860', 'expire_in_hrs': 10, 'expires_at': expires_at}
+
+	def test_expiry_past_a_day_49(self):
+		timestamp = (datetime.now() - timedelta(hours=30)).strftime(DATETIME_FORMAT)
+		self.assertLess(cache_deadline({'timestamp': timestamp, 'expire_in_hrs': 10}), time.time()) # 30 hours is not 6 hours
+		cache = TTLCache(LogCacheStore(self.fname))
+		cache['OLD'] = {'values': 1, 'timestamp': timestamp, 'expire_in_hrs': 10} # no epoch deadline
+		self.assertIsNone(get_from_cache('old', cache))
+		self.assertFalse('OLD' in cache)
+
+	def test_sweep_removes_expired_50(self):
+		now = time.time()
+		cache = TTLCache(LogCacheStore(self.fname))
+		for i in range(5):
+			cache['K{}'.format(i)] = self.entry(i, now + 100 * (i + 1))
+		self.assertEqual(cache.sweep_expired(now + 350), 3)
+		self.assertEqual(sorted(cache), ['K3', 'K4'])
+		reopened = TTLCache(LogCacheStore(self.fname))
+		self.assertEqual(reopened.store.expires_at('K4'), now + 500)
+		self.assertEqual(reopened.sweep_expired(now + 450), 1)
+		self.assertEqual(list(reopened), ['K4'])
+
+	def test_migrated_entries_index_from_headers_79(self):
+		legacy = os.path.join(self.tmp_dir.name, 'legacy.json')
+		timestamp = datetime.now().strftime(DATETIME_FORMAT)
+		legacy_diction = {'K{}'.format(i): {'values': i, 'timestamp': timestamp, 'expire_in_hrs': i + 1} for i in range(3)}
+		with open(legacy, 'w') as legacy_file:
+			legacy_file.write(json.dumps(legacy_diction))
+		for _ in range(2): # the migrating run, then a plain reopen
+			cache = TTLCache(LogCacheStore(self.fname, legacy_fname=legacy, legacy_deadline=cache_deadline))
+			self.assertEqual(cache.sweep_expired(), 0)
+			self.assertEqual(cache.store._values, {}) # deadlines came from the record headers
+			for key, entry in legacy_diction.items():
+				self.assertEqual(cache.store.expires_at(key), cache_deadline(entry))
+
+	def test_lru_eviction_and_stats_51(self):
+		later = time.time() + 3600
+		cache = TTLCache(LogCacheStore(self.fname), max_entries=3)
+		for key in ['A', 'B', 'C']:
+			cache[key] = self.entry(key, later)
+		self.assertEqual(get_from_cache('A', cache), 'A') # A is now the most recently used
+		cache['D'] = self.entry('D', later)
+		self.assertEqual(sorted(cache), ['A', 'C', 'D'])
+		self.assertIsNone(get_from_cache('B', cache))
+		stats = cache.stats()
+		self.assertEqual((stats['entries'], stats['hits'], stats['misses'], stats['evictions']), (3, 1, 1, 1))
+		small = TTLCache(LogCacheStore(self.fname + '2'), max_bytes=stats['bytes'] // 3 * 2)
+		for key in ['A', 'B', 'C']:
+			small[key] = self.entry(key, later)
+		self.assertEqual(sorted(small), ['B', 'C'])
+
+class Tests_Cache_Format(unittest.TestCase):
+	def setUp(self):
+		self.tmp_dir = tempfile.TemporaryDirectory()
+		self.fname = os.path.join(self.tmp_dir.name, 'format_cache.log')
+		with open(CACHE_FNAME, 'r') as cache_file:
+			self.responses = [entry['values'] for entry in json.loads(cache_file.read()).values()]
+
+	def tearDown(self):
+		self.tmp_dir.cleanup()
+
+	def test_projection_keeps_handler_fields_52(self):
+		for response in self.responses:
+			projected = project_twitter_data(response)
+			self.assertEqual(type(projected), type(response))
+			for raw, slim in zip(page_statuses(response), page_statuses(projected)):
+				raw_handler, slim_handler = twitter_handler(raw), twitter_handler(slim)
+				for field in ('text', 'tweet_id', 'mentions', 'in_reply_to_screen_name', 'user_screen_name', 'user_name', 'retweet_count', 'timestamp_UTC'):
+					self.assertEqual(getattr(raw_handler, field), getattr(slim_handler, field))
+				self.assertEqual([h['text'] for h in raw_handler.hashtags], [h['text'] for h in slim_handler.hashtags])
+		self.assertEqual(project_twitter_data({'errors': []}), {'errors': []})
+
+	def test_compressed_records_read_back_53(self):
+		raw_store = LogCacheStore(self.fname + '.raw')
+		store = LogCacheStore(self.fname, codec='zlib')
+		for i, response in enumerate(self.responses):
+			raw_store['R{}'.format(i)] = response
+			store['R{}'.format(i)] = response
+		store.codec = 'lzma' # records keep whichever codec they were written with
+		store['SLIM'] = project_twitter_data(self.responses[0])
+		self.assertLess(os.path.getsize(self.fname) * 3, os.path.getsize(self.fname + '.raw'))
+		store.compact()
+		reopened = LogCacheStore(self.fname)
+		self.assertEqual(reopened['R1'], self.responses[1])
+		self.assertEqual(reopened['SLIM'], project_twitter_data(self.responses[0]))
+		with self.assertRaises(ValueError):
+			LogCacheStore(self.fname, codec='snappy')
+
+class Tests_Batch_Sentiment(unittest.TestCase):
+	def setUp(self):
+		self.texts = ["I love this, it is great", "This is a terrible, awful idea", "The meeting is on Tuesday", "I love this, it is great"]
+		self.tmp_dir = tempfile.TemporaryDirectory()
+		self.cache = SentimentCache(os.path.join(self.tmp_dir.name, 'sentiment.log'))
+
+	def tearDown(self):
+		self.tmp_dir.cleanup()
+
+	def test_batch_matches_single_22(self):
+		sentiments = score_sentiments(self.texts, cache=self.cache)
+		self.assertEqual(len(sentiments['score']), 4)
+		for i, text in enumerate(self.texts):
+			blob = TextBlob(text)
+			self.assertEqual(sentiments['score'][i], blob.sentiment.polarity)
+			self.assertEqual(sentiments['subjectivity'][i], blob.sentiment.subjectivity)
+			self.assertEqual(sentiments['classification'][i], classify_sentiment(blob.sentiment.polarity))
+
+	def test_batch_process_pool_23(self):
+		in_process = score_sentiments(self.texts * 150, workers=1, cache=self.cache)
+		pooled = score_sentiments(["{} {}".format(text, i) for i, text in enumerate(self.texts * 150)], workers=2, cache=self.cache)
+		self.assertEqual(len(pooled['classification']), 600)
+		self.assertEqual(in_process['classification'][:4], pooled['classification'][:4])
+
+	def test_process_pool_is_reused_82(self):
+		score_sentiments(["pool text {}".format(i) for i in range(600)], workers=2, cache=self.cache)
+		pool = get_sentiment_pool(2)
+		score_sentiments(["more pool text {}".format(i) for i in range(600)], workers=2, cache=self.cache)
+		self.assertIs(get_sentiment_pool(2), pool)
+		shutdown_sentiment_pools()
+		self.assertIsNot(get_sentiment_pool(2), pool) # a fresh one once the old pool is shut down
+
+	def test_sentiment_cache_hits_24(self):
+		score_sentiments(self.texts, cache=self.cache)
+		self.assertEqual(self.cache.stats()['misses'], 3) # the repeated text is scored once
+		reloaded = SentimentCache(os.path.join(self.tmp_dir.name, 'sentiment.log'))
+		sentiments = score_sentiments(["I  love this,\nit is great"], cache=reloaded)
+		self.assertEqual(reloaded.stats()['hits'], 1)
+		self.assertEqual(reloaded.stats()['misses'], 0)
+		self.assertEqual(sentiments['score'][0], TextBlob(self.texts[0]).sentiment.polarity)
+
+	def test_sentiment_cache_lru_25(self):
+		small_cache = SentimentCache(os.path.join(self.tmp_dir.name, 'small.log'), max_entries=2)
+		score_sentiments(self.texts[:3], cache=small_cache)
+		self.assertEqual(len(small_cache), 2)
+		self.assertEqual(small_cache.stats()['evictions'], 1)
+		self.assertEqual(len(SentimentCache(os.path.join(self.tmp_dir.name, 'small.log'))), 2)
+
+	def test_sentiment_cache_lazy_recency_83(self):
+		fname = os.path.join(self.tmp_dir.name, 'recency.log')
+		cache = SentimentCache(fname, max_entries=3)
+		cache.put_many({'A': (0.1, 0.1), 'B': (0.2, 0.2), 'C': (0.3, 0.3)})
+		cache.get_many(['A'])
+		cache.put_many({'D': (0.4, 0.4)}) # B is the least recently used
+		self.assertEqual(cache.stats()['evictions'], 1)
+		reopened = SentimentCache(fname, max_entries=3)
+		self.assertEqual(len(reopened), 3)
+		self.assertEqual(len(reopened.store._values), 0) # keys only until something is looked up
+		self.assertEqual(list(reopened._lru), ['C', 'A', 'D'])
+		reopened.put_many({'E': (0.5, 0.5)})
+		self.assertEqual(reopened.get_many(['A', 'C']), {'A': (0.1, 0.1)}) # C, not A, went first
+
+class _StandInHandler(BaseHTTPRequestHandler):
+	# local stand-in for the twitter API: answers with queued status codes, then 200s
+	protocol_version = "HTTP/1.1"
+
+	def setup(self):
+		BaseHTTPRequestHandler.setup(self)
+		self.server.connections += 1
+
+	def do_GET(self):
+		self.server.requests.append(self.path)
+		status = self.server.statuses.pop(0) if self.server.statuses else 200
+		body = json.dumps({'statuses': [], 'path': self.path}).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+class Tests_Twitter_Session(unittest.TestCase):
+	def setUp(self):
+		self.server = ThreadingHTTPServer(('127.0.0.1', 0), _StandInHandler)
+		self.server.connections = 0
+		self.server.requests = []
+		self.server.statuses = []
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+		self.url = "http://127.0.0.1:{}/1.1/search/tweets.json".format(self.server.server_port)
+		self.creds_loads = 0
+		self.session = TwitterSession('StandIn', creds_loader=self.load_creds)
+
+	def tearDown(self):
+		self.session.close()
+		self.server.shutdown()
+		self.server.server_close()
+
+	def load_creds(self, service_ident):
+		self.creds_loads += 1
+		return ('key', 'secret', 'owner_key_{}'.format(self.creds_loads), 'owner_secret', 'verifier')
+
+	def test_session_keep_alive_28(self):
+		for i in range(5):
+			resp = self.session.get(self.url, params={'q': 'Trump', 'count': i})
+			self.assertEqual(resp.status_code, 200)
+		self.assertEqual(len(self.server.requests), 5)
+		self.assertEqual(self.server.connections, 1)
+		self.assertEqual(self.creds_loads, 1)
+
+	def test_session_retries_server_errors_29(self):
+		self.server.statuses = [503, 503]
+		resp = self.session.get(self.url, params={'q': 'Trump'})
+		self.assertEqual(resp.status_code, 200)
+		self.assertEqual(len(self.server.requests), 3)
+
+	def test_session_returns_last_server_error_84(self):
+		self.server.statuses = [503] * 10 # more than the retries
+		with mock.patch.object(SI507F17_finalproject, 'HTTP_BACKOFF_FACTOR', 0):
+			resp = self.session.get(self.url, params={'q': 'Trump'})
+		self.assertEqual(resp.status_code, 503)
+		self.assertEqual(len(self.server.requests), HTTP_RETRIES + 1)
+		with self.assertRaises(TwitterAPIError) as raised:
+			cache_twitter_response('STAND_IN_503', resp)
+		self.assertEqual(raised.exception.status_code, 503)
+
+	def test_session_rebuilds_on_401_30(self):
+		self.server.statuses = [401]
+		resp = self.session.get(self.url, params={'q': 'Trump'})
+		self.assertEqual(resp.status_code, 200)
+		self.assertEqual(self.creds_loads, 2)
+
+def _status(tweet_id, text=None, screen_name='someone', mentions=(), retweet_count=0):
+	# the fields of a twitter status that twitter_handler reads
+	return {'id_str': str(tweet_id), 'text': text or 'tweet number {}'.format(tweet_id),
+		'entities': {'user_mentions': [{'screen_name': name} for name in mentions], 'hashtags': []},
+		'in_reply_to_screen_name': None, 'user': {'screen_name': screen_name, 'name': screen_name.title()},
+		'retweet_count': retweet_count, 'created_at': 'Thu Dec 14 19:57:46 +0000 2017'}
+
+class _PagingHandler(BaseHTTPRequestHandler):
+	# local stand-in for search/tweets.json that honours count, max_id and since_id
+	protocol_version = "HTTP/1.1"
+
+	def do_GET(self):
+		query = parse_qs(urlparse(self.path).query)
+		self.server.requests.append(query)
+		time.sleep(self.server.latency)
+		if self.server.fail_after is not None and len(self.server.requests) > self.server.fail_after:
+			body = json.dumps({'errors': [{'code': 63, 'message': 'User has been suspended.'}]}).encode('utf-8')
+			self.send_response(403)
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+			return
+		rate_headers = {}
+		if self.server.rate_limit:
+			with self.server.lock:
+				now = time.time()
+				if now >= self.server.window_start + self.server.window_secs:
+					self.server.window_start, self.server.window_used = now, 0
+				self.server.window_used += 1
+				remaining = self.server.rate_limit - self.server.window_used
+				rate_headers = {'x-rate-limit-remaining': str(max(remaining, 0)),
+					'x-rate-limit-reset': str(self.server.window_start + self.server.window_secs)}
+			if remaining < 0:
+				self.server.rejected += 1
+				self.send_response(429)
+				for name, value in rate_headers.items():
+					self.send_header(name, value)
+				self.send_header('Content-Length', '2')
+				self.end_headers()
+				self.wfile.write(b'{}')
+				return
+		count = int(query.get('count', ['15'])[0])
+		max_id = int(query['max_id'][0]) if 'max_id' in query else None
+		since_id = int(query['since_id'][0]) if 'since_id' in query else 0
+		page = [status for status in self.server.corpus if (max_id is None or int(status['id_str']) <= max_id) and int(status['id_str']) > since_id][:count]
+		body = json.dumps({'statuses': page}).encode('utf-8')
+		self.send_response(200)
+		for name, value in rate_headers.items():
+			self.send_header(name, value)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+class _StandInTestCase(unittest.TestCase):
+	# runs a _PagingHandler server and points the module's caches at throwaway files
+	def setUp(self):
+		self.server = ThreadingHTTPServer(('127.0.0.1', 0), _PagingHandler)
+		self.server.requests = []
+		self.server.corpus = [_status(1000 - i) for i in range(25)] # newest first
+		self.server.latency = 0
+		self.server.rate_limit = None
+		self.server.fail_after = None # requests answered before every later one gets a 403
+		self.server.lock = threading.Lock()
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+		self.url = "http://127.0.0.1:{}/1.1/search/tweets.json".format(self.server.server_port)
+		self.tmp_dir = tempfile.TemporaryDirectory()
+		self.saved_caches = (SI507F17_finalproject.CACHE_DICTION, SI507F17_finalproject.CREDS_DICTION, SI507F17_finalproject.TWEET_INDEX)
+		SI507F17_finalproject.CACHE_DICTION = TTLCache(LogCacheStore(os.path.join(self.tmp_dir.name, 'data.log')))
+		SI507F17_finalproject.CREDS_DICTION = TTLCache(LogCacheStore(os.path.join(self.tmp_dir.name, 'creds.log')))
+		SI507F17_finalproject.TWEET_INDEX = TweetIndex()
+		set_in_creds_cache('PagingStandIn', ('key', 'secret', 'owner_key', 'owner_secret', 'verifier'), 10)
+
+	def tearDown(self):
+		SI507F17_finalproject.CACHE_DICTION, SI507F17_finalproject.CREDS_DICTION, SI507F17_finalproject.TWEET_INDEX = self.saved_caches
+		self.server.shutdown()
+		self.server.server_close()
+		self.tmp_dir.cleanup()
+
+class Tests_Paginated_Fetch(_StandInTestCase):
+
+	def test_pages_follow_max_id_31(self):
+		tweets = list(iter_twitter_data(self.url, 'PagingStandIn', {'q': 'Trump', 'count': 10}))
+		self.assertEqual([t['id_str'] for t in tweets], [s['id_str'] for s in self.server.corpus])
+		self.assertEqual(len(self.server.requests), 4) # 10 + 10 + 5, then an empty page
+
+	def test_pages_stop_at_since_id_32(self):
+		tweets = list(iter_twitter_data(self.url, 'PagingStandIn', {'q': 'Trump', 'count': 10, 'since_id': 985}))
+		self.assertEqual(len(tweets), 15)
+
+	def test_pages_resume_from_cache_33(self):
+		list(iter_twitter_data(self.url, 'PagingStandIn', {'q': 'Trump', 'count': 10}, max_pages=2))
+		self.assertEqual(len(self.server.requests), 2)
+		tweets = list(iter_twitter_data(self.url, 'PagingStandIn', {'q': 'Trump', 'count': 10}))
+		self.assertEqual(len(tweets), 25)
+		self.assertEqual(len(self.server.requests), 4) # the first two pages came from the cache
+
+class Tests_Concurrent_Fetch(_StandInTestCase):
+	def test_queries_overlap_34(self):
+		self.server.latency = 0.3
+		queries = [(self.url, {'q': 'term {}'.format(i), 'count': 5}) for i in range(6)]
+		start = time.time()
+		results = fetch_many_twitter_data(queries, 'PagingStandIn', max_concurrency=6)
+		elapsed = time.time() - start
+		self.assertEqual(len(results), 6)
+		self.assertTrue(all(len(result['statuses']) == 5 for result in results))
+		self.assertLess(elapsed, 6 * 0.3)
+
+	def test_queries_use_cache_35(self):
+		queries = [(self.url, {'q': 'cached', 'count': 5})]
+		fetch_many_twitter_data(queries, 'PagingStandIn')
+		fetch_many_twitter_data(queries, 'PagingStandIn')
+		self.assertEqual(len(self.server.requests), 1)
+
+	def test_queries_wait_for_rate_limit_36(self):
+		self.server.rate_limit = 2
+		self.server.window_secs = 1
+		self.server.window_start = time.time()
+		self.server.window_used = 0
+		self.server.rejected = 0
+		queries = [(self.url, {'q': 'limited {}'.format(i), 'count': 5}) for i in range(4)]
+		results = fetch_many_twitter_data(queries, 'PagingStandIn', max_concurrency=1)
+		self.assertTrue(all(len(result['statuses']) == 5 for result in results))
+		self.assertEqual(self.server.rejected, 0) # the budget ran out and we waited instead of getting 429s
+
+	def test_queries_refetch_cached_errors_85(self):
+		params = {'q': 'was rate limited', 'count': 5}
+		ident = create_request_identifier(self.url, params)
+		SI507F17_finalproject.CACHE_DICTION[ident.upper()] = SI507F17_finalproject._cache_entry({'errors': [{'code': 88}]}, 10)
+		results = fetch_many_twitter_data([(self.url, params)], 'PagingStandIn')
+		self.assertEqual(len(results[0]['statuses']), 5)
+		self.assertEqual(len(self.server.requests), 1)
+
+	def test_rate_limit_backoff_without_reset_74(self):
+		budget = RateLimitBudget()
+		rejected = mock.Mock(status_code=429, headers={})
+		waits = []
+		for _ in range(3):
+			budget.update(rejected)
+			waits.append(budget.reset_at - time.time())
+			budget.reset_at = 0 # as if the wait was over
+		self.assertEqual([round(wait) for wait in waits], [1, 2, 4])
+		budget.update(mock.Mock(status_code=200, headers={}))
+		self.assertEqual(budget.backoff, RATE_LIMIT_MIN_BACKOFF_SECS)
+
+class Tests_Incremental_Ingest(_StandInTestCase):
+	def test_ingest_only_new_tweets_39(self):
+		db = (secret_data.db_name, secret_data.db_password, secret_data.db_user)
+		setup_database(*db)
+		params = {'q': 'Trump', 'count': 10}
+		self.server.corpus = self.server.corpus[10:] # the 15 oldest tweets exist at first
+		self.assertEqual(ingest_incremental(self.url, 'PagingStandIn', params, *db), 15)
+		self.server.corpus = [_status(1000 - i) for i in range(25)]
+		self.assertEqual(ingest_incremental(self.url, 'PagingStandIn', params, *db), 10)
+		self.assertEqual(self.server.requests[-1]['since_id'], ['990'])
+		self.assertEqual(ingest_incremental(self.url, 'PagingStandIn', params, *db), 0)
+		with db_connection(*db) as (conn, cur):
+			cur.execute("SELECT COUNT(*) FROM tweets")
+			self.assertEqual(cur.fetchone()['count'], 25)
+
+	def test_quiet_run_is_not_cached_77(self):
+		db = (secret_data.db_name, secret_data.db_password, secret_data.db_user)
+		setup_database(*db)
+		params = {'q': 'Trump', 'count': 10}
+		self.server.corpus = self.server.corpus[10:]
+		self.assertEqual(ingest_incremental(self.url, 'PagingStandIn', params, *db), 15)
+		self.assertEqual(ingest_incremental(self.url, 'PagingStandIn', params, *db), 0) # caches an empty head page
+		requests_before = len(self.server.requests)
+		self.server.corpus = [_status(1000 - i) for i in range(25)]
+		self.assertEqual(ingest_incremental(self.url, 'PagingStandIn', params, *db), 10)
+		self.assertEqual(self.server.requests[requests_before]['since_id'], ['990'])
+
+	def test_watermark_waits_for_full_walk_78(self):
+		db = (secret_data.db_name, secret_data.db_password, secret_data.db_user)
+		setup_database(*db)
+		params = {'q': 'Trump', 'count': 10}
+		query_ident = create_request_identifier(self.url, params)
+		self.server.corpus = self.server.corpus[20:]
+		self.assertEqual(ingest_incremental(self.url, 'PagingStandIn', params, *db), 5)
+		self.assertEqual(get_watermark(query_ident, *db), '980')
+		self.server.corpus = [_status(1000 - i) for i in range(25)]
+		self.assertEqual(ingest_incremental(self.url, 'PagingStandIn', params, *db, max_pages=1), 10) # 1000..991 only
+		self.assertEqual(get_watermark(query_ident, *db), '980')
+		self.assertEqual(ingest_incremental(self.url, 'PagingStandIn', params, *db, max_pages=None), 20)
+		self.assertEqual(get_watermark(query_ident, *db), '1000')
+		with db_connection(*db) as (conn, cur):
+			cur.execute("SELECT COUNT(*) FROM tweets")
+			self.assertEqual(cur.fetchone()['count'], 25)
+
+class Tests_Pipeline(_StandInTestCase):
+	def test_pipeline_loads_every_page_60(self):
+		db = (secret_data.db_name, secret_data.db_password, secret_data.db_user)
+		setup_database(*db)
+		self.server.corpus = [_status(1000 - i, mentions=('a', 'b') if i % 2 else ()) for i in range(25)]
+		self.server.latency = 0.02
+		saved_instrument = SI507F17_finalproject.INSTRUMENT
+		SI507F17_finalproject.INSTRUMENT = True
+		SI507F17_finalproject.INSTRUMENTS.reset()
+		try:
+			result = run_pipeline([(self.url, {'q': 'Trump', 'count': 10}, True)], 'PagingStandIn', *db, max_pages=None, queue_size=1, workers=2)
+			parse_calls = SI507F17_finalproject.INSTRUMENTS.stages['pipeline.parse'][0]
+		finally:
+			SI507F17_finalproject.INSTRUMENT = saved_instrument
+		self.assertEqual(result['tweets'], [25])
+		self.assertEqual(parse_calls, 3) # once per page, shared by both tables and the index
+		self.assertEqual(list(SI507F17_finalproject.TWEET_INDEX.find_all('tweet', 'number')),
+			sorted(int(s['id_str']) for s in self.server.corpus))
+		self.assertEqual(result['mention_graph'].top_mentioned(), [('a', 12), ('b', 12)])
+		with db_connection(*db) as (conn, cur):
+			cur.execute("SELECT COUNT(*) FROM tweets")
+			self.assertEqual(cur.fetchone()['count'], 25)
+			cur.execute("SELECT COUNT(*) FROM trump_mentions")
+			self.assertEqual(cur.fetchone()['count'], 24)
+
+	def test_pipeline_waits_for_rate_limit_75(self):
+		self.server.rate_limit = 2
+		self.server.window_secs = 1
+		self.server.window_start = time.time()
+		self.server.window_used = 0
+		self.server.rejected = 0
+		result = run_pipeline([(self.url, {'q': 'Trump', 'count': 5}, False)], 'PagingStandIn', max_pages=None, workers=1)
+		self.assertEqual(result['tweets'], [25])
+		self.assertEqual(self.server.rejected, 0) # the fetch stage spends the shared budget
+		self.assertIsNotNone(RATE_LIMIT_BUDGETS[self.url].remaining)
+
+	def test_pipeline_small_pages_skip_pool_and_reuse_graph_87(self):
+		db = (secret_data.db_name, secret_data.db_password, secret_data.db_user)
+		setup_database(*db)
+		self.server.corpus = [_status(1000 - i, mentions=('a', 'b') if i % 2 else ('c',)) for i in range(15)]
+		calls = []
+		def no_pool(workers=None):
+			calls.append('get_sentiment_pool')
+			raise AssertionError("a small page started the process pool")
+		saved_pool, saved_from_batch = SI507F17_finalproject.get_sentiment_pool, MentionGraph.__dict__['from_batch']
+		SI507F17_finalproject.get_sentiment_pool = no_pool
+		MentionGraph.from_batch = classmethod(lambda cls, tweets: calls.append('from_batch') or saved_from_batch.__func__(cls, tweets))
+		try:
+			result = run_pipeline([(self.url, {'q': 'Trump', 'count': 10}, True)], 'PagingStandIn', *db, max_pages=None, workers=2)
+		finally:
+			SI507F17_finalproject.get_sentiment_pool = saved_pool
+			MentionGraph.from_batch = saved_from_batch
+		self.assertEqual(calls, [])
+		with db_connection(*db) as (conn, cur):
+			cur.execute("SELECT parent_tweet_id, user_screen_name FROM trump_mentions")
+			rows = sorted((row['parent_tweet_id'], row['user_screen_name']) for row in cur.fetchall())
+		self.assertEqual(rows, sorted(result['mention_graph'].rows()))
+		self.assertEqual(len(rows), 7 * 2 + 8)
+
+	def test_pipeline_raises_on_api_error_76(self):
+		self.server.fail_after = 2
+		with self.assertRaises(TwitterAPIError) as raised:
+			run_pipeline([(self.url, {'q': 'Trump', 'count': 5}, False)], 'PagingStandIn', max_pages=None, workers=1)
+		self.assertEqual(raised.exception.status_code, 403)
+		self.assertEqual(len(self.server.requests), 3)
+
+	def test_pipeline_failure_stops_all_stages_61(self):
+		bad_db = (os.path.join(self.tmp_dir.name, 'missing_dir', 'db'), '', '')
+		saved_backend = SI507F17_finalproject.DB_BACKEND
+		SI507F17_finalproject.DB_BACKEND = 'sqlite' # the load stage can't open this file
+		try:
+			with self.assertRaises(Exception):
+				run_pipeline([(self.url, {'q': 'Trump', 'count': 5}, False)], 'PagingStandIn', *bad_db, max_pages=None, queue_size=1, workers=1)
+		finally:
+			SI507F17_finalproject.DB_BACKEND = saved_backend
+
+class Tests_Fake_Twitter(unittest.TestCase):
+	# synthetic tweets served by SI507F17_fake_twitter, with the module's caches on throwaway files
+	def setUp(self):
+		self.statuses = SI507F17_fake_twitter.generate_statuses(3000, seed=7)
+		self.server = SI507F17_fake_twitter.FakeTwitterServer(self.statuses).start()
+		self.tmp_dir = tempfile.TemporaryDirectory()
+		self.saved_caches = (SI507F17_finalproject.CACHE_DICTION, SI507F17_finalproject.CREDS_DICTION, SI507F17_finalproject.TWEET_INDEX)
+		SI507F17_finalproject.CACHE_DICTION = TTLCache(LogCacheStore(os.path.join(self.tmp_dir.name, 'data.log')))
+		SI507F17_finalproject.CREDS_DICTION = TTLCache(LogCacheStore(os.path.join(self.tmp_dir.name, 'creds.log')))
+		SI507F17_finalproject.TWEET_INDEX = TweetIndex()
+
+	def tearDown(self):
+		SI507F17_finalproject.CACHE_DICTION, SI507F17_finalproject.CREDS_DICTION, SI507F17_finalproject.TWEET_INDEX = self.saved_caches
+		self.server.stop()
+		self.tmp_dir.cleanup()
+
+	def test_generated_statuses_68(self):
+		ids = [int(status['id_str']) for status in self.statuses]
+		self.assertEqual(ids, sorted(set(ids), reverse=True)) # unique, newest first
+		self.assertEqual(self.statuses, SI507F17_fake_twitter.generate_statuses(3000, seed=7))
+		by_id = {status['id_str']: status for status in self.statuses}
+		replies = [status for status in self.statuses if status['in_reply_to_status_id_str']]
+		self.assertTrue(replies and any(by_id[status['in_reply_to_status_id_str']]['in_reply_to_status_id_str'] for status in replies)) # chains
+		retweets = [status for status in self.statuses if 'retweeted_status' in status]
+		self.assertTrue(retweets and all(status['text'].startswith('RT @') for status in retweets))
+		for status in self.statuses:
+			for mention in status['entities']['user_mentions']:
+				start, end = mention['indices']
+				self.assertEqual(status['text'][start:end], '@' + mention['screen_name'])
+		batch = TweetBatch.from_statuses(self.statuses)
+		self.assertEqual(len(batch), 3000)
+		self.assertEqual(list(batch.created_at), sorted(batch.created_at, reverse=True))
+		self.assertEqual(project_status(self.statuses[0])['entities'], project_status(json.loads(json.dumps(self.statuses[0])))['entities'])
+
+	def test_paging_and_rate_limits_69(self):
+		set_in_creds_cache('FakeTwitter', ('key', 'secret', 'owner_key', 'owner_secret', 'verifier'), 10)
+		search = list(iter_twitter_data(self.server.search_url, 'FakeTwitter', {'q': 'Donald Trump', 'count': 100}, max_pages=None))
+		matches = lambda text: 'donald' in text.lower() and 'trump' in text.lower() # like twitter, mentions and hashtags match too
+		self.assertEqual([t['id_str'] for t in search], [s['id_str'] for s in self.statuses if matches(s['text'])])
+		timeline = list(iter_twitter_data(self.server.timeline_url, 'FakeTwitter', {'screen_name': '@realdonaldtrump', 'count': 199}, max_pages=None))
+		self.assertEqual(len(timeline), sum(s['user']['screen_name'] == 'realDonaldTrump' for s in self.statuses))
+		self.server.rate_limits = {SI507F17_fake_twitter.TIMELINE_PATH: 2}
+		url = self.server.timeline_url
+		responses = [requests.get(url, params={'screen_name': 'realDonaldTrump', 'count': 5}) for _ in range(3)]
+		self.assertEqual([resp.status_code for resp in responses], [200, 200, 429])
+		self.assertEqual(responses[1].headers['x-rate-limit-remaining'], '0')
+		self.assertEqual(self.server.rejected, 1)
+
+	def test_rate_limited_page_raises_73(self):
+		set_in_creds_cache('FakeTwitter', ('key', 'secret', 'owner_key', 'owner_secret', 'verifier'), 10)
+		self.server.rate_limits = {SI507F17_fake_twitter.SEARCH_PATH: 2}
+		params = {'q': 'Donald Trump', 'count': 10}
+		pages = []
+		with self.assertRaises(TwitterAPIError) as raised:
+			for statuses in iter_twitter_pages(self.server.search_url, 'FakeTwitter', params, max_pages=None):
+				pages.append(statuses)
+		self.assertEqual(len(pages), 2)
+		self.assertEqual(raised.exception.status_code, 429)
+		self.assertEqual(raised.exception.errors[0]['code'], 88)
+		self.assertIsNotNone(raised.exception.reset_at)
+		self.assertEqual(len(SI507F17_finalproject.CACHE_DICTION), 2) # the 429 body was not cached
+
+	def test_oauth_handshake_70(self):
+		self.assertEqual((CLIENT_KEY, CLIENT_SECRET), ('', '')) # the shipped secret_data.py is enough for the stand-in
+		use_twitter_api_base(self.server.base_url)
+		try:
+			with mock.patch('webbrowser.open'), mock.patch('builtins.input', return_value=SI507F17_fake_twitter.FAKE_VERIFIER):
+				creds = get_tokens_from_api('FakeTwitter')
+		finally:
+			use_twitter_api_base("https://api.twitter.com")
+		self.assertEqual(list(creds[2:]), ['fake-access-token', 'fake-access-secret', SI507F17_fake_twitter.FAKE_VERIFIER])
+		self.assertEqual(list(get_from_cache('FakeTwitter', SI507F17_finalproject.CREDS_DICTION)), list(creds))
+		self.assertEqual(REQUEST_TOKEN_URL, "https://api.twitter.com/oauth/request_token")
+
+	def test_end_to_end_pipeline_71(self):
+		set_in_creds_cache('FakeTwitter', ('key', 'secret', 'owner_key', 'owner_secret', 'verifier'), 10)
+		db = (os.path.join(self.tmp_dir.name, 'e2e'), '', '')
+		saved_backend = SI507F17_finalproject.DB_BACKEND
+		SI507F17_finalproject.DB_BACKEND = 'sqlite'
+		try:
+			setup_database(*db)
+			result = run_pipeline([(self.server.search_url, {'q': 'Donald Trump', 'count': 100}, False),
+				(self.server.timeline_url, {'screen_name': '@realdonaldtrump', 'count': 200}, True)], 'FakeTwitter', *db, max_pages=None)
+			with db_connection(*db) as (conn, cur):
+				cur.execute("SELECT COUNT(*) AS n FROM tweets")
+				self.assertEqual(cur.fetchone()['n'], len(self.statuses)) # each one is by trump and/or mentions him
+			self.assertGreaterEqual(sum(result['tweets']), len(self.statuses))
+			self.assertEqual(fetch_top_mentioned(*db, k=3), result['mention_graph'].top_mentioned(3))
+		finally:
+			SI507F17_finalproject.DB_BACKEND = saved_backend
+
+class Tests_Tweet_Batch(unittest.TestCase):
+	def setUp(self):
+		self.tmp_dir = tempfile.TemporaryDirectory()
+		self.cache = SentimentCache(os.path.join(self.tmp_dir.name, 'sentiment.log'))
+		self.statuses = [_status(3, 'I love it', 'realDonaldTrump', ['a', 'b'], 10),
+			_status(2, 'I hate it', 'someone', [], 20),
+			_status(1, 'It is a chair', 'realDonaldTrump', ['b'], 30),
+			_status(3, 'I love it', 'realDonaldTrump', ['a', 'b'], 10)]
+		self.batch = TweetBatch.from_statuses(self.statuses)
+
+	def tearDown(self):
+		self.tmp_dir.cleanup()
+
+	def test_handler_has_no_dict_40(self):
+		handler = twitter_handler(self.statuses[0])
+		self.assertFalse(hasattr(handler, '__dict__'))
+		self.assertEqual(handler.mentions, ['a', 'b'])
+
+	def test_batch_columns_41(self):
+		self.assertEqual(len(self.batch), 4)
+		self.assertEqual(list(self.batch.retweet_counts), [10, 20, 30, 10])
+		self.assertEqual(self.batch.mentions_of(0), ['a', 'b'])
+		self.assertEqual(self.batch.mentions_of(1), [])
+		self.assertEqual(list(self.batch.mention_rows()), [('3', 'a'), ('3', 'b'), ('1', 'b'), ('3', 'a'), ('3', 'b')])
+
+	def test_batch_rows_match_handler_42(self):
+		rows = list(self.batch.score(cache=self.cache).tweet_rows())
+		self.assertEqual(len(rows), 3) # the repeated id is loaded once
+		handler = twitter_handler(self.statuses[1])
+		sentiment = handler.get_sentiment_score()
+		self.assertEqual(rows[1], (handler.tweet_id, handler.text, handler.in_reply_to_screen_name, sentiment['score'],
+			sentiment['classification'], handler.retweet_count, handler.user_screen_name, handler.user_name, handler.created_at))
+
+class Tests_Mention_Graph(unittest.TestCase):
+	def setUp(self):
+		self.statuses = [_status(1, mentions=('a', 'b', 'c')), _status(2, mentions=('b', 'c', 'b')), _status(3, mentions=('c',)),
+			_status(1, mentions=('a', 'b', 'c')), _status(4)]
+		self.graph = MentionGraph.from_batch(self.statuses)
+
+	def test_graph_counts_54(self):
+		self.assertEqual(len(self.graph), 4) # the repeated tweet is counted once
+		self.assertEqual(self.graph.top_mentioned(2), [('c', 3), ('b', 2)])
+		self.assertEqual(self.graph.co_mentioned('b'), [('c', 2), ('a', 1)])
+		self.assertEqual(self.graph.top_pairs(1), [(('b', 'c'), 2)])
+		self.assertEqual(sorted(self.graph.rows()), [('1', 'a'), ('1', 'b'), ('1', 'c'), ('2', 'b'), ('2', 'c'), ('3', 'c')])
+
+	def test_persisted_graph_queries_55(self):
+		db = (secret_data.db_name, secret_data.db_password, secret_data.db_user)
+		timeline = get_twitter_data("https://api.twitter.com/1.1/statuses/user_timeline.json", "Twitter", {"screen_name":"@realdonaldtrump", "count":199})
+		graph = MentionGraph.from_batch(timeline)
+		setup_database(*db)
+		insert_into_tweets(timeline, *db)
+		self.assertEqual(insert_into_trump_mentions(graph, *db)[0], sum(graph.counts.values()))
+		self.assertEqual(fetch_top_mentioned(*db, k=5), graph.top_mentioned(5))
+		top_user = graph.top_mentioned(1)[0][0]
+		self.assertEqual(fetch_co_mentions(top_user, *db, k=5), graph.co_mentioned(top_user, 5))
+
+class Tests_Tweet_Index(unittest.TestCase):
+	def setUp(self):
+		self.statuses = [_status(30, 'Make America great again https://t.co/x1', mentions=('WhiteHouse',)),
+			_status(10, 'The economy is great', mentions=('FoxNews',)), _status(20, 'Fake news from CNN', mentions=('CNN', 'FoxNews'))]
+		self.statuses[0]['entities']['hashtags'] = [{'text': 'MAGA'}]
+		self.tmp_dir = tempfile.TemporaryDirectory()
+		self.fname = os.path.join(self.tmp_dir.name, 'data_cache.index')
+		self.index = TweetIndex(self.fname).add_batch(self.statuses)
+
+	def tearDown(self):
+		self.tmp_dir.cleanup()
+
+	def test_and_or_queries_62(self):
+		self.assertEqual(list(self.index.postings('GREAT')), [10, 30]) # sorted, whatever order they came in
+		self.assertEqual(list(self.index.find_all('great', '#maga')), [30])
+		self.assertEqual(list(self.index.find_all('great', '@foxnews')), [10])
+		self.assertEqual(list(self.index.find_any('#MAGA', '@CNN')), [20, 30])
+		self.assertEqual(list(self.index.find_all('great', 'missing')), [])
+		self.assertNotIn('https', self.index) # links are not indexed
+
+	def test_index_matches_linear_scan_63(self):
+		handlers = [twitter_handler(status) for status in self.statuses]
+		for word in ('great', 'news', 'economy'):
+			expected = sorted(int(h.tweet_id) for h in handlers if word in h.text.lower().split())
+			self.assertEqual(list(self.index.postings(word)), expected)
+
+	def test_persisted_and_incremental_64(self):
+		self.index.save()
+		reloaded = TweetIndex(self.fname)
+		self.assertEqual(list(reloaded.find_any('@foxnews')), [10, 20])
+		reloaded.add_batch([_status(15, 'More great news', mentions=('FoxNews',))])
+		self.assertEqual(list(reloaded.find_all('great', '@foxnews')), [10, 15])
+		self.assertEqual(len(reloaded), len(self.index) + 1) # "more" is new
+
+	def test_migrated_cache_is_indexed_80(self):
+		legacy = os.path.join(self.tmp_dir.name, 'legacy.json')
+		with open(legacy, 'w') as legacy_file:
+			legacy_file.write(json.dumps({'PAGE': SI507F17_finalproject._cache_entry({'statuses': self.statuses}, 10)}))
+		index = TweetIndex()
+		on_migrate = mock.Mock(side_effect=lambda store: rebuild_tweet_index(index, cache=store))
+		log_fname = os.path.join(self.tmp_dir.name, 'data.log')
+		for _ in range(2): # migrates, then opens the log it wrote
+			store = LogCacheStore(log_fname, legacy_fname=legacy, on_migrate=on_migrate)
+			self.assertEqual(list(store), ['PAGE'])
+		self.assertEqual(on_migrate.call_count, 1)
+		self.assertEqual(list(index.find_any('#maga', '@cnn')), [20, 30])
+
+	def test_removed_pages_leave_the_index_88(self):
+		now = time.time()
+		page = lambda statuses, expires_at: {'values': {'statuses': statuses}, 'timestamp': '2017-12-14 14:58:03.721860', 'expire_in_hrs': 10, 'expires_at': expires_at}
+		cache = TTLCache(LogCacheStore(os.path.join(self.tmp_dir.name, 'data.log')), max_entries=2,
+			on_remove=lambda store, identifiers: unindex_cached_pages(store, identifiers, self.index))
+		cache['OLD'] = page(self.statuses[:1], now + 100)
+		cache['NEW'] = page(self.statuses[1:], now + 1000)
+		SI507F17_finalproject.CACHE_REPLAY = False
+		try:
+			self.assertEqual(cache.sweep_expired(now + 500), 1)
+		finally:
+			SI507F17_finalproject.CACHE_REPLAY = True
+		self.assertEqual(list(self.index.find_any('great', '#maga', '@whitehouse')), [10])
+		self.assertNotIn('america', self.index)
+		cache['NEXT'] = page([_status(40, 'Great jobs numbers')], now + 2000)
+		cache['LAST'] = page([_status(50, 'Jobs jobs jobs')], now + 3000) # evicts NEW
+		self.assertEqual(list(self.index.find_any('great', '@cnn', '@foxnews')), [])
+		del cache['NEXT']
+		self.assertEqual(len(self.index), 0) # 40 and 50 were never indexed
+		self.index.save()
+		self.assertEqual(len(TweetIndex(self.fname)), 0)
+
+class Tests_SQLite_Backend(unittest.TestCase):
+	def setUp(self):
+		self.tmp_dir = tempfile.TemporaryDirectory()
+		self.sqlite_db = (os.path.join(self.tmp_dir.name, 'test_db'), '', '')
+		self.pg_db = (secret_data.db_name, secret_data.db_password, secret_data.db_user)
+		self.timeline = get_twitter_data("https://api.twitter.com/1.1/statuses/user_timeline.json", "Twitter", {"screen_name":"@realdonaldtrump", "count":199})
+		self.saved_backend = SI507F17_finalproject.DB_BACKEND
+
+	def tearDown(self):
+		SI507F17_finalproject.DB_BACKEND = self.saved_backend
+		self.tmp_dir.cleanup()
+
+	def load(self, backend, db):
+		SI507F17_finalproject.DB_BACKEND = backend
+		setup_database(*db)
+		insert_into_tweets(self.timeline, *db)
+		insert_into_trump_mentions(self.timeline, *db)
+		return (fetch_avg_retweet_count_trump_tweets_by_classification(*db), fetch_top_mentioned(*db, k=5),
+			fetch_co_mentions('WhiteHouse', *db, k=5))
+
+	def test_sqlite_matches_postgres_56(self):
+		self.assertEqual(self.load('sqlite', self.sqlite_db), self.load('postgres', self.pg_db))
+		self.assertTrue(os.path.exists(self.sqlite_db[0] + '.sqlite3'))
+
+	def test_sqlite_rollup_and_watermarks_57(self):
+		SI507F17_finalproject.DB_BACKEND = 'sqlite'
+		setup_database(*self.sqlite_db, incremental=True)
+		batch = TweetBatch.from_statuses(self.timeline)
+		insert_into_tweets(batch, *self.sqlite_db)
+		for i in range(len(batch)):
+			batch.retweet_counts[i] += 1
+		insert_into_tweets(batch, *self.sqlite_db) # upsert: rollup must follow the updated counts
+		set_watermark('query', '123', *self.sqlite_db)
+		self.assertEqual(get_watermark('query', *self.sqlite_db), '123')
+		with db_connection(*self.sqlite_db) as (conn, cur):
+			cur.execute("""SELECT user_screen_name, sentiment_classification, COUNT(*) AS n, SUM(retweet_count) AS retweets
+				FROM tweets GROUP BY user_screen_name, sentiment_classification ORDER BY 1, 2""")
+			expected = [tuple(row) for row in cur.fetchall()]
+			cur.execute("SELECT * FROM tweet_rollups WHERE tweet_count > 0 ORDER BY 1, 2")
+			self.assertEqual([tuple(row) for row in cur.fetchall()], expected)
+		with self.assertRaises(ValueError):
+			get_storage_backend('oracle')
+
+class Tests_Time_Buckets(unittest.TestCase):
+	def setUp(self):
+		self.tmp_dir = tempfile.TemporaryDirectory()
+		self.sqlite_db = (os.path.join(self.tmp_dir.name, 'test_db'), '', '')
+		self.pg_db = (secret_data.db_name, secret_data.db_password, secret_data.db_user)
+		self.batch = TweetBatch.from_statuses(get_twitter_data("https://api.twitter.com/1.1/statuses/user_timeline.json", "Twitter", {"screen_name":"@realdonaldtrump", "count":199}))
+		self.saved_backend = SI507F17_finalproject.DB_BACKEND
+
+	def tearDown(self):
+		SI507F17_finalproject.DB_BACKEND = self.saved_backend
+		self.tmp_dir.cleanup()
+
+	def assertRollupsEqual(self, actual, expected):
+		self.assertEqual([row[:2] for row in actual], [row[:2] for row in expected])
+		for actual_row, expected_row in zip(actual, expected):
+			self.assertAlmostEqual(actual_row[2], expected_row[2])
+			self.assertAlmostEqual(actual_row[3], expected_row[3])
+
+	def test_parse_created_at_65(self):
+		for created_at in ('Thu Dec 14 19:57:46 +0000 2017', 'Mon Feb 29 00:00:01 +0000 2016', 'Sun Jan 01 23:30:00 -0530 2017'):
+			expected = int(datetime.strptime(created_at, SI507F17_finalproject.TWITTER_TIME_FORMAT).timestamp())
+			self.assertEqual(parse_created_at(created_at), expected)
+		self.assertEqual(parse_created_at('Thu Dec 14 19:57:46 +0000 2017'), 1513281466)
+		self.assertEqual(twitter_handler(_status(1)).created_at, 1513281466)
+		with self.assertRaises(ValueError):
+			parse_created_at('yesterday')
+
+	def test_windowed_rollups_match_batch_66(self):
+		for backend, db in (('sqlite', self.sqlite_db), ('postgres', self.pg_db)):
+			SI507F17_finalproject.DB_BACKEND = backend
+			setup_database(*db)
+			insert_into_tweets(self.batch, *db)
+			for i in range(len(self.batch)):
+				self.batch.retweet_counts[i] += 1
+			insert_into_tweets(self.batch, *db) # upsert: the rollups follow the new counts
+			columns = batch_columns(self.batch)
+			start, end = int(columns['created_at'].min()), int(columns['created_at'].max())
+			for bucket in ('hour', 'day'):
+				self.assertRollupsEqual(fetch_time_rollups(*db, bucket=bucket), aggregate_time_rollups(columns, bucket))
+			middle = start + (end - start) // 2
+			self.assertRollupsEqual(fetch_time_rollups(*db, bucket='hour', start=middle, end=end, screen_name=None),
+				aggregate_time_rollups(columns, 'hour', middle, end, None))
+			created_at, retweets, scores = fetch_tweets_between(middle, end, *db)
+			in_window = (columns['created_at'] >= middle) & (columns['created_at'] < end)
+			self.assertEqual(list(created_at), sorted(columns['created_at'][in_window]))
+			self.assertEqual(retweets.sum(), columns['retweet_count'][in_window].sum())
+
+	def test_incremental_adds_created_at_67(self):
+		SI507F17_finalproject.DB_BACKEND = 'sqlite'
+		with db_connection(*self.sqlite_db) as (conn, cur): # a tweets table from before created_at was stored
+			cur.execute("""CREATE TABLE tweets (id VARCHAR(50) UNIQUE, tweet_text VARCHAR(200), in_reply_to VARCHAR(200),
+				sentiment_score NUMERIC, sentiment_classification VARCHAR(20), retweet_count INT, user_screen_name VARCHAR(50), user_name VARCHAR(50))""")
+			cur.execute("INSERT INTO tweets VALUES (%s, %s, %s, %s, %s, %s, %s, %s)", next(self.batch.tweet_rows())[:-1])
+		setup_database(*self.sqlite_db, incremental=True)
+		self.assertEqual(fetch_time_rollups(*self.sqlite_db), []) # the old row has no created_at yet
+		insert_into_tweets(self.batch, *self.sqlite_db) # the upsert fills it in
+		self.assertRollupsEqual(fetch_time_rollups(*self.sqlite_db, bucket='day'), aggregate_time_rollups(batch_columns(self.batch), 'day'))
+
+class Tests_Offline_Dashboard(unittest.TestCase):
+	def setUp(self):
+		self.about_trump = TweetBatch.from_statuses(get_twitter_data("https://api.twitter.com/1.1/search/tweets.json", "Twitter", {"q":"Donald Trump", "count":100})['statuses'])
+		self.by_trump = TweetBatch.from_statuses(get_twitter_data("https://api.twitter.com/1.1/statuses/user_timeline.json", "Twitter", {"screen_name":"@realdonaldtrump", "count":199}))
+		self.tmp_dir = tempfile.TemporaryDirectory()
+
+	def tearDown(self):
+		self.tmp_dir.cleanup()
+
+	def test_aggregates_match_sql_58(self):
+		db = (secret_data.db_name, secret_data.db_password, secret_data.db_user)
+		setup_database(*db)
+		insert_into_tweets(self.about_trump, *db)
+		insert_into_tweets(self.by_trump, *db)
+		columns = batch_columns(self.about_trump, self.by_trump)
+		self.assertEqual(aggregate_avg_retweet_count_by_classification(columns), fetch_avg_retweet_count_trump_tweets_by_classification(*db))
+		retweets, scores = aggregate_sentiment_retweets(columns)
+		sql_retweets, sql_scores = fetch_sentiment_retweets_abtrump_arrays(*db)
+		self.assertEqual(sorted(zip(retweets, scores)), sorted(zip(sql_retweets, sql_scores)))
+
+	def test_render_offline_59(self):
+		columns = batch_columns(self.about_trump, self.by_trump)
+		tweet_sentiment, avg_retweet = aggregate_avg_retweet_count_by_classification(columns)
+		figures = dashboard_figures(tweet_sentiment, avg_retweet, *aggregate_sentiment_retweets(columns))
+		path = render_dashboard_offline(figures, self.tmp_dir.name)
+		with open(path, 'r') as page_file:
+			page = page_file.read()
+		self.assertEqual(page.count('Plotly.newPlot'), 2)
+		self.assertNotIn('<script src=', page) # plotly.js is inlined, not fetched
+
+class Tests_Benchmarks(unittest.TestCase):
+	def test_benchmark_report_45(self):
+		report = SI507F17_benchmarks.run_benchmarks(tweets=500, repeat=1, stages=('parse',))
+		self.assertEqual(report['tweets'], 500)
+		self.assertEqual([result['stage'] for result in report['results']], ['parse: twitter_handler per tweet', 'parse: TweetBatch.from_statuses', 'parse: MentionGraph.from_batch'])
+		self.assertEqual(json.loads(json.dumps(report)), report)
+
+	def test_end_to_end_stage_72(self):
+		saved_backend = SI507F17_finalproject.DB_BACKEND
+		report = SI507F17_benchmarks.run_benchmarks(tweets=400, repeat=1, stages=('e2e',), db_backend='sqlite')
+		self.assertEqual(SI507F17_finalproject.DB_BACKEND, saved_backend)
+		[result] = report['results']
+		self.assertEqual((result['stage'], result['items']), ('e2e: fake api -> run_pipeline', 400))
+		self.assertGreater(result['api_requests'], 2)
+
+	def test_replicated_ids_unique_46(self):
+		statuses = [_status(1), _status(2)]
+		replicated = SI507F17_benchmarks.replicate_statuses(statuses, 10)
+		self.assertEqual(len(set(status['id_str'] for status in replicated)), 10)
+		self.assertEqual(len(set(status['text'] for status in replicated)), 10)
+
+class Tests_Instrumentation(unittest.TestCase):
+	def setUp(self):
+		self.saved_instrument = SI507F17_finalproject.INSTRUMENT
+		SI507F17_finalproject.INSTRUMENTS.reset()
+
+	def tearDown(self):
+		SI507F17_finalproject.INSTRUMENT = self.saved_instrument
+		SI507F17_finalproject.INSTRUMENTS.reset()
+
+	def test_stage_timings_recorded_47(self):
+		SI507F17_finalproject.INSTRUMENT = True
+		diction = {}
+		get_from_cache("missing", diction)
+		with SI507F17_finalproject.timed("stage.a"):
+			pass
+		with SI507F17_finalproject.timed("stage.a"):
+			pass
+		instruments = SI507F17_finalproject.INSTRUMENTS
+		self.assertEqual(instruments.stages["stage.a"][0], 2)
+		self.assertEqual(instruments.counters["cache.miss"], 1)
+		self.assertIn("stage.a", instruments.report())
+
+	def test_cached_fetch_is_counted_not_printed_86(self):
+		url, params = "https://api.twitter.com/1.1/search/tweets.json", {"q": "Donald Trump", "count": 100}
+		get_twitter_data(url, "Twitter", params) # the first use may migrate the shipped json cache
+		SI507F17_finalproject.INSTRUMENT = True
+		output = io.StringIO()
+		with contextlib.redirect_stdout(output):
+			data = get_twitter_data(url, "Twitter", params)
+		self.assertEqual(len(data['statuses']), 100)
+		self.assertEqual(output.getvalue(), "")
+		self.assertEqual(SI507F17_finalproject.INSTRUMENTS.counters["fetch.from_cache"], 1)
+
+	def test_disabled_is_noop_48(self):
+		SI507F17_finalproject.INSTRUMENT = False
+		self.assertIs(SI507F17_finalproject.timed("stage.a"), SI507F17_finalproject._NULL_TIMER)
+		SI507F17_finalproject.count_event("cache.hit")
+		self.assertEqual(SI507F17_finalproject.INSTRUMENTS.counters, {})
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)
@@ -11,6 +11,7 @@ client_secret=""
 db_name = "SI507_Final_Project"
 db_user = "nikhilkalambur" ## PLEASE REPLACE THIS WITH THE USER NAME FOR YOUR COMPUTER
 db_password = "" ## FEEL FREE TO KEEP THIS BLANK
+db_backend = "postgres" ## OR "sqlite" TO USE A LOCAL <db_name>.sqlite3 FILE INSTEAD OF A POSTGRES SERVER
 
 # THESE ARE CREDITS FOR POSTING TO PLOTLY
 plotly_api_key = "xR42cP0jfc1IBuuz8ryp"